@@ -0,0 +1,24 @@
+#!/usr/bin/python3
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Prepares the logging and initiates the asyncio consumer,
+an alternative to entrypoint.py when aio-pika is installed.
+"""
+import logging
+
+if __name__ == "__main__":
+    from entrypoint import _prep_logging
+
+    _prep_logging()
+    logging.getLogger("aio_pika").setLevel(logging.WARNING)
+    logging.getLogger("aiormq").setLevel(logging.WARNING)
+
+    from rabbit_consumer.async_consumer import initiate_async_consumer
+    from rabbit_consumer.consumer_config import load_config
+    from rabbit_consumer.metrics import start_metrics_server
+
+    # Fail fast on a bad config, rather than part way through a message
+    config = load_config()
+    start_metrics_server(config.consumer_metrics_port)
+    initiate_async_consumer()
@@ -0,0 +1,551 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file provides a stand-in for the Aquilon REST API, implementing
+the endpoints used by aq_api against an in-memory model of machines
+and hosts. Point AQ_URL at it to test or benchmark without Aquilon.
+Run with: python -m benchmarks.aq_server --port 8080 --latency-ms 50
+"""
+import argparse
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from unittest.mock import Mock, patch
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from rabbit_consumer import aq_api
+
+logger = logging.getLogger(__name__)
+
+Params = Dict[str, str]
+
+
+class FakeAqError(Exception):
+    """
+    Raised by the fake to return a 400 with the message, as Aquilon does
+    """
+
+
+@dataclass
+class FakeMachine:
+    """
+    A machine and its interfaces, mapped from name to MAC address
+    """
+
+    name: str
+    serial: str
+    params: Params
+    interfaces: Dict[str, str] = field(default_factory=dict)
+    bootable: Optional[str] = None
+    addresses: List[str] = field(default_factory=list)
+
+
+@dataclass
+class FakeHost:
+    """
+    A host, which is bound to a single machine
+    """
+
+    hostname: str
+    machine: str
+    ip: str
+    params: Params
+    makes: int = 0
+
+
+class FakeAqState:
+    """
+    The in-memory machines and hosts, which enforces the same
+    deletion order as Aquilon. All methods are thread-safe.
+    """
+
+    def __init__(self) -> None:
+        self.machines: Dict[str, FakeMachine] = {}
+        self.hosts: Dict[str, FakeHost] = {}
+        self._next_machine: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _machine(self, name: str) -> FakeMachine:
+        if name not in self.machines:
+            raise FakeAqError(f"Machine {name} not found.")
+        return self.machines[name]
+
+    def _host(self, hostname: str) -> FakeHost:
+        if hostname not in self.hosts:
+            raise FakeAqError(f"Host {hostname} not found.")
+        return self.hosts[hostname]
+
+    def next_machine(self, prefix: str, params: Params) -> str:
+        """
+        Creates a machine with the next free name for the prefix
+        """
+        with self._lock:
+            self._next_machine[prefix] += 1
+            name = f"{prefix}{self._next_machine[prefix]}"
+            self.machines[name] = FakeMachine(name, params.get("serial", ""), params)
+            return name
+
+    def describe_machine(self, name: str) -> str:
+        """
+        Describes a machine, including its interfaces and addresses
+        """
+        with self._lock:
+            machine = self._machine(name)
+            lines = [f"Machine: {machine.name}", f"  Serial: {machine.serial}"]
+            for interface, mac in machine.interfaces.items():
+                boot = " [boot, default_route]" if interface == machine.bootable else ""
+                lines.append(f"  Interface: {interface} {mac}{boot}")
+            lines.extend(f"    Provides: {address}" for address in machine.addresses)
+            return "\n".join(lines)
+
+    def delete_machine(self, name: str) -> str:
+        """
+        Deletes a machine, which must no longer have a host or addresses
+        """
+        with self._lock:
+            machine = self._machine(name)
+            host = next((h for h in self.hosts.values() if h.machine == name), None)
+            if host:
+                raise FakeAqError(
+                    f"Machine {name} is still in use by host {host.hostname}."
+                )
+            if machine.addresses:
+                raise FakeAqError(f"Machine {name} still has addresses assigned.")
+            del self.machines[name]
+            return ""
+
+    def add_interface(self, name: str, interface: str, params: Params) -> str:
+        """
+        Adds an interface to a machine
+        """
+        with self._lock:
+            machine = self._machine(name)
+            if interface in machine.interfaces:
+                raise FakeAqError(f"Machine {name} already has interface {interface}.")
+            machine.interfaces[interface] = params.get("mac", "")
+            return ""
+
+    def update_interface(self, name: str, interface: str, params: Params) -> str:
+        """
+        Marks an interface as the boot interface when requested
+        """
+        with self._lock:
+            machine = self._machine(name)
+            if interface not in machine.interfaces:
+                raise FakeAqError(f"Interface {interface} of {name} not found.")
+            if "boot" in params:
+                machine.bootable = interface
+            return ""
+
+    def delete_interface(self, params: Params) -> str:
+        """
+        Deletes an interface, which must no longer have addresses
+        """
+        with self._lock:
+            machine = self._machine(params.get("machine", ""))
+            interface = params.get("interface", "")
+            if interface not in machine.interfaces:
+                raise FakeAqError(f"Interface {interface} of {machine.name} not found.")
+            if machine.addresses:
+                raise FakeAqError(f"Interface {interface} still has addresses.")
+            del machine.interfaces[interface]
+            if machine.bootable == interface:
+                machine.bootable = None
+            return ""
+
+    def delete_address(self, params: Params) -> str:
+        """
+        Removes an address from a machine's interface
+        """
+        with self._lock:
+            machine = self._machine(params.get("machine", ""))
+            address = params.get("ip", "")
+            if address not in machine.addresses:
+                raise FakeAqError(f"Address {address} not found on {machine.name}.")
+            machine.addresses.remove(address)
+            return ""
+
+    def describe_host(self, hostname: str) -> str:
+        """
+        Describes a host
+        """
+        with self._lock:
+            host = self._host(hostname)
+            return f"Host: {host.hostname}\n  Machine: {host.machine}\n  IP: {host.ip}"
+
+    def create_host(self, hostname: str, params: Params) -> str:
+        """
+        Creates a host on an existing machine, assigning its address
+        """
+        with self._lock:
+            if hostname in self.hosts:
+                raise FakeAqError(f"Host {hostname} already exists.")
+            machine = self._machine(params.get("machine", ""))
+            host = FakeHost(hostname, machine.name, params.get("ip", ""), params)
+            self.hosts[hostname] = host
+            machine.addresses.append(host.ip)
+            return ""
+
+    def delete_host(self, hostname: str) -> str:
+        """
+        Deletes a host, freeing its address
+        """
+        with self._lock:
+            host = self.hosts.pop(self._host(hostname).hostname)
+            machine = self.machines.get(host.machine)
+            if machine and host.ip in machine.addresses:
+                machine.addresses.remove(host.ip)
+            return ""
+
+    def make(self, hostname: str) -> str:
+        """
+        Compiles the templates of a host
+        """
+        with self._lock:
+            self._host(hostname).makes += 1
+            return ""
+
+    def manage(self, hostname: str, params: Params) -> str:
+        """
+        Moves a host to another domain or sandbox
+        """
+        with self._lock:
+            host = self._host(hostname)
+            for key in ("domain", "sandbox"):
+                host.params.pop(key, None)
+                if key in params:
+                    host.params[key] = params[key]
+            return ""
+
+    def find_machine(self, params: Params) -> str:
+        """
+        Returns the name of the machine with the serial, or nothing
+        """
+        with self._lock:
+            serial = params.get("serial")
+            return next(
+                (m.name for m in self.machines.values() if m.serial == serial), ""
+            )
+
+    def find_host(self, params: Params) -> str:
+        """
+        Returns the hostname on the machine, or nothing
+        """
+        with self._lock:
+            machine = params.get("machine")
+            return next(
+                (h.hostname for h in self.hosts.values() if h.machine == machine), ""
+            )
+
+
+# Handlers receive the state, the groups matched from the path and the params
+_Route = Tuple[str, str, "re.Pattern[str]", Callable[..., str]]
+
+_ROUTES: List[_Route] = [
+    (
+        "PUT",
+        "next_machine",
+        re.compile(r"/next_machine/(?P<prefix>[^/]+)"),
+        lambda s, g, p: s.next_machine(g["prefix"], p),
+    ),
+    (
+        "GET",
+        "find_machine",
+        re.compile(r"/find/machine"),
+        lambda s, g, p: s.find_machine(p),
+    ),
+    ("GET", "find_host", re.compile(r"/find/host"), lambda s, g, p: s.find_host(p)),
+    (
+        "PUT",
+        "add_interface",
+        re.compile(r"/machine/(?P<name>[^/]+)/interface/(?P<interface>[^/]+)"),
+        lambda s, g, p: s.add_interface(g["name"], g["interface"], p),
+    ),
+    (
+        "POST",
+        "update_interface",
+        re.compile(r"/machine/(?P<name>[^/]+)/interface/(?P<interface>[^/]+)"),
+        lambda s, g, p: s.update_interface(g["name"], g["interface"], p),
+    ),
+    (
+        "GET",
+        "machine",
+        re.compile(r"/machine/(?P<name>[^/]+)"),
+        lambda s, g, p: s.describe_machine(g["name"]),
+    ),
+    (
+        "DELETE",
+        "delete_machine",
+        re.compile(r"/machine/(?P<name>[^/]+)"),
+        lambda s, g, p: s.delete_machine(g["name"]),
+    ),
+    (
+        "POST",
+        "make",
+        re.compile(r"/host/(?P<hostname>[^/]+)/command/make"),
+        lambda s, g, p: s.make(g["hostname"]),
+    ),
+    (
+        "POST",
+        "manage",
+        re.compile(r"/host/(?P<hostname>[^/]+)/command/manage"),
+        lambda s, g, p: s.manage(g["hostname"], p),
+    ),
+    (
+        "GET",
+        "host",
+        re.compile(r"/host/(?P<hostname>[^/]+)"),
+        lambda s, g, p: s.describe_host(g["hostname"]),
+    ),
+    (
+        "PUT",
+        "create_host",
+        re.compile(r"/host/(?P<hostname>[^/]+)"),
+        lambda s, g, p: s.create_host(g["hostname"], p),
+    ),
+    (
+        "DELETE",
+        "delete_host",
+        re.compile(r"/host/(?P<hostname>[^/]+)"),
+        lambda s, g, p: s.delete_host(g["hostname"]),
+    ),
+    (
+        "DELETE",
+        "delete_address",
+        re.compile(r"/interface_address"),
+        lambda s, g, p: s.delete_address(p),
+    ),
+    (
+        "POST",
+        "delete_interface",
+        re.compile(r"/interface/command/del"),
+        lambda s, g, p: s.delete_interface(p),
+    ),
+]
+
+
+class FakeAqServer(ThreadingHTTPServer):
+    """
+    Serves the fake Aquilon API on a thread per request. Each request
+    waits for latency_seconds, or the latency for its route if one is
+    given. While require_auth is set, requests without a Negotiate
+    token are refused with a 401, which can be switched at any time.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: Tuple[str, int] = ("127.0.0.1", 0),
+        latency_seconds: float = 0,
+        route_latencies: Optional[Dict[str, float]] = None,
+        require_auth: bool = True,
+    ) -> None:
+        super().__init__(address, _FakeAqHandler)
+        self.state = FakeAqState()
+        self.latency_seconds = latency_seconds
+        self.route_latencies = dict(route_latencies or {})
+        self.require_auth = require_auth
+        self.requests: Counter = Counter()
+
+    @property
+    def url(self) -> str:
+        """
+        The base URL to use as AQ_URL
+        """
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def latency_for(self, route: str) -> float:
+        """
+        Returns how long requests to the route should take
+        """
+        return self.route_latencies.get(route, self.latency_seconds)
+
+
+class _FakeAqHandler(BaseHTTPRequestHandler):
+    """
+    Dispatches each request to the matching route on the server's state
+    """
+
+    server: FakeAqServer
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """
+        Handles a GET request
+        """
+        self._dispatch("GET")
+
+    def do_PUT(self) -> None:  # pylint: disable=invalid-name
+        """
+        Handles a PUT request
+        """
+        self._dispatch("PUT")
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """
+        Handles a POST request
+        """
+        self._dispatch("POST")
+
+    def do_DELETE(self) -> None:  # pylint: disable=invalid-name
+        """
+        Handles a DELETE request
+        """
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method: str) -> None:
+        if self.server.require_auth and not self.headers.get(
+            "Authorization", ""
+        ).startswith("Negotiate "):
+            self._respond(
+                401, "Authentication required", {"WWW-Authenticate": "Negotiate"}
+            )
+            return
+
+        url = urlsplit(self.path)
+        params = {
+            key: values[-1]
+            for key, values in parse_qs(url.query, keep_blank_values=True).items()
+        }
+        for route_method, name, pattern, handler in _ROUTES:
+            match = pattern.fullmatch(url.path)
+            if route_method != method or not match:
+                continue
+
+            self.server.requests[name] += 1
+            latency = self.server.latency_for(name)
+            if latency > 0:
+                time.sleep(latency)
+            try:
+                body = handler(self.server.state, match.groupdict(), params)
+            except FakeAqError as err:
+                self._respond(400, str(err))
+                return
+            self._respond(200, body)
+            return
+
+        self._respond(404, f"No route for {method} {url.path}")
+
+    def _respond(
+        self, status: int, body: str, headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        encoded = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(encoded)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class FakeNegotiateAuth(
+    requests.auth.AuthBase
+):  # pylint: disable=too-few-public-methods
+    """
+    Sends a placeholder Negotiate token, so aq_api passes the
+    fake server's auth check without a Kerberos ticket
+    """
+
+    def __call__(self, request: requests.PreparedRequest) -> requests.PreparedRequest:
+        request.headers["Authorization"] = "Negotiate fake-token"
+        return request
+
+
+@contextmanager
+def fake_kerberos() -> Iterator[None]:
+    """
+    Replaces Kerberos in aq_api for the duration of the block, so it
+    can talk to the fake server. New sessions are used on both sides.
+    """
+    aq_api.reset_session_pool()
+    try:
+        with patch.object(
+            aq_api, "HTTPKerberosAuth", lambda **_: FakeNegotiateAuth()
+        ), patch.object(aq_api, "get_ticket_cache", return_value=Mock()):
+            yield
+    finally:
+        aq_api.reset_session_pool()
+
+
+@contextmanager
+def run_fake_aq_server(**kwargs) -> Iterator[FakeAqServer]:
+    """
+    Runs a fake Aquilon server on a background thread for the duration
+    of the block, taking the same arguments as FakeAqServer
+    """
+    server = FakeAqServer(**kwargs)
+    thread = threading.Thread(
+        target=server.serve_forever,
+        # Polling more often than the default keeps shutdown quick in tests
+        kwargs={"poll_interval": 0.05},
+        name="fake-aq-server",
+        daemon=True,
+    )
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def _parse_route_latency(value: str) -> Tuple[str, float]:
+    """
+    Parses a route=milliseconds latency override from the command line
+    """
+    route, _, millis = value.partition("=")
+    return route, float(millis) / 1e3
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """
+    Parses the command line and serves the fake until interrupted
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument(
+        "--route-latency",
+        type=_parse_route_latency,
+        action="append",
+        default=[],
+        help="Latency for a single route, such as make=2000",
+    )
+    parser.add_argument(
+        "--no-auth", action="store_true", help="Accept requests without a token"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeAqServer(
+        (args.host, args.port),
+        latency_seconds=args.latency_ms / 1e3,
+        route_latencies=dict(args.route_latency),
+        require_auth=not args.no_auth,
+    )
+    logger.info("Serving fake Aquilon on %s", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
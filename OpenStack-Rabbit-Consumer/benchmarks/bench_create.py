@@ -0,0 +1,156 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file counts the requests sent to Aquilon and Nova for each VM create,
+with Aquilon faked and Nova faked at the connection, so server and image
+lookups are cached as they are in production. Each count is printed
+alongside the count from before the metadata write-back reused what
+creating the VM found. Run with:
+python -m benchmarks.bench_create --creates 100
+"""
+import argparse
+import logging
+import random
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+from unittest.mock import Mock
+
+from benchmarks import corpus
+from benchmarks.bench_decode import write_results
+from benchmarks.fakes import FakeAqApi, FakeNova, fake_backends
+from rabbit_consumer.message_consumer import (
+    SUPPORTED_MESSAGE_TYPES,
+    consume,
+    decode_message,
+)
+
+# Requests per create before the metadata write-back reused the server
+# record and machine name found whilst creating the VM, which were
+# fetched again from Nova and Aquilon. Measured with --creates 100 --seed 0
+BASELINE = {
+    "aq.add_machine_nics": 1.00,
+    "aq.aq_make": 1.00,
+    "aq.check_host_exists": 1.00,
+    "aq.create_host": 1.00,
+    "aq.create_machine": 1.00,
+    "aq.delete_host": 0.01,
+    "aq.search_machine_by_serial": 2.00,
+    "aq.set_interface_bootable": 1.00,
+    "nova.find_image": 0.01,
+    "nova.servers": 2.00,
+    "nova.set_server_metadata": 1.00,
+}
+
+
+@dataclass
+class RoundTripResult:
+    """
+    The mean number of each request sent to a backend per create,
+    along with the baseline it is compared against
+    """
+
+    creates: int
+    aq_requests: Dict[str, float]
+    nova_requests: Dict[str, float]
+    baseline: Dict[str, float] = field(default_factory=lambda: dict(BASELINE))
+
+    @property
+    def aq_total(self) -> float:
+        """
+        Returns the mean number of Aquilon requests per create
+        """
+        return sum(self.aq_requests.values())
+
+    @property
+    def nova_total(self) -> float:
+        """
+        Returns the mean number of Nova requests per create
+        """
+        return sum(self.nova_requests.values())
+
+    def _baseline_total(self, backend: str) -> float:
+        """
+        Returns the baseline number of requests per create to the backend
+        """
+        return sum(
+            count
+            for name, count in self.baseline.items()
+            if name.startswith(backend + ".")
+        )
+
+    def __str__(self) -> str:
+        counts = {f"aq.{k}": v for k, v in self.aq_requests.items()}
+        counts.update({f"nova.{k}": v for k, v in self.nova_requests.items()})
+        rows = [
+            (name, counts.get(name, 0.0)) for name in sorted(counts | self.baseline)
+        ]
+        rows.append(("aq total", self.aq_total))
+        rows.append(("nova total", self.nova_total))
+
+        baselines = dict(self.baseline)
+        baselines["aq total"] = self._baseline_total("aq")
+        baselines["nova total"] = self._baseline_total("nova")
+
+        lines = [f"{'request':<28} {'per create':>10} {'baseline':>10} {'change':>10}"]
+        for name, count in rows:
+            before = baselines.get(name, 0.0)
+            lines.append(
+                f"{name:<28} {count:>10.2f} {before:>10.2f} {count - before:>+10.2f}"
+            )
+        return "\n".join(lines)
+
+
+def count_round_trips(creates: int, seed: int = 0) -> RoundTripResult:
+    """
+    Handles the given number of create messages for new VMs,
+    counting the requests each backend receives
+    """
+    rng = random.Random(seed)
+    messages = [
+        decode_message(
+            Mock(
+                body=corpus.encode(
+                    corpus.make_notification(SUPPORTED_MESSAGE_TYPES["create"], rng=rng)
+                )
+            )
+        )
+        for _ in range(creates)
+    ]
+
+    aq_api, nova = FakeAqApi(), FakeNova()
+    with fake_backends(aq_api, nova=nova):
+        for message in messages:
+            consume(message)
+
+    return RoundTripResult(
+        creates=creates,
+        aq_requests={k: v / creates for k, v in aq_api.calls.items()},
+        nova_requests={k: v / creates for k, v in nova.calls.items()},
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> Dict:
+    """
+    Parses the command line, counts the requests and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--creates", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="Write results to a file")
+    args = parser.parse_args(argv)
+
+    # The consumer logs every message, which would drown out the results
+    logging.disable(logging.CRITICAL)
+    try:
+        result = count_round_trips(args.creates, seed=args.seed)
+    finally:
+        logging.disable(logging.NOTSET)
+
+    if args.json_path:
+        write_results(args.json_path, asdict(result))
+    print(result)
+    return asdict(result)
+
+
+if __name__ == "__main__":
+    main()
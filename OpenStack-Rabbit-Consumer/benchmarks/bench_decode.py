@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file benchmarks decoding and dispatching messages, with the Openstack
+and Aquilon layers replaced by in-process fakes. Run with:
+python -m benchmarks.bench_decode --messages 5000
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Union
+from unittest.mock import Mock
+
+from benchmarks import corpus
+from benchmarks.fakes import fake_backends
+from rabbit_consumer.message_consumer import (
+    SUPPORTED_MESSAGE_TYPES,
+    decode_message,
+    on_message,
+)
+from rabbit_consumer.rabbit_message import MessageEventType, RabbitMessage
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    The results of running a single benchmark over a corpus
+    """
+
+    name: str
+    messages: int
+    messages_per_sec: float
+    p50_us: float
+    p99_us: float
+    peak_alloc_kib: float
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name:<28} {self.messages:>8} {self.messages_per_sec:>12.0f} "
+            f"{self.p50_us:>10.1f} {self.p99_us:>10.1f} {self.peak_alloc_kib:>10.2f}"
+        )
+
+
+def percentile(sorted_samples: List[float], percent: float) -> float:
+    """
+    Returns the nearest-rank percentile from pre-sorted samples
+    """
+    index = max(0, int(round(percent / 100 * len(sorted_samples))) - 1)
+    return sorted_samples[index]
+
+
+def write_results(path: str, results: Union[Dict, List[Dict]]) -> None:
+    """
+    Writes serialised results to the given path as JSON
+    """
+    with open(path, "w", encoding="utf-8") as output:
+        json.dump(results, output, indent=2)
+
+
+def _measure_allocations(func: Callable, inputs: List, limit: int = 500) -> float:
+    """
+    Returns the mean peak memory allocated per call in KiB. This is
+    measured separately, as tracing allocations slows down every call
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        for item in inputs[:limit]:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func(item)
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return statistics.fmean(peaks) / 1024 if peaks else 0.0
+
+
+def run_benchmark(name: str, func: Callable, inputs: List) -> BenchmarkResult:
+    """
+    Times each call of func over the inputs, returning the throughput,
+    latency percentiles and allocations per message
+    """
+    samples = []
+    start = time.perf_counter()
+    for item in inputs:
+        call_start = time.perf_counter()
+        func(item)
+        samples.append(time.perf_counter() - call_start)
+    elapsed = time.perf_counter() - start
+
+    samples.sort()
+    return BenchmarkResult(
+        name=name,
+        messages=len(inputs),
+        messages_per_sec=len(inputs) / elapsed if elapsed else 0.0,
+        p50_us=percentile(samples, 50) * 1e6,
+        p99_us=percentile(samples, 99) * 1e6,
+        peak_alloc_kib=_measure_allocations(func, inputs),
+    )
+
+
+def _to_message(raw_body: bytes) -> Mock:
+    """
+    Wraps a raw body so it can be passed to the consumer as a rabbit message
+    """
+    message = Mock()
+    message.body = raw_body
+    return message
+
+
+def run_all(raw_bodies: List[bytes]) -> List[BenchmarkResult]:
+    """
+    Runs each of the benchmarks over the given corpus
+    """
+    inner_bodies = [json.loads(raw)["oslo.message"] for raw in raw_bodies]
+    supported = [
+        body
+        for body in inner_bodies
+        if MessageEventType.from_json(body).event_type
+        in SUPPORTED_MESSAGE_TYPES.values()
+    ]
+    messages = [_to_message(raw) for raw in raw_bodies]
+
+    results = [
+        run_benchmark(
+            "MessageEventType.from_json", MessageEventType.from_json, inner_bodies
+        ),
+        run_benchmark("RabbitMessage.from_json", RabbitMessage.from_json, supported),
+        run_benchmark("decode_message", decode_message, messages),
+    ]
+    with fake_backends():
+        results.append(run_benchmark("on_message", on_message, messages))
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> List[Dict]:
+    """
+    Parses the command line, runs the benchmarks and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--corpus", help="JSONL capture of raw message bodies")
+    parser.add_argument("--json", dest="json_path", help="Write results to a file")
+    args = parser.parse_args(argv)
+
+    # The consumer logs every message, which would dominate the timings
+    logging.disable(logging.CRITICAL)
+    if args.corpus:
+        raw_bodies = list(corpus.load(args.corpus))[: args.messages]
+    else:
+        raw_bodies = corpus.generate(args.messages, seed=args.seed)
+
+    try:
+        results = run_all(raw_bodies)
+    finally:
+        logging.disable(logging.NOTSET)
+    print(
+        f"{'benchmark':<28} {'messages':>8} {'msgs/sec':>12} "
+        f"{'p50 (us)':>10} {'p99 (us)':>10} {'KiB/msg':>10}"
+    )
+    for result in results:
+        print(result)
+
+    serialised = [asdict(result) for result in results]
+    if args.json_path:
+        write_results(args.json_path, serialised)
+    return serialised
+
+
+if __name__ == "__main__":
+    main()
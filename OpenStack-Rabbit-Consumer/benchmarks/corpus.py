@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file generates a corpus of realistic oslo notifications, modelled on
+those sent by Nova, for benchmarking the consumer offline
+"""
+import json
+import random
+import uuid
+from typing import Dict, Iterator, List, Optional
+
+# Approximate mix of event types seen on the nova notification exchange,
+# the large majority of which are ignored by the consumer
+EVENT_TYPE_WEIGHTS = {
+    "compute.instance.update": 40,
+    "compute.instance.exists": 20,
+    "compute.instance.create.start": 5,
+    "compute.instance.create.end": 5,
+    "compute.instance.delete.start": 5,
+    "compute.instance.delete.end": 5,
+    "compute.instance.shutdown.start": 3,
+    "compute.instance.shutdown.end": 3,
+    "compute.instance.power_off.start": 2,
+    "compute.instance.power_off.end": 2,
+    "compute.instance.power_on.start": 2,
+    "compute.instance.power_on.end": 2,
+    "compute.instance.reboot.start": 3,
+    "compute.instance.reboot.end": 3,
+}
+
+# Number of metadata entries, fixed IPs and service catalog endpoints used
+# to vary the size of the generated payloads
+PAYLOAD_SIZES = {
+    "small": (0, 1, 0),
+    "medium": (8, 2, 10),
+    "large": (40, 6, 60),
+}
+
+
+def _service_catalog(endpoints: int) -> List[Dict]:
+    return [
+        {
+            "type": f"service-{i}",
+            "name": f"service-{i}",
+            "endpoints": [
+                {
+                    "region": "RegionOne",
+                    "publicURL": f"https://openstack.example.com:{8000 + i}/v2.1",
+                    "internalURL": f"https://internal.example.com:{8000 + i}/v2.1",
+                    "adminURL": f"https://admin.example.com:{8000 + i}/v2.1",
+                }
+            ],
+        }
+        for i in range(endpoints)
+    ]
+
+
+def _fixed_ips(count: int, rng: random.Random) -> List[Dict]:
+    return [
+        {
+            "address": f"172.16.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+            "floating_ips": [],
+            "label": "Internal",
+            "meta": {},
+            "type": "fixed",
+            "version": 4,
+            "vif_mac": ":".join(f"{rng.randint(0, 255):02x}" for _ in range(6)),
+        }
+        for _ in range(count)
+    ]
+
+
+def make_notification(
+    event_type: str,
+    size: str = "medium",
+    instance_id: Optional[str] = None,
+    rng: Optional[random.Random] = None,
+) -> Dict:
+    """
+    Creates a single Nova legacy notification for the given event type
+    """
+    rng = rng or random.Random()
+    metadata_count, ip_count, catalog_count = PAYLOAD_SIZES[size]
+    instance_id = instance_id or str(uuid.UUID(int=rng.getrandbits(128)))
+    project_id = uuid.UUID(int=rng.getrandbits(128)).hex
+
+    metadata = {f"user_key_{i}": f"value-{i}" * 4 for i in range(metadata_count)}
+    return {
+        "message_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "publisher_id": "compute.hv-123.example.com",
+        "event_type": event_type,
+        "priority": "INFO",
+        "timestamp": "2023-05-01 12:00:00.000000",
+        "_unique_id": uuid.UUID(int=rng.getrandbits(128)).hex,
+        "_context_project_name": "benchmark-project",
+        "_context_project_id": project_id,
+        "_context_user_name": "benchmark-user",
+        "_context_user_id": uuid.UUID(int=rng.getrandbits(128)).hex,
+        "_context_roles": ["member", "reader"],
+        "_context_auth_token": "gAAAAA" + "x" * 180,
+        "_context_request_id": f"req-{uuid.UUID(int=rng.getrandbits(128))}",
+        "_context_service_catalog": _service_catalog(catalog_count),
+        "payload": {
+            "tenant_id": project_id,
+            "instance_id": instance_id,
+            "display_name": f"vm-{instance_id[:8]}",
+            "hostname": f"vm-{instance_id[:8]}",
+            "host": "hv-123.example.com",
+            "node": "hv-123.example.com",
+            "instance_type": "l3.small",
+            "memory_mb": rng.choice([2048, 4096, 8192]),
+            "vcpus": rng.choice([1, 2, 4, 8]),
+            "disk_gb": 100,
+            "root_gb": 100,
+            "ephemeral_gb": 0,
+            "state": "active",
+            "state_description": "",
+            "image_ref_url": "https://glance.example.com/images/"
+            + str(uuid.UUID(int=rng.getrandbits(128))),
+            "image_meta": {"AQ_OS": "rocky", "AQ_OSVERSION": "8x-x86_64"},
+            "metadata": metadata,
+            "fixed_ips": _fixed_ips(ip_count, rng),
+            "launched_at": "2023-05-01T11:59:00.000000",
+            "created_at": "2023-05-01 11:58:00+00:00",
+            "availability_zone": "ceph",
+        },
+    }
+
+
+def encode(notification: Dict) -> bytes:
+    """
+    Wraps a notification in the oslo.message envelope, as sent over the wire
+    """
+    envelope = {"oslo.version": "2.0", "oslo.message": json.dumps(notification)}
+    return json.dumps(envelope).encode("utf-8")
+
+
+def generate(count: int, seed: int = 0) -> List[bytes]:
+    """
+    Generates a corpus of encoded messages with a realistic mix of
+    event types and payload sizes
+    """
+    rng = random.Random(seed)
+    event_types = list(EVENT_TYPE_WEIGHTS)
+    weights = list(EVENT_TYPE_WEIGHTS.values())
+    sizes = list(PAYLOAD_SIZES)
+    return [
+        encode(
+            make_notification(
+                rng.choices(event_types, weights)[0], rng.choice(sizes), rng=rng
+            )
+        )
+        for _ in range(count)
+    ]
+
+
+def load(path: str) -> Iterator[bytes]:
+    """
+    Loads a captured corpus, where each line is a raw message body
+    """
+    with open(path, "rb") as capture:
+        for line in capture:
+            line = line.strip()
+            if line:
+                yield line
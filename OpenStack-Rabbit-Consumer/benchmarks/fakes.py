@@ -0,0 +1,410 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file provides in-process stand-ins for the aq_api and openstack_api
+modules, so the consumer can be exercised without any external services
+"""
+import contextlib
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional
+from unittest.mock import patch
+
+from rabbit_consumer import message_consumer, openstack_address
+from rabbit_consumer import openstack_api as real_openstack_api
+from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.image_details import ImageDetails
+from rabbit_consumer.openstack_address import OpenstackAddress
+from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.server_batcher import ServerBatcher
+from rabbit_consumer.ttl_cache import TtlLruCache
+from rabbit_consumer.vm_data import VmData
+
+AQ_IMAGE_METADATA = {
+    "AQ_ARCHETYPE": "cloud",
+    "AQ_DOMAIN": "prod_cloud",
+    "AQ_PERSONALITY": "nubesvms",
+    "AQ_OS": "rocky",
+    "AQ_OSVERSION": "8x-x86_64",
+}
+
+
+# pylint: disable=too-few-public-methods
+class FaultInjector:
+    """
+    Slows down and fails calls to a fake backend. Latency is exponentially
+    distributed around the given mean, giving a long tail like a real
+    service, and a fraction of calls raise a ConnectionError.
+    """
+
+    def __init__(
+        self, latency_seconds: float = 0, error_rate: float = 0, seed: int = 0
+    ) -> None:
+        if not 0 <= error_rate <= 1:
+            raise ValueError(f"Error rate must be between 0 and 1, got {error_rate}")
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self, name: str) -> None:
+        """
+        Waits for the injected latency, then raises if the call should fail
+        """
+        with self._lock:
+            delay = (
+                self._rng.expovariate(1 / self.latency_seconds)
+                if self.latency_seconds > 0
+                else 0
+            )
+            fail = self._rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise ConnectionError(f"Injected failure in {name}")
+
+
+class FakeOpenstackApi:
+    """
+    Stands in for rabbit_consumer.openstack_api, where every server exists
+    and was built from an Aquilon managed image
+    """
+
+    def __init__(self, faults: Optional[FaultInjector] = None) -> None:
+        self.calls: Counter = Counter()
+        self.metadata: Dict[str, Dict] = {}
+        self._faults = faults
+        self._lock = threading.Lock()
+
+    def _record(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+        if self._faults:
+            self._faults.apply(name)
+
+    @contextmanager
+    def server_cache(self) -> Iterator[None]:
+        """
+        Stands in for the per-message server cache
+        """
+        yield
+
+    def check_machine_exists(self, _: VmData) -> bool:
+        """
+        Every server exists
+        """
+        self._record("check_machine_exists")
+        return True
+
+    def get_server_details(self, vm_data: VmData) -> SimpleNamespace:
+        """
+        Every server is active
+        """
+        self._record("get_server_details")
+        return SimpleNamespace(id=vm_data.virtual_machine_id, status="ACTIVE")
+
+    def get_image(self, _: VmData) -> ImageDetails:
+        """
+        Every server uses an Aquilon image
+        """
+        self._record("get_image")
+        return ImageDetails(
+            name="rocky-8-aq",
+            metadata=AQ_IMAGE_METADATA,
+            is_aq_managed=True,
+            aq_metadata=AqMetadata.from_dict(AQ_IMAGE_METADATA),
+        )
+
+    def get_server_metadata(self, _: VmData) -> Dict[str, str]:
+        """
+        Servers have no metadata overrides
+        """
+        self._record("get_server_metadata")
+        return {}
+
+    # pylint: disable=unused-argument
+    def get_server_networks(
+        self, vm_data: VmData, resolve_hostnames: bool = True
+    ) -> List[OpenstackAddress]:
+        """
+        Servers have a single internal address, whose hostname is
+        known whether or not it is asked for
+        """
+        self._record("get_server_networks")
+        return [
+            OpenstackAddress(
+                version=4,
+                addr="172.16.0.10",
+                mac_addr="fa:16:3e:00:00:01",
+                hostname=f"host-{vm_data.virtual_machine_id[:8]}.example.com",
+            )
+        ]
+
+    def update_metadata(
+        self, vm_data: VmData, metadata: Dict, server: Optional[SimpleNamespace] = None
+    ) -> None:
+        """
+        Records the metadata written back to the server
+        """
+        self._record("update_metadata")
+        self.metadata[vm_data.virtual_machine_id] = metadata
+
+
+class FakeNova:
+    """
+    Stands in for an openstacksdk connection, so the real openstack_api
+    module runs with its caching, whilst counting each request sent to
+    Nova. Every server exists on an internal network with an Aquilon image.
+    """
+
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self.metadata: Dict[str, Dict] = {}
+        self.compute = self
+        self._lock = threading.Lock()
+
+    def _record(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    @contextmanager
+    def connection(self) -> Iterator["FakeNova"]:
+        """
+        Stands in for OpenstackConnection
+        """
+        yield self
+
+    def servers(self, uuid: str, **_) -> List[SimpleNamespace]:
+        """
+        Lists the server with the given ID
+        """
+        self._record("servers")
+        address = {
+            "version": 4,
+            # Each server has its own address, so its host is only created once
+            "addr": f"172.16.{int(uuid[:2], 16)}.{int(uuid[2:4], 16)}",
+            "OS-EXT-IPS-MAC:mac_addr": "fa:16:3e:00:00:01",
+        }
+        return [
+            SimpleNamespace(
+                id=uuid,
+                name=f"vm-{uuid[:8]}",
+                status="ACTIVE",
+                metadata={},
+                image=SimpleNamespace(id="image-id"),
+                addresses={"Internal": [address]},
+            )
+        ]
+
+    def find_image(self, _: str) -> SimpleNamespace:
+        """
+        Finds the Aquilon image every server uses
+        """
+        self._record("find_image")
+        return SimpleNamespace(name="rocky-8-aq", metadata=AQ_IMAGE_METADATA)
+
+    def set_server_metadata(self, server: SimpleNamespace, **metadata) -> None:
+        """
+        Records the metadata written back to the server
+        """
+        self._record("set_server_metadata")
+        self.metadata[server.id] = metadata
+
+
+class FakeResolver:
+    """
+    Stands in for the DNS resolver, where every name resolves
+    """
+
+    @staticmethod
+    def forward(_: str) -> str:
+        """
+        Every hostname resolves to the same address
+        """
+        return "172.16.0.10"
+
+    @staticmethod
+    def reverse(ip_addr: str) -> str:
+        """
+        Every address has a hostname
+        """
+        return f"host-{ip_addr.replace('.', '-')}.example.com"
+
+    def reverse_many(self, ip_addrs: List[str]) -> List[str]:
+        """
+        Every address has a hostname
+        """
+        return [self.reverse(ip_addr) for ip_addr in ip_addrs]
+
+
+@dataclass
+class FakeAqApi:
+    """
+    Stands in for rabbit_consumer.aq_api, keeping just enough state to
+    follow the create and delete flows
+    """
+
+    calls: Counter = field(default_factory=Counter)
+    machines: Dict[str, str] = field(default_factory=dict)
+    hosts: Dict[str, str] = field(default_factory=dict)
+    faults: Optional[FaultInjector] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def _record(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+        if self.faults:
+            self.faults.apply(name)
+
+    def create_machine(self, _: RabbitMessage, vm_data: VmData) -> str:
+        """
+        Allocates the next machine name for the serial
+        """
+        self._record("create_machine")
+        name = f"vm-openstack-{len(self.machines)}"
+        self.machines[vm_data.virtual_machine_id] = name
+        return name
+
+    def add_machine_nics(self, *_) -> None:
+        """
+        Adds NICs to a machine
+        """
+        self._record("add_machine_nics")
+
+    def set_interface_bootable(self, *_) -> None:
+        """
+        Sets a machine's interface as bootable
+        """
+        self._record("set_interface_bootable")
+
+    def create_host(
+        self, _: AqMetadata, addresses: List[OpenstackAddress], machine_name: str
+    ) -> None:
+        """
+        Creates a host on the machine
+        """
+        self._record("create_host")
+        self.hosts[addresses[0].hostname] = machine_name
+
+    def aq_make(self, *_) -> None:
+        """
+        Compiles templates for a host
+        """
+        self._record("aq_make")
+
+    def check_host_exists(self, hostname: str) -> bool:
+        """
+        Checks if a host exists
+        """
+        self._record("check_host_exists")
+        return hostname in self.hosts
+
+    def search_machine_by_serial(self, vm_data: VmData) -> Optional[str]:
+        """
+        Finds a machine by its serial
+        """
+        self._record("search_machine_by_serial")
+        return self.machines.get(vm_data.virtual_machine_id)
+
+    def search_host_by_machine(self, machine_name: str) -> Optional[str]:
+        """
+        Finds the host on a machine
+        """
+        self._record("search_host_by_machine")
+        return next((h for h, m in self.hosts.items() if m == machine_name), None)
+
+    def get_machine_details(self, machine_name: str) -> str:
+        """
+        Describes a machine
+        """
+        self._record("get_machine_details")
+        return f"Machine: {machine_name}\n  Interface: eth0"
+
+    def delete_host(self, hostname: str) -> None:
+        """
+        Deletes a host
+        """
+        self._record("delete_host")
+        self.hosts.pop(hostname, None)
+
+    def delete_address(self, *_) -> None:
+        """
+        Deletes an address from a machine
+        """
+        self._record("delete_address")
+
+    def delete_interface(self, *_) -> None:
+        """
+        Deletes an interface from a machine
+        """
+        self._record("delete_interface")
+
+    def delete_machine(self, machine_name: str) -> None:
+        """
+        Deletes a machine
+        """
+        self._record("delete_machine")
+        for serial, name in list(self.machines.items()):
+            if name == machine_name:
+                del self.machines[serial]
+
+
+@contextmanager
+def fake_backends(
+    aq_api: Optional[FakeAqApi] = None,
+    openstack_api: Optional[FakeOpenstackApi] = None,
+    nova: Optional[FakeNova] = None,
+) -> Iterator[None]:
+    """
+    Replaces the Aquilon and Openstack layers used by the message
+    consumer for the duration of the block. Given a FakeNova, the
+    real Openstack layer is kept and only its connection replaced.
+    """
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(
+            patch.object(message_consumer, "aq_api", aq_api or FakeAqApi())
+        )
+        if nova:
+            stack.enter_context(_fake_nova_connection(nova))
+        else:
+            stack.enter_context(
+                patch.object(
+                    message_consumer,
+                    "openstack_api",
+                    openstack_api or FakeOpenstackApi(),
+                )
+            )
+        # Avoid resolving the fake hostnames against real DNS
+        for module in (message_consumer, openstack_address):
+            stack.enter_context(
+                patch.object(module, "get_resolver", return_value=FakeResolver())
+            )
+        yield
+
+
+@contextmanager
+def _fake_nova_connection(nova: FakeNova) -> Iterator[None]:
+    """
+    Connects the Openstack layer to the fake, with its own image cache
+    and a batcher looking up each server individually
+    """
+    # pylint: disable=protected-access
+    batcher = ServerBatcher(
+        real_openstack_api._fetch_server,
+        real_openstack_api._fetch_servers,
+        window_seconds=0,
+        max_batch=1,
+    )
+    with (
+        patch.object(real_openstack_api, "OpenstackConnection", nova.connection),
+        patch.object(
+            real_openstack_api, "get_image_cache", return_value=TtlLruCache(16, 300)
+        ),
+        patch.object(real_openstack_api, "get_server_batcher", return_value=batcher),
+    ):
+        yield
@@ -0,0 +1,255 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file replays a capture of rabbit messages through the consumer at a
+fixed rate, or as fast as possible, against fake Openstack and Aquilon
+backends with injected latency and errors. It reports the throughput and
+end to end latency, for sizing the worker count. Run with:
+python -m benchmarks.replay --corpus capture.jsonl --rate 50 --workers 4
+"""
+import argparse
+import logging
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from benchmarks import corpus
+from benchmarks.bench_decode import percentile, write_results
+from benchmarks.fakes import FakeAqApi, FakeOpenstackApi, FaultInjector, fake_backends
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.message_consumer import (
+    SUPPORTED_MESSAGE_TYPES,
+    consume,
+    dispatch_message,
+    on_message,
+)
+from rabbit_consumer.worker_pool import MessageWorkerPool
+
+
+@dataclass
+class ReplayResult:  # pylint: disable=too-many-instance-attributes
+    """
+    The throughput and latency of a single replay, where latency runs
+    from when a message was due to arrive until it was acked
+    """
+
+    messages: int
+    failed: int
+    workers: int
+    offered_rate: float
+    elapsed_seconds: float
+    messages_per_sec: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    aq_calls: int
+    openstack_calls: int
+
+    def __str__(self) -> str:
+        offered = f"{self.offered_rate:.1f}/s" if self.offered_rate else "unlimited"
+        return (
+            f"messages: {self.messages} ({self.failed} failed), "
+            f"workers: {self.workers}, offered: {offered}\n"
+            f"throughput: {self.messages_per_sec:.1f} msgs/sec "
+            f"over {self.elapsed_seconds:.2f}s\n"
+            f"latency (ms): p50 {self.p50_ms:.1f}, p95 {self.p95_ms:.1f}, "
+            f"p99 {self.p99_ms:.1f}, max {self.max_ms:.1f}\n"
+            f"backend calls: aq {self.aq_calls}, openstack {self.openstack_calls}"
+        )
+
+
+# pylint: disable=too-few-public-methods
+class _ReplayMessage:
+    """
+    Stands in for a rabbit message, recording when it is acked
+    """
+
+    def __init__(self, body: bytes, due: float) -> None:
+        self.body = body
+        self.properties: Dict = {}
+        self.due = due
+        self.finished: Optional[float] = None
+
+    # pylint: disable=unused-argument
+    def ack(self, all_previous: bool = False) -> None:
+        """
+        Records the message as finished
+        """
+        self.finished = time.perf_counter()
+
+
+class _CountingRouter:
+    """
+    Stands in for the retry router, counting failed messages
+    instead of republishing them
+    """
+
+    def __init__(self) -> None:
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    # pylint: disable=unused-argument
+    def route(self, message, error, event_type, retry=True) -> str:
+        """
+        Counts the failed message, which the pool then acks
+        """
+        with self._lock:
+            self.failed += 1
+        return "replay.failed"
+
+
+def _wait_until(due: float) -> None:
+    """
+    Sleeps until the given perf_counter time
+    """
+    remaining = due - time.perf_counter()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def _replay_inline(messages: List[_ReplayMessage]) -> int:
+    """
+    Feeds each message through on_message on this thread,
+    returning the number which failed
+    """
+    failed = 0
+    for message in messages:
+        _wait_until(message.due)
+        try:
+            on_message(message)
+        except Exception:  # pylint: disable=broad-exception-caught
+            message.finished = time.perf_counter()
+            failed += 1
+    return failed
+
+
+def _replay_pooled(
+    messages: List[_ReplayMessage], workers: int, coalesce_seconds: float
+) -> int:
+    """
+    Feeds each message through a worker pool as the consumer does,
+    returning the number which failed
+    """
+    router = _CountingRouter()
+    coalescer = CreateDeleteCoalescer(
+        coalesce_seconds,
+        create_event_type=SUPPORTED_MESSAGE_TYPES["create"],
+        delete_event_type=SUPPORTED_MESSAGE_TYPES["delete"],
+    )
+    with MessageWorkerPool(workers, consume, coalescer, router) as pool:
+        for message in messages:
+            _wait_until(message.due)
+            dispatch_message(pool, message)
+    return router.failed
+
+
+def replay(  # pylint: disable=too-many-arguments
+    raw_bodies: List[bytes],
+    *,
+    rate: float = 0,
+    workers: int = 0,
+    coalesce_seconds: float = 0,
+    aq_api: Optional[FakeAqApi] = None,
+    openstack_api: Optional[FakeOpenstackApi] = None,
+) -> ReplayResult:
+    """
+    Replays the raw bodies at the given rate in messages per second, or
+    as fast as possible if 0. With 0 workers each message goes through
+    on_message in turn, otherwise through a worker pool of that size.
+    """
+    aq_api = aq_api or FakeAqApi()
+    openstack_api = openstack_api or FakeOpenstackApi()
+
+    start = time.perf_counter()
+    interval = 1 / rate if rate else 0
+    messages = [
+        _ReplayMessage(body, start + i * interval) for i, body in enumerate(raw_bodies)
+    ]
+    with fake_backends(aq_api, openstack_api):
+        if workers:
+            failed = _replay_pooled(messages, workers, coalesce_seconds)
+        else:
+            failed = _replay_inline(messages)
+    end = time.perf_counter()
+
+    # Every message has been acked or has failed by now
+    latencies = sorted((m.finished or end) - m.due for m in messages)
+    elapsed = end - start
+    return ReplayResult(
+        messages=len(messages),
+        failed=failed,
+        workers=workers,
+        offered_rate=rate,
+        elapsed_seconds=elapsed,
+        messages_per_sec=len(messages) / elapsed if elapsed else 0.0,
+        p50_ms=percentile(latencies, 50) * 1e3 if latencies else 0.0,
+        p95_ms=percentile(latencies, 95) * 1e3 if latencies else 0.0,
+        p99_ms=percentile(latencies, 99) * 1e3 if latencies else 0.0,
+        max_ms=latencies[-1] * 1e3 if latencies else 0.0,
+        aq_calls=sum(aq_api.calls.values()),
+        openstack_calls=sum(openstack_api.calls.values()),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> Dict:
+    """
+    Parses the command line, runs the replay and prints the results
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", help="JSONL capture of raw message bodies")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="Messages per second, 0 is unlimited"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=0, help="Worker pool size, 0 uses on_message"
+    )
+    parser.add_argument("--coalesce-seconds", type=float, default=0)
+    parser.add_argument("--aq-latency-ms", type=float, default=0)
+    parser.add_argument("--aq-error-rate", type=float, default=0)
+    parser.add_argument("--openstack-latency-ms", type=float, default=0)
+    parser.add_argument("--openstack-error-rate", type=float, default=0)
+    parser.add_argument("--json", dest="json_path", help="Write results to a file")
+    args = parser.parse_args(argv)
+
+    if args.corpus:
+        raw_bodies = list(corpus.load(args.corpus))[: args.messages]
+    else:
+        raw_bodies = corpus.generate(args.messages, seed=args.seed)
+
+    aq_api = FakeAqApi(
+        faults=FaultInjector(
+            args.aq_latency_ms / 1e3, args.aq_error_rate, seed=args.seed
+        )
+    )
+    openstack_api = FakeOpenstackApi(
+        faults=FaultInjector(
+            args.openstack_latency_ms / 1e3, args.openstack_error_rate, seed=args.seed
+        )
+    )
+
+    # The consumer logs every message and failure, which would dominate the timings
+    logging.disable(logging.CRITICAL)
+    try:
+        result = replay(
+            raw_bodies,
+            rate=args.rate,
+            workers=args.workers,
+            coalesce_seconds=args.coalesce_seconds,
+            aq_api=aq_api,
+            openstack_api=openstack_api,
+        )
+    finally:
+        logging.disable(logging.NOTSET)
+    print(result)
+
+    if args.json_path:
+        write_results(args.json_path, asdict(result))
+    return asdict(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,6 +22,11 @@ def _prep_logging():
 if __name__ == "__main__":
     _prep_logging()
 
+    from rabbit_consumer.consumer_config import load_config
     from rabbit_consumer.message_consumer import initiate_consumer
+    from rabbit_consumer.metrics import start_metrics_server
 
+    # Fail fast on a bad config, rather than part way through a message
+    config = load_config()
+    start_metrics_server(config.consumer_metrics_port)
     initiate_consumer()
@@ -0,0 +1,90 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file batches the acks of messages which need no handling, so the
+busy nova notification stream does not cost a frame per message
+"""
+import logging
+from typing import List, Set, Tuple
+
+import rabbitpy
+
+logger = logging.getLogger(__name__)
+
+# A message to ack, and whether the ack covers every earlier delivery
+Ack = Tuple[rabbitpy.Message, bool]
+
+
+class AckBatcher:
+    """
+    Holds the messages ignored on a single channel until batch_size have
+    built up, then acks them with one ack of the latest delivery tag,
+    which RabbitMQ applies to every earlier delivery too. As that would
+    also ack messages still being handled, the delivery tags handed on
+    are tracked until they are acked, much like publisher confirms. A
+    batched ack only covers messages delivered before the oldest of
+    these, and any held messages it cannot cover are acked one at a time
+    once batch_size are still held. Callers serialise access, and send
+    the acks returned.
+    """
+
+    def __init__(self, batch_size: int):
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be at least 1, got {batch_size}")
+        self._batch_size = batch_size
+        self._handed_on: Set[int] = set()
+        # Held in the order they were delivered
+        self._held: List[rabbitpy.Message] = []
+
+    def handed_on(self, message: rabbitpy.Message) -> None:
+        """
+        Records a message being handled, which a batch must not cover
+        until it has been acked
+        """
+        self._handed_on.add(message.delivery_tag)
+
+    def settled(self, message: rabbitpy.Message) -> None:
+        """
+        Records a message handed on being acked by itself
+        """
+        self._handed_on.discard(message.delivery_tag)
+
+    def ignore(self, message: rabbitpy.Message) -> List[Ack]:
+        """
+        Holds a message which needs no handling, returning the acks to
+        send once a full batch is held
+        """
+        self._held.append(message)
+        if len(self._held) < self._batch_size:
+            return []
+
+        acks = self._covered()
+        if len(self._held) >= self._batch_size:
+            logger.debug("Acking %s messages held behind others", len(self._held))
+            acks += self.flush()
+        return acks
+
+    def flush(self) -> List[Ack]:
+        """
+        Returns the acks for every held message, batching those which can be
+        """
+        acks = self._covered()
+        acks += [(message, False) for message in self._held]
+        self._held = []
+        return acks
+
+    def _covered(self) -> List[Ack]:
+        """
+        Returns a single ack for the held messages delivered before any
+        still being handled, and stops holding them
+        """
+        oldest = min(self._handed_on, default=None)
+        covered = [
+            message
+            for message in self._held
+            if oldest is None or message.delivery_tag < oldest
+        ]
+        if not covered:
+            return []
+        self._held = self._held[len(covered) :]
+        return [(covered[-1], True)]
@@ -5,16 +5,23 @@ This file defines methods to be used to interact with the
 Aquilon API
 """
 import logging
+import os
 import subprocess
-from typing import Optional, List
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, List, Tuple
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests_kerberos import HTTPKerberosAuth
 from urllib3.util.retry import Retry
 
-from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer import metrics
+from rabbit_consumer.backend_limiter import AQ, get_limiter
+from rabbit_consumer.consumer_config import ConsumerConfig, get_config
 from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.kerberos_ticket import KerberosTicketCache, get_ccache_path
 from rabbit_consumer.openstack_address import OpenstackAddress
 from rabbit_consumer.rabbit_message import RabbitMessage
 from rabbit_consumer.vm_data import VmData
@@ -26,6 +33,8 @@ UPDATE_INTERFACE_SUFFIX = "/machine/{0}/interface/{1}?boot&default_route"
 DELETE_HOST_SUFFIX = "/host/{0}"
 DELETE_MACHINE_SUFFIX = "/machine/{0}"
 
+AQ_CERT_CHAIN = "/etc/grid-security/certificates/aquilon-gridpp-rl-ac-uk-chain.pem"
+
 logger = logging.getLogger(__name__)
 
 
@@ -49,33 +58,198 @@ def verify_kerberos_ticket() -> bool:
     return True
 
 
+class AqSessionPool:
+    """
+    A thread-safe pool of keep-alive sessions to Aquilon. Each session holds
+    its own persistent HTTPS connection and Kerberos auth context, so repeated
+    requests skip the TLS handshake and initial SPNEGO negotiation.
+    At most `size` sessions are in use at once, further callers block.
+    """
+
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError(f"Pool size must be at least 1, got {size}")
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle: List[requests.Session] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """
+        Creates a new session with retries and Kerberos auth
+        """
+        logger.debug("Creating new Aquilon session")
+        session = requests.Session()
+        session.verify = AQ_CERT_CHAIN
+        retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[503])
+        session.mount("https://", HTTPAdapter(max_retries=retries))
+        # Sending the token up-front saves a 401 round trip on every request
+        session.auth = HTTPKerberosAuth(force_preemptive=True)
+        return session
+
+    @contextmanager
+    def session(self) -> Iterator[requests.Session]:
+        """
+        Borrows a session from the pool for the duration of the block.
+        Sessions which raise a connection level error are discarded.
+        """
+        # pylint: disable=consider-using-with
+        self._slots.acquire()
+        with self._lock:
+            session = self._idle.pop() if self._idle else None
+
+        try:
+            if session is None:
+                session = self._create_session()
+            yield session
+        except requests.RequestException:
+            session.close()
+            session = None
+            raise
+        finally:
+            self._return(session)
+
+    def _return(self, session: Optional[requests.Session]) -> None:
+        """
+        Returns a session to the idle list and frees its slot,
+        discarded sessions are passed as None
+        """
+        if session is not None:
+            with self._lock:
+                self._idle.append(session)
+        self._slots.release()
+
+    def close(self) -> None:
+        """
+        Closes all idle sessions
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for session in idle:
+            session.close()
+
+
+_session_pool: Optional[AqSessionPool] = None  # pylint: disable=invalid-name
+_session_pool_lock = threading.Lock()
+
+
+def get_session_pool() -> AqSessionPool:
+    """
+    Returns the process wide Aquilon session pool, creating it on first use
+    """
+    global _session_pool  # pylint: disable=global-statement
+    with _session_pool_lock:
+        if _session_pool is None:
+            _session_pool = AqSessionPool(get_config().aq_pool_size)
+        return _session_pool
+
+
+def reset_session_pool() -> None:
+    """
+    Closes and discards the session pool, so it is rebuilt on next use
+    """
+    global _session_pool  # pylint: disable=global-statement
+    with _session_pool_lock:
+        pool, _session_pool = _session_pool, None
+    if pool:
+        pool.close()
+
+
+def _get_timeout(config: ConsumerConfig) -> Tuple[Optional[float], Optional[float]]:
+    """
+    Returns the (connect, read) timeout for requests, where 0 disables a timeout
+    """
+    return config.aq_connect_timeout or None, config.aq_read_timeout or None
+
+
+_ticket_cache: Optional[KerberosTicketCache] = None  # pylint: disable=invalid-name
+_ticket_cache_lock = threading.Lock()
+
+
+def get_ticket_cache() -> KerberosTicketCache:
+    """
+    Returns the process wide Kerberos ticket cache, creating it on first use
+    """
+    global _ticket_cache  # pylint: disable=global-statement
+    ticket_cache = _ticket_cache
+    if ticket_cache is None:
+        with _ticket_cache_lock:
+            if _ticket_cache is None:
+                _ticket_cache = KerberosTicketCache(
+                    get_ccache_path(os.getenv("KRB5CCNAME"))
+                )
+            ticket_cache = _ticket_cache
+    return ticket_cache
+
+
+def reset_ticket_cache() -> None:
+    """
+    Discards the Kerberos ticket cache, so it is rebuilt on next use
+    """
+    global _ticket_cache  # pylint: disable=global-statement
+    with _ticket_cache_lock:
+        _ticket_cache = None
+
+
 def setup_requests(
     url: str, method: str, desc: str, params: Optional[dict] = None
 ) -> str:
     """
     Passes a request to the Aquilon API
     """
-    verify_kerberos_ticket()
+    get_ticket_cache().ensure_valid()
     logger.debug("%s: %s - params: %s", method, url, params)
 
-    session = requests.Session()
-    session.verify = "/etc/grid-security/certificates/aquilon-gridpp-rl-ac-uk-chain.pem"
-    retries = Retry(total=5, backoff_factor=0.1, status_forcelist=[503])
-    session.mount("https://", HTTPAdapter(max_retries=retries))
-    if method == "post":
-        response = session.post(url, auth=HTTPKerberosAuth(), params=params)
-    elif method == "put":
-        response = session.put(url, auth=HTTPKerberosAuth(), params=params)
-    elif method == "delete":
-        response = session.delete(url, auth=HTTPKerberosAuth(), params=params)
-    else:
-        response = session.get(url, auth=HTTPKerberosAuth(), params=params)
+    config = get_config()
+    # Errors Aquilon reports deliberately say nothing about its health
+    with get_limiter(AQ).request(ignore=(AquilonError,)):
+        response = _send_request(config, url, method, desc, params)
+        _check_response(response, url, desc)
 
+    logger.debug("Success: %s ", desc)
+    logger.debug("AQ Response: %s", response.text)
+    return response.text
+
+
+def _send_request(
+    config: ConsumerConfig,
+    url: str,
+    method: str,
+    desc: str,
+    params: Optional[dict],
+) -> requests.Response:
+    """
+    Sends a request on a pooled session, recording how long it took
+    """
+    timeout = _get_timeout(config)
+    start = time.perf_counter()
+    with get_session_pool().session() as session:
+        if method == "post":
+            response = session.post(url, params=params, timeout=timeout)
+        elif method == "put":
+            response = session.put(url, params=params, timeout=timeout)
+        elif method == "delete":
+            response = session.delete(url, params=params, timeout=timeout)
+        else:
+            response = session.get(url, params=params, timeout=timeout)
+    _log_latency(config, desc, time.perf_counter() - start)
+    return response
+
+
+def _check_response(response: requests.Response, url: str, desc: str) -> None:
+    """
+    Raises an AquilonError for requests Aquilon rejected,
+    or a ConnectionError if the request otherwise failed
+    """
     if response.status_code == 400:
         # This might be an expected error, so don't log it
         logger.debug("AQ Error Response: %s", response.text)
         raise AquilonError(response.text)
 
+    if response.status_code == 401:
+        # Our ticket may have been revoked or replaced, so check it next time
+        get_ticket_cache().invalidate()
+
     if response.status_code != 200:
         logger.error("%s: Failed: %s", desc, response.text)
         logger.error(url)
@@ -83,9 +257,16 @@ def setup_requests(
             f"Failed {desc}: {response.status_code} -" "{response.text}"
         )
 
-    logger.debug("Success: %s ", desc)
-    logger.debug("AQ Response: %s", response.text)
-    return response.text
+
+def _log_latency(config: ConsumerConfig, desc: str, elapsed: float) -> None:
+    """
+    Logs how long an Aquilon request took, warning if it was slow
+    """
+    metrics.AQ_REQUEST_LATENCY.labels(desc).observe(elapsed)
+    if config.aq_slow_request_seconds and elapsed >= config.aq_slow_request_seconds:
+        logger.warning("Slow AQ request: %s took %.3fs", desc, elapsed)
+    else:
+        logger.debug("%s took %.3fs", desc, elapsed)
 
 
 def aq_make(addresses: List[OpenstackAddress]) -> None:
@@ -101,7 +282,7 @@ def aq_make(addresses: List[OpenstackAddress]) -> None:
     if not hostname or not hostname.strip():
         raise ValueError("Hostname cannot be empty")
 
-    url = ConsumerConfig().aq_url + f"/host/{hostname}/command/make"
+    url = get_config().aq_url + f"/host/{hostname}/command/make"
     setup_requests(url, "post", "Make Template")
 
 
@@ -122,7 +303,7 @@ def aq_manage(addresses: List[OpenstackAddress], image_meta: AqMetadata) -> None
     else:
         params["domain"] = image_meta.aq_domain
 
-    url = ConsumerConfig().aq_url + f"/host/{hostname}/command/manage"
+    url = get_config().aq_url + f"/host/{hostname}/command/manage"
     setup_requests(url, "post", "Manage Host", params=params)
 
 
@@ -140,7 +321,8 @@ def create_machine(message: RabbitMessage, vm_data: VmData) -> str:
         "memory": message.payload.memory_mb,
     }
 
-    url = ConsumerConfig().aq_url + f"/next_machine/{ConsumerConfig().aq_prefix}"
+    config = get_config()
+    url = config.aq_url + f"/next_machine/{config.aq_prefix}"
     response = setup_requests(url, "put", "Create Machine", params=params)
     return response
 
@@ -151,7 +333,7 @@ def delete_machine(machine_name: str) -> None:
     """
     logger.debug("Attempting to delete machine for %s", machine_name)
 
-    url = ConsumerConfig().aq_url + DELETE_MACHINE_SUFFIX.format(machine_name)
+    url = get_config().aq_url + DELETE_MACHINE_SUFFIX.format(machine_name)
 
     setup_requests(url, "delete", "Delete Machine")
 
@@ -162,7 +344,7 @@ def create_host(
     """
     Creates a host in Aquilon
     """
-    config = ConsumerConfig()
+    config = get_config()
 
     address = addresses[0]
     params = {
@@ -189,7 +371,7 @@ def delete_host(hostname: str) -> None:
     Deletes a host in Aquilon
     """
     logger.debug("Attempting to delete host for %s ", hostname)
-    url = ConsumerConfig().aq_url + DELETE_HOST_SUFFIX.format(hostname)
+    url = get_config().aq_url + DELETE_HOST_SUFFIX.format(hostname)
     setup_requests(url, "delete", "Host Delete")
 
 
@@ -198,7 +380,7 @@ def delete_address(address: str, machine_name: str) -> None:
     Deletes an address in Aquilon
     """
     logger.debug("Attempting to delete address for %s ", address)
-    url = ConsumerConfig().aq_url + "/interface_address"
+    url = get_config().aq_url + "/interface_address"
     params = {"ip": address, "machine": machine_name, "interface": "eth0"}
     setup_requests(url, "delete", "Address Delete", params=params)
 
@@ -208,7 +390,7 @@ def delete_interface(machine_name: str) -> None:
     Deletes a host interface in Aquilon
     """
     logger.debug("Attempting to delete interface for %s ", machine_name)
-    url = ConsumerConfig().aq_url + "/interface/command/del"
+    url = get_config().aq_url + "/interface/command/del"
     params = {"interface": "eth0", "machine": machine_name}
     setup_requests(url, "post", "Interface Delete", params=params)
 
@@ -228,9 +410,7 @@ def add_machine_nics(machine_name: str, addresses: List[OpenstackAddress]) -> No
         interface_name,
         machine_name,
     )
-    url = (
-        ConsumerConfig().aq_url + f"/machine/{machine_name}/interface/{interface_name}"
-    )
+    url = get_config().aq_url + f"/machine/{machine_name}/interface/{interface_name}"
     setup_requests(
         url, "put", "Add Machine Interface", params={"mac": address.mac_addr}
     )
@@ -242,7 +422,7 @@ def set_interface_bootable(machine_name: str, interface_name: str) -> None:
     """
     logger.debug("Attempting to bootable %s ", machine_name)
 
-    url = ConsumerConfig().aq_url + UPDATE_INTERFACE_SUFFIX.format(
+    url = get_config().aq_url + UPDATE_INTERFACE_SUFFIX.format(
         machine_name, interface_name
     )
 
@@ -254,7 +434,7 @@ def search_machine_by_serial(vm_data: VmData) -> Optional[str]:
     Searches for a machine in Aquilon based on a serial number
     """
     logger.debug("Searching for host with serial %s", vm_data.virtual_machine_id)
-    url = ConsumerConfig().aq_url + "/find/machine"
+    url = get_config().aq_url + "/find/machine"
     params = {"serial": vm_data.virtual_machine_id}
     response = setup_requests(url, "get", "Search Host", params=params).strip()
 
@@ -268,7 +448,7 @@ def search_host_by_machine(machine_name: str) -> Optional[str]:
     Searches for a host in Aquilon based on a machine name
     """
     logger.debug("Searching for host with machine name %s", machine_name)
-    url = ConsumerConfig().aq_url + "/find/host"
+    url = get_config().aq_url + "/find/host"
     params = {"machine": machine_name}
     response = setup_requests(url, "get", "Search Host", params=params).strip()
 
@@ -282,7 +462,7 @@ def get_machine_details(machine_name: str) -> str:
     Gets a machine's details as a string
     """
     logger.debug("Getting machine details for %s", machine_name)
-    url = ConsumerConfig().aq_url + f"/machine/{machine_name}"
+    url = get_config().aq_url + f"/machine/{machine_name}"
     return setup_requests(url, "get", "Get machine details").strip()
 
 
@@ -291,7 +471,7 @@ def check_host_exists(hostname: str) -> bool:
     Checks if a host exists in Aquilon
     """
     logger.debug("Checking if hostname exists: %s", hostname)
-    url = ConsumerConfig().aq_url + HOST_CHECK_SUFFIX.format(hostname)
+    url = get_config().aq_url + HOST_CHECK_SUFFIX.format(hostname)
     try:
         setup_requests(url, "get", "Check Host")
     except AquilonError as err:
@@ -0,0 +1,379 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file consumes rabbit messages with asyncio, so a single process
+can keep hundreds of VM provisioning flows in flight whilst reusing
+the handlers, retries and ordering of the threaded consumer
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Set
+
+try:
+    import aio_pika
+except ImportError:  # pragma: no cover
+    aio_pika = None
+
+from rabbit_consumer import metrics
+from rabbit_consumer.aq_api import verify_kerberos_ticket
+from rabbit_consumer.backend_limiter import (
+    backends_open,
+    run_when_available,
+    wait_for_backends,
+)
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.consumer_config import ConsumerConfig, get_config
+from rabbit_consumer.idempotency_store import idempotency_store
+from rabbit_consumer.make_queue import deferred_makes
+from rabbit_consumer.message_consumer import (
+    SUPPORTED_MESSAGE_TYPES,
+    consume,
+    consumed_exchanges,
+    decode_message,
+)
+from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.retry_queue import RetryRouter
+from rabbit_consumer.worker_pool import record_failure
+
+logger = logging.getLogger(__name__)
+
+# Properties of a received message kept when it is republished for a retry
+_COPIED_PROPERTIES = (
+    "content_type",
+    "content_encoding",
+    "correlation_id",
+    "message_id",
+    "timestamp",
+    "type",
+    "app_id",
+)
+
+
+# pylint: disable=too-few-public-methods
+class AsyncMessage:
+    """
+    Presents a message received by aio-pika with the body and properties
+    of a rabbitpy message, so it can be decoded, coalesced and retried by
+    the same code as the threaded consumer
+    """
+
+    def __init__(self, message: "aio_pika.abc.AbstractIncomingMessage"):
+        self._message = message
+        self.body: bytes = message.body
+        self.properties: Dict[str, Any] = {"headers": dict(message.headers or {})}
+        for name in _COPIED_PROPERTIES:
+            value = getattr(message, name)
+            if value is not None:
+                self.properties[name] = value
+
+    async def ack(self) -> None:
+        """
+        Acks the underlying message
+        """
+        await self._message.ack()
+
+
+class AsyncRetryPublisher:
+    """
+    Moves failed messages onto the queues of a RetryRouter, publishing
+    with aio-pika rather than on the router's channel
+    """
+
+    def __init__(
+        self, channel: "aio_pika.abc.AbstractChannel", retry_router: RetryRouter
+    ):
+        self._channel = channel
+        self._retry_router = retry_router
+
+    async def declare(self) -> None:
+        """
+        Declares the retry and dead-letter queues, matching RetryRouter.declare
+        """
+        for name, arguments in self._retry_router.retry_queue_arguments().items():
+            logger.debug("Declaring retry queue: %s", name)
+            await self._channel.declare_queue(name, durable=True, arguments=arguments)
+
+        dead_letter_queue = self._retry_router.dead_letter_queue
+        logger.debug("Declaring dead-letter queue: %s", dead_letter_queue)
+        await self._channel.declare_queue(dead_letter_queue, durable=True)
+
+    async def publish(
+        self,
+        message: AsyncMessage,
+        error: Exception,
+        event_type: str,
+        retry: bool = True,
+    ) -> str:
+        """
+        Republishes the failed message onto its next retry queue, or the
+        dead-letter queue, returning the name of the queue used once
+        RabbitMQ has confirmed it, as aio-pika channels use publisher
+        confirms by default. The original message must still be acked
+        by the caller.
+        """
+        destination, properties = self._retry_router.prepare(
+            message, error, event_type, retry
+        )
+        await self._channel.default_exchange.publish(
+            aio_pika.Message(message.body, **properties), routing_key=destination
+        )
+        return destination
+
+
+class AsyncMessageDispatcher:  # pylint: disable=too-many-instance-attributes
+    """
+    Handles decoded messages as asyncio tasks, running at most `concurrency`
+    handlers at once on a thread pool, as the Aquilon and Openstack clients
+    block. Each message for a VM waits for the one before it, so all events
+    for a given VM are handled in the order they were received. Acks,
+    coalescing and retries behave as in MessageWorkerPool.
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        handler: Callable[[RabbitMessage], None],
+        coalescer: Optional[CreateDeleteCoalescer] = None,
+        retry_publisher: Optional[AsyncRetryPublisher] = None,
+    ) -> None:
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1, got {concurrency}")
+
+        self._handler = handler
+        self._coalescer = coalescer
+        self._retry_publisher = retry_publisher
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="async-consumer"
+        )
+        # The latest task for each VM, which the next message for it waits on
+        self._tails: Dict[str, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._error: Optional[Exception] = None
+
+    async def __aenter__(self) -> "AsyncMessageDispatcher":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.join()
+        self._executor.shutdown()
+
+    async def dispatch(self, message: AsyncMessage) -> None:
+        """
+        Decodes the message then starts handling it, acking messages we do
+        not handle and dead-lettering those which cannot be decoded. Raises
+        the first handler error which could not be retried, so the consumer
+        stops and the un-acked message is redelivered.
+        """
+        if self._error:
+            raise self._error
+
+        # Waits whilst a backend is down, so messages stay on the queue. The
+        # check is cheap, so only an open circuit leaves the event loop
+        if backends_open():
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_backends)
+        try:
+            decoded = decode_message(message)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            # Retrying cannot help a message we cannot read
+            logger.exception("Failed to decode message")
+            await self.reject(message, err, metrics.UNKNOWN_EVENT_TYPE, retry=False)
+            return
+
+        if not decoded:
+            await message.ack()
+            return
+
+        if self._coalescer:
+            cancelled = self._coalescer.submitted(message, decoded)
+            if cancelled:
+                await cancelled.ack()
+
+        instance_id = decoded.payload.instance_id
+        metrics.MESSAGES_IN_FLIGHT.inc()
+        task = asyncio.create_task(
+            self._handle_after(self._tails.get(instance_id), message, decoded)
+        )
+        self._tails[instance_id] = task
+        self._tasks.add(task)
+        task.add_done_callback(partial(self._finished, instance_id))
+
+    async def join(self) -> None:
+        """
+        Waits for every message dispatched so far to be handled
+        """
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    async def reject(
+        self,
+        message: AsyncMessage,
+        error: Exception,
+        event_type: str,
+        retry: bool = True,
+    ) -> None:
+        """
+        Moves a failed message onto the retry queues then acks it. Raises
+        the error if there is no publisher, or the message could not be
+        moved, leaving the message un-acked to be redelivered.
+        """
+        if not self._retry_publisher:
+            raise error
+
+        await self._retry_publisher.publish(message, error, event_type, retry=retry)
+        await message.ack()
+
+    def _finished(self, instance_id: str, task: asyncio.Task) -> None:
+        """
+        Forgets a completed task, unless another message for the VM follows it
+        """
+        self._tasks.discard(task)
+        if self._tails.get(instance_id) is task:
+            del self._tails[instance_id]
+
+    async def _handle_after(
+        self,
+        previous: Optional[asyncio.Task],
+        message: AsyncMessage,
+        decoded: RabbitMessage,
+    ) -> None:
+        """
+        Handles the message once the previous message for its VM is done
+        """
+        try:
+            if previous:
+                await asyncio.wait({previous})
+            async with self._semaphore:
+                await self._handle(message, decoded)
+        finally:
+            metrics.MESSAGES_IN_FLIGHT.dec()
+
+    async def _handle(self, message: AsyncMessage, decoded: RabbitMessage) -> None:
+        """
+        Handles then acks a single message, retrying it if it fails or
+        otherwise recording the first error
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            handled = await loop.run_in_executor(
+                self._executor, self._run_handler, message, decoded
+            )
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            await self._failed(message, decoded, err)
+            return
+
+        if not handled:
+            # Already acked when it was cancelled
+            metrics.MESSAGES_IGNORED.labels(decoded.event_type).inc()
+            return
+
+        await message.ack()
+        metrics.MESSAGES_ACKED.labels(decoded.event_type).inc()
+
+    async def _failed(
+        self, message: AsyncMessage, decoded: RabbitMessage, error: Exception
+    ) -> None:
+        """
+        Moves a failed message onto the retry queues, or keeps its error
+        to stop the consumer if it cannot be moved
+        """
+        record_failure(decoded, error)
+        try:
+            await self.reject(message, error, decoded.event_type)
+        except Exception as reject_err:  # pylint: disable=broad-exception-caught
+            if reject_err is not error:
+                logger.exception("Failed to move message onto a retry queue")
+            self._error = self._error or error
+
+    def _run_handler(self, message: AsyncMessage, decoded: RabbitMessage) -> bool:
+        """
+        Runs on the thread pool, as both waiting out the coalescing period
+        and the handler block. Returns False if the message was cancelled.
+        """
+        if self._coalescer and not self._coalescer.claim(message, decoded):
+            return False
+        run_when_available(self._handler, decoded)
+        return True
+
+
+async def _declare_retry_publisher(
+    channel: "aio_pika.abc.AbstractChannel", config: ConsumerConfig
+) -> Optional[AsyncRetryPublisher]:
+    """
+    Declares the queues failed messages are moved onto, returning
+    None if failures should stop the consumer instead
+    """
+    if config.consumer_retry_attempts < 1:
+        return None
+
+    retry_router = RetryRouter(
+        None,
+        queue_name="ral.info",
+        max_attempts=config.consumer_retry_attempts,
+        retry_seconds=config.consumer_retry_seconds,
+    )
+    retry_publisher = AsyncRetryPublisher(channel, retry_router)
+    await retry_publisher.declare()
+    return retry_publisher
+
+
+async def consume_async(config: ConsumerConfig) -> None:
+    """
+    Connects to rabbit and consumes ral.info until the connection closes
+    or a message fails which cannot be retried
+    """
+    login_str = (
+        f"amqp://{config.rabbit_username}:{config.rabbit_password}"
+        f"@{config.rabbit_host}:{config.rabbit_port}/"
+    )
+    connection = await aio_pika.connect(login_str)
+    async with connection:
+        channel = await connection.channel()
+        logger.debug("Connected to RabbitMQ")
+        # Un-acked messages include those waiting behind another for their VM
+        await channel.set_qos(
+            prefetch_count=config.consumer_prefetch_count
+            or config.consumer_async_concurrency
+        )
+
+        # Durable indicates that the queue will survive a broker restart
+        queue = await channel.declare_queue("ral.info", durable=True)
+        for exchange in consumed_exchanges(config):
+            logger.debug("Binding to exchange: %s", exchange)
+            await queue.bind(exchange, routing_key="ral.info")
+
+        retry_publisher = await _declare_retry_publisher(channel, config)
+        coalescer = CreateDeleteCoalescer(
+            config.consumer_coalesce_seconds,
+            create_event_type=SUPPORTED_MESSAGE_TYPES["create"],
+            delete_event_type=SUPPORTED_MESSAGE_TYPES["delete"],
+        )
+        # The dispatcher stops first, so makes it queued are still run and
+        # can record their progress before the store is closed
+        with idempotency_store(config), deferred_makes(config):
+            async with AsyncMessageDispatcher(
+                config.consumer_async_concurrency, consume, coalescer, retry_publisher
+            ) as dispatcher:
+                logger.debug("Starting to consume messages")
+                async with queue.iterator() as messages:
+                    async for message in messages:
+                        await dispatcher.dispatch(AsyncMessage(message))
+
+
+def initiate_async_consumer() -> None:
+    """
+    Initiates the asyncio message consumer and runs it until it stops
+    """
+    if aio_pika is None:
+        raise RuntimeError("aio-pika must be installed to consume with asyncio")
+
+    logger.debug("Initiating asyncio message consumer")
+    # Ensure we have valid creds before trying to contact rabbit
+    verify_kerberos_ticket()
+
+    config = get_config()
+    if config.consumer_shards:
+        raise ValueError("CONSUMER_SHARDS is not supported by the asyncio consumer")
+    asyncio.run(consume_async(config))
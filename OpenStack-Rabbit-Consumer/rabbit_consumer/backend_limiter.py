@@ -0,0 +1,331 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file limits how hard the consumer pushes Aquilon and Openstack,
+backing off as they slow down or fail and stopping altogether
+whilst they are down, so a struggling backend can recover
+"""
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Tuple, Type
+
+from rabbit_consumer import metrics
+from rabbit_consumer.consumer_config import get_config
+
+logger = logging.getLogger(__name__)
+
+# Backends with their own limiter
+AQ = "aq"
+OPENSTACK = "openstack"
+
+# Circuit breaker states, as exported in metrics
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+# The limit is multiplied by this after a failed or slow request
+_DECREASE_FACTOR = 0.5
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of sending a request whilst the backend's circuit is open
+    """
+
+
+class BackendLimiter:  # pylint: disable=too-many-instance-attributes
+    """
+    Limits the number of concurrent requests to a backend. The limit grows
+    by one for each limit's worth of fast, successful requests and halves
+    after a failed or slow one (AIMD), staying between min_limit and
+    max_limit. Only requests started since the last decrease can decrease
+    it again, so a burst of failures halves it once.
+
+    Once error_rate of the last `window` requests have failed the circuit
+    opens, failing requests immediately for open_seconds. A single probe
+    request is then let through, closing the circuit if it succeeds or
+    opening it again if not. An error rate of 0 never opens the circuit,
+    and 0 slow_seconds ignores latency.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        name: str,
+        *,
+        min_limit: int,
+        max_limit: int,
+        slow_seconds: float,
+        error_rate: float,
+        window: int,
+        open_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if not 1 <= min_limit <= max_limit:
+            raise ValueError(
+                f"Limits must satisfy 1 <= min <= max, got {min_limit} and {max_limit}"
+            )
+        self.name = name
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._slow_seconds = slow_seconds
+        self._error_rate = error_rate
+        self._open_seconds = open_seconds
+        self._clock = clock
+
+        self._cond = threading.Condition()
+        self._limit = float(max_limit)
+        self._in_flight = 0
+        self._last_decrease = float("-inf")
+        self._outcomes: Deque[bool] = collections.deque(maxlen=window)
+        self._state = CLOSED
+        self._open_until = 0.0
+        self._probing = False
+        self._export()
+
+    @property
+    def limit(self) -> int:
+        """
+        The number of requests currently allowed at once
+        """
+        return int(self._limit)
+
+    @property
+    def state(self) -> int:
+        """
+        The circuit breaker state, one of CLOSED, HALF_OPEN or OPEN
+        """
+        with self._cond:
+            self._check_open_expired()
+            return self._state
+
+    def acquire(self) -> float:
+        """
+        Waits for a free slot, returning the time the request started to
+        pass to release. Raises a CircuitOpenError if the circuit is open.
+        """
+        with self._cond:
+            while True:
+                self._check_open_expired()
+                if self._state == OPEN:
+                    metrics.BACKEND_REQUESTS_REJECTED.labels(self.name).inc()
+                    raise CircuitOpenError(f"Circuit open for {self.name}")
+                if self._state == CLOSED and self._in_flight < self.limit:
+                    break
+                # Only the probe runs whilst half open, once earlier requests finish
+                if self._state == HALF_OPEN and not self._probing:
+                    if not self._in_flight:
+                        self._probing = True
+                        break
+                self._cond.wait(self._remaining_open())
+
+            self._in_flight += 1
+            self._export()
+            return self._clock()
+
+    def release(self, started: float, failed: bool) -> None:
+        """
+        Frees the slot taken by acquire, adjusting the limit and
+        circuit from how the request went
+        """
+        now = self._clock()
+        slow = bool(self._slow_seconds) and now - started >= self._slow_seconds
+        with self._cond:
+            self._in_flight -= 1
+            if self._probing:
+                self._probing = False
+                self._finish_probe(failed)
+            elif failed or slow:
+                self._decrease(started, now)
+            else:
+                self._limit = min(self._limit + 1 / self._limit, self._max_limit)
+
+            if self._state == CLOSED:
+                self._outcomes.append(failed)
+                self._check_error_rate(now)
+            self._export()
+            self._cond.notify_all()
+
+    @contextmanager
+    def request(self, ignore: Tuple[Type[Exception], ...] = ()) -> Iterator[None]:
+        """
+        Holds a slot for the duration of the block. Errors raised by the
+        block count as failures, apart from those of the ignored types,
+        which the backend raised deliberately.
+        """
+        started = self.acquire()
+        failed = True
+        try:
+            yield
+            failed = False
+        except ignore:
+            failed = False
+            raise
+        finally:
+            self.release(started, failed)
+
+    def wait_until_available(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until the circuit is no longer open, returning False
+        if it is still open after the timeout
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._cond:
+            while True:
+                self._check_open_expired()
+                if self._state != OPEN:
+                    return True
+                wait = self._remaining_open()
+                if deadline is not None:
+                    wait = min(wait, deadline - self._clock())
+                    if wait <= 0:
+                        return False
+                self._cond.wait(wait)
+
+    def _remaining_open(self) -> Optional[float]:
+        """
+        Returns how long until an open circuit lets a probe through,
+        or None to wait until notified
+        """
+        if self._state != OPEN:
+            return None
+        return max(self._open_until - self._clock(), 0)
+
+    def _check_open_expired(self) -> None:
+        """
+        Moves an open circuit to half open once it has been open long enough
+        """
+        if self._state == OPEN and self._clock() >= self._open_until:
+            logger.info("Probing %s after its circuit was open", self.name)
+            self._state = HALF_OPEN
+            self._export()
+
+    def _decrease(self, started: float, now: float) -> None:
+        """
+        Halves the limit, unless the request started before the last decrease
+        """
+        if started < self._last_decrease:
+            return
+        self._limit = max(self._limit * _DECREASE_FACTOR, self._min_limit)
+        self._last_decrease = now
+        logger.warning("Reduced %s concurrency to %s", self.name, self.limit)
+
+    def _finish_probe(self, failed: bool) -> None:
+        """
+        Closes the circuit after a successful probe, or re-opens it
+        """
+        if failed:
+            self._open(self._clock())
+            return
+        logger.info("Closing circuit for %s, which has recovered", self.name)
+        self._state = CLOSED
+        self._outcomes.clear()
+
+    def _check_error_rate(self, now: float) -> None:
+        """
+        Opens the circuit if too many of the recent requests failed
+        """
+        if not self._error_rate or len(self._outcomes) < self._outcomes.maxlen:
+            return
+        if sum(self._outcomes) / len(self._outcomes) >= self._error_rate:
+            self._open(now)
+
+    def _open(self, now: float) -> None:
+        """
+        Opens the circuit, starting again from the minimum limit once it closes
+        """
+        logger.error(
+            "Opening circuit for %s for %.0fs after repeated failures",
+            self.name,
+            self._open_seconds,
+        )
+        self._state = OPEN
+        self._open_until = now + self._open_seconds
+        self._limit = float(self._min_limit)
+        self._outcomes.clear()
+        metrics.BACKEND_CIRCUIT_OPENED.labels(self.name).inc()
+
+    def _export(self) -> None:
+        """
+        Publishes the current state as metrics
+        """
+        metrics.BACKEND_CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+        metrics.BACKEND_REQUESTS_IN_FLIGHT.labels(self.name).set(self._in_flight)
+        metrics.BACKEND_CIRCUIT_STATE.labels(self.name).set(self._state)
+
+
+_limiters: Dict[str, BackendLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(backend: str) -> BackendLimiter:
+    """
+    Returns the process wide limiter for the backend, creating it on first use
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(backend)
+        if limiter is None:
+            config = get_config()
+            slow_seconds = (
+                config.aq_slow_request_seconds
+                if backend == AQ
+                else config.openstack_slow_request_seconds
+            )
+            limiter = BackendLimiter(
+                backend,
+                min_limit=config.backend_min_concurrency,
+                max_limit=config.backend_max_concurrency,
+                slow_seconds=slow_seconds,
+                error_rate=config.backend_error_rate,
+                window=config.backend_error_window,
+                open_seconds=config.backend_open_seconds,
+            )
+            _limiters[backend] = limiter
+        return limiter
+
+
+def reset_limiters() -> None:
+    """
+    Discards every limiter, so they are rebuilt from the current config
+    """
+    with _limiters_lock:
+        _limiters.clear()
+
+
+def backends_open() -> bool:
+    """
+    Returns whether any backend's circuit is open, without waiting
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return any(limiter.state == OPEN for limiter in limiters)
+
+
+def wait_for_backends() -> None:
+    """
+    Waits until no backend's circuit is open, so messages are held
+    rather than failed whilst a backend recovers
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    for limiter in limiters:
+        if limiter.state == OPEN:
+            logger.warning("Holding messages until %s recovers", limiter.name)
+            limiter.wait_until_available()
+
+
+def run_when_available(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Runs the function once no backend's circuit is open, running it again
+    if a circuit opened part way through, so the message it is handling is
+    held rather than failed
+    """
+    while True:
+        wait_for_backends()
+        try:
+            return func(*args)
+        except CircuitOpenError as err:
+            logger.warning("Holding message until backends recover: %s", err)
@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file holds create messages briefly before they are handled, so
+a VM which is deleted straight away is never provisioned in Aquilon
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
+
+import rabbitpy
+
+from rabbit_consumer.rabbit_message import RabbitMessage
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _PendingCreate:
+    """
+    A create message which has been received but not yet started
+    """
+
+    message: rabbitpy.Message
+    release_at: float
+    cancelled: threading.Event = field(default_factory=threading.Event)
+
+
+class CreateDeleteCoalescer:
+    """
+    Tracks create messages per instance ID from when they are received
+    until a worker starts them. Creates are held for at least hold_seconds,
+    and a delete arriving in the meantime cancels the create.
+    """
+
+    def __init__(
+        self,
+        hold_seconds: float,
+        create_event_type: str,
+        delete_event_type: str,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._hold_seconds = hold_seconds
+        self._create_event_type = create_event_type
+        self._delete_event_type = delete_event_type
+        self._clock = clock
+        self._pending: Dict[str, _PendingCreate] = {}
+        self._lock = threading.Lock()
+        self._cancelled_count = 0
+
+    @property
+    def cancelled_count(self) -> int:
+        """
+        The number of creates cancelled by a following delete or create
+        """
+        return self._cancelled_count
+
+    def submitted(
+        self, message: rabbitpy.Message, decoded: RabbitMessage
+    ) -> Optional[rabbitpy.Message]:
+        """
+        Records a message as it is queued. Returns the create message
+        cancelled by this one, which the caller is responsible for acking.
+        """
+        instance_id = decoded.payload.instance_id
+        if decoded.event_type not in (self._create_event_type, self._delete_event_type):
+            return None
+
+        with self._lock:
+            pending = self._pending.pop(instance_id, None)
+            if decoded.event_type == self._create_event_type:
+                # A redelivered create replaces the one already waiting
+                self._pending[instance_id] = _PendingCreate(
+                    message, self._clock() + self._hold_seconds
+                )
+            if not pending:
+                return None
+            pending.cancelled.set()
+            self._cancelled_count += 1
+
+        logger.info("Cancelling pending create for %s", instance_id)
+        return pending.message
+
+    def claim(self, message: rabbitpy.Message, decoded: RabbitMessage) -> bool:
+        """
+        Called by a worker before handling a message. Waits until a create
+        has been held long enough, returning False if it was cancelled.
+        """
+        instance_id = decoded.payload.instance_id
+        with self._lock:
+            pending = self._pending.get(instance_id)
+        if not pending or pending.message is not message:
+            # Either not a create, or it has already been cancelled
+            return decoded.event_type != self._create_event_type
+
+        remaining = pending.release_at - self._clock()
+        if remaining > 0:
+            pending.cancelled.wait(remaining)
+
+        with self._lock:
+            if pending.cancelled.is_set():
+                return False
+            del self._pending[instance_id]
+        return True
@@ -5,13 +5,48 @@ This file allows us to set environment variables so that
 credentials are not exposed
 """
 
+import logging
 import os
+import threading
 from dataclasses import dataclass, field
 from functools import partial
+from typing import List, Optional
 
+logger = logging.getLogger(__name__)
 
-@dataclass
-class _AqFields:
+# Placeholder used by the Dockerfile for values which must be provided
+_NOT_SET = "NOT_SET"
+
+# Config values which must be provided, mapped to their environment variable
+_REQUIRED_FIELDS = {
+    "aq_prefix": "AQ_PREFIX",
+    "aq_url": "AQ_URL",
+    "openstack_auth_url": "OPENSTACK_AUTH_URL",
+    "openstack_username": "OPENSTACK_USERNAME",
+    "openstack_password": "OPENSTACK_PASSWORD",
+    "rabbit_host": "RABBIT_HOST",
+    "rabbit_port": "RABBIT_PORT",
+    "rabbit_username": "RABBIT_USERNAME",
+    "rabbit_password": "RABBIT_PASSWORD",
+}
+
+
+def _getenv_int(name: str, default: int) -> int:
+    """
+    Gets an environment variable as an integer, using the default if unset
+    """
+    return int(os.getenv(name, str(default)))
+
+
+def _getenv_float(name: str, default: float) -> float:
+    """
+    Gets an environment variable as a float, using the default if unset
+    """
+    return float(os.getenv(name, str(default)))
+
+
+@dataclass(frozen=True)
+class _AqFields:  # pylint: disable=too-many-instance-attributes
     """
     Dataclass for all Aquilon config elements. These are pulled from
     environment variables.
@@ -20,9 +55,39 @@ class _AqFields:
     aq_prefix: str = field(default_factory=partial(os.getenv, "AQ_PREFIX"))
     aq_url: str = field(default_factory=partial(os.getenv, "AQ_URL"))
 
+    aq_pool_size: int = field(default_factory=partial(_getenv_int, "AQ_POOL_SIZE", 10))
+    # Timeouts are in seconds, where 0 disables the timeout
+    aq_connect_timeout: float = field(
+        default_factory=partial(_getenv_float, "AQ_CONNECT_TIMEOUT", 10)
+    )
+    aq_read_timeout: float = field(
+        default_factory=partial(_getenv_float, "AQ_READ_TIMEOUT", 0)
+    )
+    # Requests taking longer than this are logged as warnings, 0 disables
+    aq_slow_request_seconds: float = field(
+        default_factory=partial(_getenv_float, "AQ_SLOW_REQUEST_SECONDS", 30)
+    )
+
+    # Template compiles run on their own workers, where 0 runs them inline.
+    # Creates are then acked before their make, so failed makes are not retried
+    aq_make_workers: int = field(
+        default_factory=partial(_getenv_int, "AQ_MAKE_WORKERS", 0)
+    )
+    # Seconds to wait before compiling, merging repeated requests for a host
+    aq_make_debounce_seconds: float = field(
+        default_factory=partial(_getenv_float, "AQ_MAKE_DEBOUNCE_SECONDS", 5)
+    )
+    aq_make_attempts: int = field(
+        default_factory=partial(_getenv_int, "AQ_MAKE_ATTEMPTS", 3)
+    )
+    # Delay before the first retry, doubling for each attempt after
+    aq_make_retry_seconds: float = field(
+        default_factory=partial(_getenv_float, "AQ_MAKE_RETRY_SECONDS", 10)
+    )
+
 
-@dataclass
-class _OpenstackFields:
+@dataclass(frozen=True)
+class _OpenstackFields:  # pylint: disable=too-many-instance-attributes
     """
     Dataclass for all Openstack config elements. These are pulled from
     environment variables.
@@ -41,8 +106,31 @@ class _OpenstackFields:
         default_factory=partial(os.getenv, "OPENSTACK_PASSWORD")
     )
 
+    openstack_image_cache_size: int = field(
+        default_factory=partial(_getenv_int, "OPENSTACK_IMAGE_CACHE_SIZE", 256)
+    )
+    # Seconds to cache images for, where 0 disables the cache
+    openstack_image_cache_ttl: float = field(
+        default_factory=partial(_getenv_float, "OPENSTACK_IMAGE_CACHE_TTL", 900)
+    )
+    # Seconds to gather concurrent server lookups into one request, 0 disables
+    openstack_batch_seconds: float = field(
+        default_factory=partial(_getenv_float, "OPENSTACK_BATCH_SECONDS", 0)
+    )
+    openstack_batch_size: int = field(
+        default_factory=partial(_getenv_int, "OPENSTACK_BATCH_SIZE", 50)
+    )
+    # Batched lookups list servers changed within this many seconds
+    openstack_batch_lookback_seconds: float = field(
+        default_factory=partial(_getenv_float, "OPENSTACK_BATCH_LOOKBACK_SECONDS", 600)
+    )
+    # Requests taking longer than this reduce the concurrency allowed, 0 disables
+    openstack_slow_request_seconds: float = field(
+        default_factory=partial(_getenv_float, "OPENSTACK_SLOW_REQUEST_SECONDS", 10)
+    )
+
 
-@dataclass
+@dataclass(frozen=True)
 class _RabbitFields:
     """
     Dataclass for all RabbitMQ config elements. These are pulled from
@@ -57,10 +145,307 @@ class _RabbitFields:
     rabbit_password: str = field(
         default_factory=partial(os.getenv, "RABBIT_PASSWORD", None)
     )
+    # Exchange carrying Glance notifications, used to refresh cached
+    # images as they are updated. Unset relies on the cache TTL alone
+    rabbit_image_exchange: str = field(
+        default_factory=partial(os.getenv, "RABBIT_IMAGE_EXCHANGE", "")
+    )
+
+
+@dataclass(frozen=True)
+class _ConsumerFields:  # pylint: disable=too-many-instance-attributes
+    """
+    Dataclass for all config elements which tune the consumer itself.
+    These are pulled from environment variables.
+    """
+
+    consumer_workers: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_WORKERS", 1)
+    )
+    # Messages queued ahead of each worker, beyond which the consumer
+    # waits and leaves the backlog on RabbitMQ
+    consumer_queue_size: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_QUEUE_SIZE", 10)
+    )
+    # Seconds to hold creates, so a VM deleted straight away is never
+    # provisioned. Creates still queued when their delete arrives are
+    # always cancelled, even when set to 0
+    consumer_coalesce_seconds: float = field(
+        default_factory=partial(_getenv_float, "CONSUMER_COALESCE_SECONDS", 2)
+    )
+    # Attempts at handling a message before it is dead-lettered, where 0
+    # stops the consumer on the first failure so the message is redelivered
+    consumer_retry_attempts: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_RETRY_ATTEMPTS", 5)
+    )
+    # Delay before the first retry, doubling for each attempt after
+    consumer_retry_seconds: float = field(
+        default_factory=partial(_getenv_float, "CONSUMER_RETRY_SECONDS", 30)
+    )
+    # SQLite database recording how far each message got, so redelivered
+    # messages are skipped or resumed. Empty disables it
+    consumer_state_path: str = field(
+        default_factory=partial(os.getenv, "CONSUMER_STATE_PATH", "")
+    )
+    consumer_state_retention_days: float = field(
+        default_factory=partial(_getenv_float, "CONSUMER_STATE_RETENTION_DAYS", 7)
+    )
+    # Shard queues VM messages are spread over by instance ID, which are
+    # divided between the replicas. 0 consumes ral.info directly, which
+    # keeps messages in order only with a single replica
+    consumer_shards: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_SHARDS", 0)
+    )
+    consumer_replicas: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_REPLICAS", 1)
+    )
+    # Index of this replica, where -1 takes it from the StatefulSet pod name
+    consumer_replica_index: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_REPLICA_INDEX", -1)
+    )
+    # Messages handled at once by async_entrypoint.py, which is also the
+    # number prefetched from RabbitMQ unless CONSUMER_PREFETCH_COUNT is set
+    consumer_async_concurrency: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_ASYNC_CONCURRENCY", 100)
+    )
+    # Un-acked messages RabbitMQ delivers to each channel, where 0 limits
+    # it to what the workers or pipeline can hold
+    consumer_prefetch_count: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_PREFETCH_COUNT", 0)
+    )
+    # Ignored messages acked together with a single ack, where 1 acks each
+    consumer_ack_batch_size: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_ACK_BATCH_SIZE", 1)
+    )
+    # Port serving Prometheus metrics on /metrics, where 0 disables them
+    consumer_metrics_port: int = field(
+        default_factory=partial(_getenv_int, "CONSUMER_METRICS_PORT", 9100)
+    )
+
+
+@dataclass(frozen=True)
+class _PipelineFields:
+    """
+    Dataclass for the stages messages are passed through, and the workers
+    running each. These are pulled from environment variables.
+    """
+
+    # Messages queued ahead of each stage worker, where 0 handles each
+    # message in one call on the CONSUMER_WORKERS pool instead
+    pipeline_queue_size: int = field(
+        default_factory=partial(_getenv_int, "PIPELINE_QUEUE_SIZE", 0)
+    )
+    pipeline_enrich_workers: int = field(
+        default_factory=partial(_getenv_int, "PIPELINE_ENRICH_WORKERS", 4)
+    )
+    pipeline_dns_workers: int = field(
+        default_factory=partial(_getenv_int, "PIPELINE_DNS_WORKERS", 2)
+    )
+    pipeline_provision_workers: int = field(
+        default_factory=partial(_getenv_int, "PIPELINE_PROVISION_WORKERS", 4)
+    )
+    pipeline_metadata_workers: int = field(
+        default_factory=partial(_getenv_int, "PIPELINE_METADATA_WORKERS", 2)
+    )
+
+
+@dataclass(frozen=True)
+class _DnsFields:
+    """
+    Dataclass for all DNS resolver config elements. These are pulled from
+    environment variables.
+    """
+
+    dns_cache_size: int = field(
+        default_factory=partial(_getenv_int, "DNS_CACHE_SIZE", 4096)
+    )
+    # Seconds to cache answers, and records which were not found, where 0 disables
+    dns_cache_ttl: float = field(
+        default_factory=partial(_getenv_float, "DNS_CACHE_TTL", 300)
+    )
+    dns_negative_ttl: float = field(
+        default_factory=partial(_getenv_float, "DNS_NEGATIVE_TTL", 30)
+    )
+    dns_lookup_workers: int = field(
+        default_factory=partial(_getenv_int, "DNS_LOOKUP_WORKERS", 4)
+    )
+    # Lookups taking longer than this are logged as warnings, 0 disables
+    dns_slow_lookup_seconds: float = field(
+        default_factory=partial(_getenv_float, "DNS_SLOW_LOOKUP_SECONDS", 1)
+    )
+
+
+@dataclass(frozen=True)
+class _BackendFields:
+    """
+    Dataclass for the limits applied to requests to Aquilon and Openstack.
+    These are pulled from environment variables.
+    """
+
+    # Concurrent requests allowed to each backend, which is reduced whilst
+    # requests are failing or slow then grows back as they recover
+    backend_min_concurrency: int = field(
+        default_factory=partial(_getenv_int, "BACKEND_MIN_CONCURRENCY", 1)
+    )
+    backend_max_concurrency: int = field(
+        default_factory=partial(_getenv_int, "BACKEND_MAX_CONCURRENCY", 10)
+    )
+    # Fraction of the last BACKEND_ERROR_WINDOW requests which must fail to
+    # stop using a backend for BACKEND_OPEN_SECONDS, where 0 never stops
+    backend_error_rate: float = field(
+        default_factory=partial(_getenv_float, "BACKEND_ERROR_RATE", 0.5)
+    )
+    backend_error_window: int = field(
+        default_factory=partial(_getenv_int, "BACKEND_ERROR_WINDOW", 20)
+    )
+    backend_open_seconds: float = field(
+        default_factory=partial(_getenv_float, "BACKEND_OPEN_SECONDS", 30)
+    )
+
+
+@dataclass(frozen=True)
+class ConsumerConfig(
+    _AqFields,
+    _OpenstackFields,
+    _RabbitFields,
+    _ConsumerFields,
+    _PipelineFields,
+    _DnsFields,
+    _BackendFields,
+):
+    """
+    Mix-in class for all known config elements. Instances are immutable
+    snapshots of the environment, use get_config() to fetch the current one.
+    """
+
+    def validate(self) -> "ConsumerConfig":
+        """
+        Checks all required values are set and numeric values are in range,
+        raising a ValueError describing every problem found
+        """
+        errors = [
+            f"{env_var} must be set"
+            for name, env_var in _REQUIRED_FIELDS.items()
+            if getattr(self, name) in (None, "", _NOT_SET)
+        ]
+        if self.consumer_retry_attempts < 0:
+            errors.append("CONSUMER_RETRY_ATTEMPTS cannot be negative")
+        for name in (
+            "consumer_workers",
+            "consumer_queue_size",
+            "consumer_async_concurrency",
+            "consumer_ack_batch_size",
+            "aq_pool_size",
+            "aq_make_attempts",
+            "openstack_image_cache_size",
+            "openstack_batch_size",
+            "dns_cache_size",
+            "dns_lookup_workers",
+            "pipeline_enrich_workers",
+            "pipeline_dns_workers",
+            "pipeline_provision_workers",
+            "pipeline_metadata_workers",
+        ):
+            if getattr(self, name) < 1:
+                errors.append(f"{name.upper()} must be at least 1")
+        errors += self._replica_errors()
+        errors += self._backend_errors()
+        if not 0 <= self.consumer_metrics_port <= 65535:
+            errors.append("CONSUMER_METRICS_PORT must be a valid port, or 0")
+        if self.aq_make_workers < 0:
+            errors.append("AQ_MAKE_WORKERS cannot be negative")
+        for name in (
+            "aq_connect_timeout",
+            "aq_read_timeout",
+            "dns_cache_ttl",
+            "dns_negative_ttl",
+            "consumer_coalesce_seconds",
+            "consumer_retry_seconds",
+            "consumer_state_retention_days",
+            "aq_make_debounce_seconds",
+            "aq_make_retry_seconds",
+            "openstack_image_cache_ttl",
+            "openstack_slow_request_seconds",
+            "openstack_batch_seconds",
+            "openstack_batch_lookback_seconds",
+            "backend_open_seconds",
+            "pipeline_queue_size",
+            "consumer_prefetch_count",
+        ):
+            if getattr(self, name) < 0:
+                errors.append(f"{name.upper()} cannot be negative")
+
+        if 0 < self.consumer_prefetch_count < self.consumer_ack_batch_size:
+            # RabbitMQ would stop delivering before a batch could fill
+            errors.append(
+                "CONSUMER_ACK_BATCH_SIZE cannot be more than CONSUMER_PREFETCH_COUNT"
+            )
+
+        if errors:
+            raise ValueError("Invalid consumer config: " + ", ".join(errors))
+        return self
+
+    def _replica_errors(self) -> List[str]:
+        """
+        Checks every replica can own at least one shard
+        """
+        errors = []
+        if self.consumer_shards < 0:
+            errors.append("CONSUMER_SHARDS cannot be negative")
+        if self.consumer_replicas < 1:
+            errors.append("CONSUMER_REPLICAS must be at least 1")
+        elif self.consumer_replicas > max(1, self.consumer_shards):
+            errors.append(
+                "CONSUMER_SHARDS must be at least CONSUMER_REPLICAS "
+                "to run more than one replica"
+            )
+        if self.consumer_replica_index >= self.consumer_replicas:
+            errors.append("CONSUMER_REPLICA_INDEX must be below CONSUMER_REPLICAS")
+        return errors
+
+    def _backend_errors(self) -> List[str]:
+        """
+        Checks the backend limits are consistent
+        """
+        errors = []
+        if not 1 <= self.backend_min_concurrency <= self.backend_max_concurrency:
+            errors.append(
+                "BACKEND_MIN_CONCURRENCY must be at least 1 "
+                "and no more than BACKEND_MAX_CONCURRENCY"
+            )
+        if not 0 <= self.backend_error_rate <= 1:
+            errors.append("BACKEND_ERROR_RATE must be between 0 and 1")
+        if self.backend_error_window < 1:
+            errors.append("BACKEND_ERROR_WINDOW must be at least 1")
+        return errors
+
+
+_config: Optional[ConsumerConfig] = None  # pylint: disable=invalid-name
+_config_lock = threading.Lock()
+
+
+def load_config() -> ConsumerConfig:
+    """
+    Reads and validates the config from the environment, replacing the
+    current snapshot. Raises a ValueError if the config is invalid.
+    The environment of a running process does not change, so this is
+    only called at startup, with config changes rolled out by restarting.
+    """
+    global _config  # pylint: disable=global-statement
+    config = ConsumerConfig().validate()
+    with _config_lock:
+        _config = config
+    return config
 
 
-@dataclass
-class ConsumerConfig(_AqFields, _OpenstackFields, _RabbitFields):
+def get_config() -> ConsumerConfig:
     """
-    Mix-in class for all known config elements
+    Returns the current config snapshot, loading it on first use
     """
+    config = _config
+    if config is None:
+        with _config_lock:
+            config = _config
+        if config is None:
+            config = load_config()
+    return config
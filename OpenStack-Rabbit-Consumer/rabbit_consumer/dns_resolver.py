@@ -0,0 +1,197 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file resolves hostnames and addresses, caching the answers
+so a slow resolver is not consulted for every message
+"""
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from rabbit_consumer import metrics
+from rabbit_consumer.consumer_config import get_config
+from rabbit_consumer.ttl_cache import CacheStats, TtlLruCache
+
+logger = logging.getLogger(__name__)
+
+# Errors which mean the record does not exist, rather than the lookup failing
+_NOT_FOUND_ERRORS = (socket.herror, socket.gaierror)
+
+
+@dataclass(frozen=True)
+class DnsStats:
+    """
+    A snapshot of the resolver's cache hit rate and lookup latency
+    """
+
+    cache: CacheStats
+    lookups: int
+    lookup_seconds_total: float
+    lookup_seconds_max: float
+
+    @property
+    def lookup_seconds_mean(self) -> float:
+        """
+        Returns the mean time spent on lookups which missed the cache
+        """
+        return self.lookup_seconds_total / self.lookups if self.lookups else 0.0
+
+
+class DnsResolver:  # pylint: disable=too-many-instance-attributes
+    """
+    Resolves forward and reverse lookups through a shared LRU cache.
+    Answers are cached for the positive TTL, and records which do not
+    exist for the negative TTL. Other failures, such as timeouts, are
+    not cached so they are retried on the next message.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        cache_size: int,
+        positive_ttl: float,
+        negative_ttl: float,
+        lookup_workers: int,
+        slow_lookup_seconds: float = 0,
+    ):
+        self._cache: TtlLruCache = TtlLruCache(cache_size, positive_ttl)
+        self._negative_ttl = negative_ttl
+        self._lookup_workers = lookup_workers
+        self._slow_lookup_seconds = slow_lookup_seconds
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._lookup_seconds_total = 0.0
+        self._lookup_seconds_max = 0.0
+
+    def reverse(self, ip_addr: str) -> str:
+        """
+        Returns the hostname for an ip address
+        """
+        try:
+            return self._resolve(
+                ("PTR", ip_addr), lambda: socket.gethostbyaddr(ip_addr)[0]
+            )
+        except socket.herror:
+            logger.info("No hostname found for ip %s", ip_addr)
+            raise
+        except Exception:
+            logger.error("Problem converting ip to hostname")
+            raise
+
+    def forward(self, hostname: str) -> str:
+        """
+        Returns the IPv4 address for a hostname
+        """
+        return self._resolve(("A", hostname), lambda: socket.gethostbyname(hostname))
+
+    def reverse_many(self, ip_addrs: List[str]) -> List[str]:
+        """
+        Returns the hostname for each ip address, in the same order.
+        Lookups are made concurrently when several addresses miss the cache.
+        """
+        if len(set(ip_addrs)) <= 1 or self._lookup_workers <= 1:
+            return [self.reverse(ip_addr) for ip_addr in ip_addrs]
+        return list(self._get_executor().map(self.reverse, ip_addrs))
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._lookup_workers, thread_name_prefix="dns-lookup"
+                )
+            return self._executor
+
+    def _resolve(self, key: Tuple[str, str], lookup: Callable[[], str]) -> str:
+        """
+        Returns the cached answer for the key, otherwise performs the lookup
+        and caches the result or a not found error
+        """
+        found, cached = self._cache.get(key)
+        metrics.cache_lookup("dns", found)
+        if found:
+            if isinstance(cached, Exception):
+                raise type(cached)(*cached.args)
+            return cached
+
+        start = time.perf_counter()
+        try:
+            answer = lookup()
+        except _NOT_FOUND_ERRORS as err:
+            self._cache.put(key, err, ttl=self._negative_ttl)
+            raise
+        finally:
+            self._record_latency(key, time.perf_counter() - start)
+        self._cache.put(key, answer)
+        return answer
+
+    def _record_latency(self, key: Tuple[str, str], elapsed: float) -> None:
+        metrics.STAGE_LATENCY.labels("dns_lookup").observe(elapsed)
+        with self._lock:
+            self._lookups += 1
+            self._lookup_seconds_total += elapsed
+            self._lookup_seconds_max = max(self._lookup_seconds_max, elapsed)
+
+        if self._slow_lookup_seconds and elapsed >= self._slow_lookup_seconds:
+            logger.warning("Slow DNS %s lookup for %s: %.3fs", *key, elapsed)
+        else:
+            logger.debug("DNS %s lookup for %s: %.3fs", *key, elapsed)
+
+    def stats(self) -> DnsStats:
+        """
+        Returns the cache hit rate and lookup latency so far
+        """
+        with self._lock:
+            return DnsStats(
+                cache=self._cache.stats(),
+                lookups=self._lookups,
+                lookup_seconds_total=self._lookup_seconds_total,
+                lookup_seconds_max=self._lookup_seconds_max,
+            )
+
+    def close(self) -> None:
+        """
+        Stops the lookup threads, if any were started
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=False)
+
+
+_resolver: Optional[DnsResolver] = None  # pylint: disable=invalid-name
+_resolver_lock = threading.Lock()
+
+
+def get_resolver() -> DnsResolver:
+    """
+    Returns the process wide resolver, creating it on first use
+    """
+    global _resolver  # pylint: disable=global-statement
+    with _resolver_lock:
+        if _resolver is None:
+            config = get_config()
+            _resolver = DnsResolver(
+                cache_size=config.dns_cache_size,
+                positive_ttl=config.dns_cache_ttl,
+                negative_ttl=config.dns_negative_ttl,
+                lookup_workers=config.dns_lookup_workers,
+                slow_lookup_seconds=config.dns_slow_lookup_seconds,
+            )
+        return _resolver
+
+
+def reset_resolver() -> None:
+    """
+    Discards the resolver and its cache, so the next
+    lookup creates a new one from the current config
+    """
+    global _resolver  # pylint: disable=global-statement
+    with _resolver_lock:
+        resolver, _resolver = _resolver, None
+    if resolver:
+        resolver.close()
@@ -0,0 +1,158 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file records how far each message got through being handled,
+so messages redelivered by RabbitMQ are skipped or resumed
+rather than handled again from the start
+"""
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Iterator, Optional
+
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.rabbit_message import RabbitMessage
+
+logger = logging.getLogger(__name__)
+
+# Stages recorded as a message is handled, in the order they complete
+STAGE_HOST_CREATED = "host_created"
+STAGE_MADE = "made"
+STAGE_COMPLETE = "complete"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS handled_messages (
+    instance_id TEXT NOT NULL,
+    event_type TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (instance_id, event_type, message_id)
+)
+"""
+
+
+@dataclass(frozen=True)
+class MessageKey:
+    """
+    Identifies a single message, which is the same when redelivered
+    """
+
+    instance_id: str
+    event_type: str
+    message_id: str
+
+    @staticmethod
+    def from_message(message: RabbitMessage) -> Optional["MessageKey"]:
+        """
+        Returns the key for a message, or None if it has no message ID
+        """
+        if not message.message_id:
+            return None
+        return MessageKey(
+            message.payload.instance_id, message.event_type, message.message_id
+        )
+
+
+class IdempotencyStore:
+    """
+    Stores the last completed stage of each message in SQLite. The
+    connection is shared between threads, so access is serialised.
+    Records older than retention_seconds are pruned when opened.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        retention_seconds: float,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._retention_seconds = retention_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            # Every stage is committed as it completes, which WAL keeps cheap
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(_SCHEMA)
+        self.prune()
+
+    def completed_stage(self, key: MessageKey) -> Optional[str]:
+        """
+        Returns the last stage completed for the message, if any
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stage FROM handled_messages "
+                "WHERE instance_id = ? AND event_type = ? AND message_id = ?",
+                (key.instance_id, key.event_type, key.message_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, key: MessageKey, stage: str) -> None:
+        """
+        Records the message as having completed the given stage
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO handled_messages VALUES (?, ?, ?, ?, ?)",
+                (key.instance_id, key.event_type, key.message_id, stage, self._clock()),
+            )
+
+    def prune(self) -> int:
+        """
+        Removes records older than the retention period,
+        returning how many were removed
+        """
+        cutoff = self._clock() - self._retention_seconds
+        with self._lock, self._conn:
+            removed = self._conn.execute(
+                "DELETE FROM handled_messages WHERE updated_at < ?", (cutoff,)
+            ).rowcount
+        if removed:
+            logger.info("Pruned %s handled message records", removed)
+        return removed
+
+    def close(self) -> None:
+        """
+        Closes the underlying database
+        """
+        with self._lock:
+            self._conn.close()
+
+
+_store: Optional[IdempotencyStore] = None  # pylint: disable=invalid-name
+
+
+def get_idempotency_store() -> Optional[IdempotencyStore]:
+    """
+    Returns the open store, or None if progress is not being recorded
+    """
+    return _store
+
+
+@contextmanager
+def idempotency_store(config: ConsumerConfig) -> Iterator[Optional[IdempotencyStore]]:
+    """
+    Records message progress for the duration of the block, unless
+    disabled by leaving CONSUMER_STATE_PATH empty
+    """
+    global _store  # pylint: disable=global-statement
+    if not config.consumer_state_path:
+        yield None
+        return
+
+    store = IdempotencyStore(
+        config.consumer_state_path,
+        retention_seconds=config.consumer_state_retention_days * 24 * 60 * 60,
+    )
+    logger.info("Recording message progress in %s", config.consumer_state_path)
+    _store = store
+    try:
+        yield store
+    finally:
+        _store = None
+        store.close()
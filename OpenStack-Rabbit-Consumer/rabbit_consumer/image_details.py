@@ -0,0 +1,58 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file holds the parts of an OpenStack image used by the consumer,
+so they can be cached between messages
+"""
+import dataclasses
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from mashumaro.exceptions import InvalidFieldValue, MissingField
+from openstack.compute.v2.image import Image
+
+from rabbit_consumer.aq_metadata import AqMetadata
+
+
+@dataclass(frozen=True)
+class ImageDetails:
+    """
+    An immutable snapshot of an image's name and metadata, along
+    with whether it is used to build Aquilon managed VMs
+    """
+
+    name: str
+    metadata: Dict[str, str]
+    is_aq_managed: bool
+    # Parsed once, as images are shared by many VMs
+    aq_metadata: Optional[AqMetadata] = None
+
+    @staticmethod
+    def from_image(image: Image) -> "ImageDetails":
+        """
+        Creates the snapshot from an OpenStack image
+        """
+        metadata = dict(image.metadata or {})
+        is_aq_managed = "AQ_OS" in metadata
+        aq_metadata = None
+        if is_aq_managed:
+            try:
+                aq_metadata = AqMetadata.from_dict(metadata)
+            except (MissingField, InvalidFieldValue):
+                # Left for get_aq_metadata to raise whilst handling the VM
+                pass
+        return ImageDetails(
+            name=image.name,
+            metadata=metadata,
+            is_aq_managed=is_aq_managed,
+            aq_metadata=aq_metadata,
+        )
+
+    def get_aq_metadata(self) -> AqMetadata:
+        """
+        Returns a copy of the image's Aquilon metadata, which
+        the caller is free to override with the VM's metadata
+        """
+        if self.aq_metadata is None:
+            return AqMetadata.from_dict(self.metadata)
+        return dataclasses.replace(self.aq_metadata)
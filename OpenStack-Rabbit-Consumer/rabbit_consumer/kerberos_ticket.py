@@ -0,0 +1,194 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file caches the state of the shared Kerberos ticket, so we
+do not have to fork klist before every Aquilon request
+"""
+import io
+import logging
+import os
+import struct
+import subprocess
+import threading
+import time
+from typing import BinaryIO, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Tickets are revalidated this long before they expire
+REFRESH_MARGIN_SECONDS = 300
+# How long to trust klist, which is only run if the ccache expiry cannot be read
+FALLBACK_TTL_SECONDS = 300
+# Lower bound between revalidations of a ticket which is close to expiry
+MIN_RECHECK_SECONDS = 10
+
+
+def get_ccache_path(ccname: Optional[str]) -> Optional[str]:
+    """
+    Returns the file path of a FILE type credential cache name,
+    or None if the cache is not stored in a plain file
+    """
+    if not ccname:
+        return None
+    if ccname.startswith("FILE:"):
+        return ccname[len("FILE:") :]
+    if ":" in ccname:
+        # e.g. KEYRING: or DIR: caches which we can't read directly
+        return None
+    return ccname
+
+
+def _read(handle: BinaryIO, length: int) -> bytes:
+    data = handle.read(length)
+    if len(data) != length:
+        raise EOFError("Truncated credential cache")
+    return data
+
+
+def _read_uint(handle: BinaryIO, fmt: str) -> int:
+    return struct.unpack(fmt, _read(handle, struct.calcsize(fmt)))[0]
+
+
+def _read_octets(handle: BinaryIO) -> bytes:
+    return _read(handle, _read_uint(handle, ">I"))
+
+
+def _read_principal(handle: BinaryIO) -> List[bytes]:
+    """
+    Reads a principal, returning the realm followed by its components
+    """
+    _read_uint(handle, ">I")  # Name type
+    num_components = _read_uint(handle, ">I")
+    realm = _read_octets(handle)
+    return [realm] + [_read_octets(handle) for _ in range(num_components)]
+
+
+def _read_credential(handle: BinaryIO, version: int) -> Tuple[List[bytes], int]:
+    """
+    Reads a single credential, returning the server principal and end time
+    """
+    _read_principal(handle)  # Client
+    server = _read_principal(handle)
+
+    _read_uint(handle, ">H")  # Key enctype
+    if version == 0x0503:
+        _read_uint(handle, ">H")  # Enctype is repeated in v3
+    _read_octets(handle)  # Key
+
+    _, _, end_time, _ = struct.unpack(">IIII", _read(handle, 16))
+    _read(handle, 5)  # is_skey and ticket flags
+
+    for _ in range(_read_uint(handle, ">I")):  # Addresses
+        _read_uint(handle, ">H")
+        _read_octets(handle)
+    for _ in range(_read_uint(handle, ">I")):  # Auth data
+        _read_uint(handle, ">H")
+        _read_octets(handle)
+
+    _read_octets(handle)  # Ticket
+    _read_octets(handle)  # Second ticket
+    return server, end_time
+
+
+def read_ccache_expiry(path: str) -> Optional[float]:
+    """
+    Reads the expiry time of the ticket granting ticket from a MIT
+    file credential cache, returning None if it cannot be determined
+    """
+    try:
+        with open(path, "rb") as ccache:
+            data = ccache.read()
+    except OSError as err:
+        logger.debug("Could not read ccache %s: %s", path, err)
+        return None
+
+    handle = io.BytesIO(data)
+    try:
+        version = _read_uint(handle, ">H")
+        if version not in (0x0503, 0x0504):
+            logger.debug("Unsupported ccache version: %s", hex(version))
+            return None
+        if version == 0x0504:
+            _read(handle, _read_uint(handle, ">H"))  # Header
+        _read_principal(handle)  # Default principal
+
+        expiry = None
+        while handle.tell() < len(data):
+            server, end_time = _read_credential(handle, version)
+            # Only consider ticket granting tickets, this also skips
+            # config entries (X-CACHECONF:) which have no lifetime
+            if len(server) > 1 and server[1] == b"krbtgt":
+                expiry = end_time if expiry is None else max(expiry, end_time)
+    except (EOFError, struct.error) as err:
+        logger.debug("Could not parse ccache %s: %s", path, err)
+        return None
+    return float(expiry) if expiry is not None else None
+
+
+class KerberosTicketCache:
+    """
+    Remembers that the shared Kerberos ticket is valid until close to its
+    expiry. The expiry is read from the ccache file again when the ticket
+    nears expiry, the sidecar replaces the file, or an auth failure is
+    reported. klist is only run for caches which cannot be read directly.
+    """
+
+    def __init__(self, ccache_path: Optional[str]):
+        self._ccache_path = ccache_path
+        self._lock = threading.Lock()
+        self._valid_until: Optional[float] = None
+        self._signature: Optional[Tuple[int, int, int]] = None
+
+    def _ccache_signature(self) -> Optional[Tuple[int, int, int]]:
+        """
+        Returns a value which changes whenever the ccache file is rewritten
+        """
+        if not self._ccache_path:
+            return None
+        try:
+            stat = os.stat(self._ccache_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def invalidate(self) -> None:
+        """
+        Forces the ticket to be revalidated on next use,
+        e.g. after Aquilon rejects our credentials
+        """
+        with self._lock:
+            self._valid_until = None
+
+    def ensure_valid(self) -> None:
+        """
+        Checks for a valid Kerberos ticket, using the cached state where possible.
+        Raises a RuntimeError if no ticket is found
+        """
+        with self._lock:
+            now = time.time()
+            if (
+                self._valid_until is not None
+                and now < self._valid_until
+                and self._ccache_signature() == self._signature
+            ):
+                return
+            self._revalidate(now)
+
+    def _revalidate(self, now: float) -> None:
+        logger.debug("Checking for valid Kerberos Ticket")
+        signature = self._ccache_signature()
+        expiry = read_ccache_expiry(self._ccache_path) if self._ccache_path else None
+        if expiry is None:
+            if subprocess.call(["klist", "-s"]) != 0:
+                self._valid_until = None
+                raise RuntimeError("No shared Kerberos ticket found.")
+            self._valid_until = now + FALLBACK_TTL_SECONDS
+        elif expiry <= now:
+            self._valid_until = None
+            raise RuntimeError("Shared Kerberos ticket has expired.")
+        else:
+            recheck_at = max(expiry - REFRESH_MARGIN_SECONDS, now + MIN_RECHECK_SECONDS)
+            self._valid_until = min(expiry, recheck_at)
+
+        self._signature = signature
+        logger.debug("Kerberos ticket valid, next check at %s", self._valid_until)
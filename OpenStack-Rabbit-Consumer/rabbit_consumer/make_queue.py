@@ -0,0 +1,365 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file runs Aquilon template compiles on their own workers, so
+the consumer can carry on provisioning other VMs in the meantime.
+The create message is acked before its make runs, so a make which
+fails, or is lost when the consumer stops, is only logged and counted.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from rabbit_consumer import aq_api, metrics
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.openstack_address import OpenstackAddress
+
+logger = logging.getLogger(__name__)
+
+# Failures which may succeed if tried again, unlike a failed compile
+_RETRYABLE_ERRORS = (ConnectionError, requests.RequestException)
+
+
+@dataclass
+class _MakeJob:
+    """
+    A pending make for a single VM, along with any work
+    which must only happen once the make has succeeded
+    """
+
+    vm_id: str
+    addresses: List[OpenstackAddress]
+    queued_at: float
+    on_success: List[Callable[[], None]] = field(default_factory=list)
+    attempts: int = 0
+    cancelled: bool = False
+    # Set once a run has finished, whether or not it is to be retried
+    finished: threading.Event = field(default_factory=threading.Event)
+
+    @property
+    def hostname(self) -> str:
+        """
+        The hostname of the VM's first address, which the make compiles
+        """
+        return self.addresses[0].hostname
+
+
+@dataclass(frozen=True)
+class MakeQueueStats:
+    """
+    A snapshot of the make queue's depth and how long makes take
+    from being requested to completing
+    """
+
+    depth: int
+    completed: int
+    failed: int
+    latency_seconds_total: float
+    latency_seconds_max: float
+
+    @property
+    def latency_seconds_mean(self) -> float:
+        """
+        Returns the mean time from a make being requested to it completing
+        """
+        return self.latency_seconds_total / self.completed if self.completed else 0.0
+
+
+class MakeQueue:  # pylint: disable=too-many-instance-attributes
+    """
+    Runs aq_make on a fixed number of worker threads. Each request waits
+    for debounce_seconds, during which further requests for the same VM
+    are merged into it. Makes which fail to reach Aquilon are retried with
+    an exponential backoff, up to max_attempts in total. A make can be
+    cancelled until it starts, such as when its VM is deleted.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        workers: int,
+        debounce_seconds: float,
+        max_attempts: int,
+        retry_seconds: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if workers < 1:
+            raise ValueError(f"Make workers must be at least 1, got {workers}")
+        self._debounce_seconds = debounce_seconds
+        self._max_attempts = max_attempts
+        self._retry_seconds = retry_seconds
+        self._clock = clock
+
+        # Jobs ordered by when they should run, and the jobs not yet
+        # started or running, keyed by VM ID
+        self._schedule: List[Tuple[float, int, _MakeJob]] = []
+        self._pending: Dict[str, _MakeJob] = {}
+        self._running: Dict[str, _MakeJob] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+
+        self._completed = 0
+        self._failed = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._threads = [
+            threading.Thread(target=self._worker_loop, name=f"aq-make-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def __enter__(self) -> "MakeQueue":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
+
+    def start(self) -> None:
+        """
+        Starts all worker threads
+        """
+        logger.debug("Starting %s make workers", len(self._threads))
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self) -> None:
+        """
+        Runs every queued make without waiting for the debounce,
+        then stops the workers
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+        logger.debug("All make workers stopped")
+
+    @property
+    def depth(self) -> int:
+        """
+        The number of makes waiting to run, including those awaiting a retry
+        """
+        with self._condition:
+            return len(self._schedule)
+
+    def submit(
+        self,
+        vm_id: str,
+        addresses: List[OpenstackAddress],
+        on_success: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """
+        Queues a make for the VM's host, merging it into any make for
+        the same VM which has not yet started. on_success is called
+        once the make has completed.
+        """
+        hostname = addresses[0].hostname
+        if not hostname or not hostname.strip():
+            raise ValueError("Hostname cannot be empty")
+
+        with self._condition:
+            job = self._pending.get(vm_id)
+            if job:
+                logger.debug("Merging make request for %s", vm_id)
+                job.addresses = addresses
+            else:
+                job = _MakeJob(vm_id, addresses, queued_at=self._clock())
+                self._pending[vm_id] = job
+                self._schedule_job(job, self._debounce_seconds)
+            if on_success:
+                job.on_success.append(on_success)
+
+    def cancel(self, vm_id: str) -> None:
+        """
+        Drops any make for the VM which has not started, waiting for one
+        which is running to finish, so a make queued by its create never
+        runs after the VM has been deleted
+        """
+        with self._condition:
+            pending = self._pending.pop(vm_id, None)
+            if pending:
+                logger.info("Cancelled queued make for %s", vm_id)
+                pending.cancelled = True
+            running = self._running.get(vm_id)
+            if running:
+                # Neither retried nor completed once it finishes
+                running.cancelled = True
+        if running:
+            logger.info("Waiting for running make for %s", vm_id)
+            running.finished.wait()
+
+    def _schedule_job(self, job: _MakeJob, delay: float) -> None:
+        """
+        Adds the job to the schedule, the caller must hold the condition
+        """
+        run_at = self._clock() + delay
+        heapq.heappush(self._schedule, (run_at, next(self._sequence), job))
+        metrics.MAKE_QUEUE_DEPTH.set(len(self._schedule))
+        self._condition.notify()
+
+    def _next_job(self) -> Optional[_MakeJob]:
+        """
+        Waits for the next job which is due, returning None once
+        the queue is stopping and has no jobs left
+        """
+        with self._condition:
+            while True:
+                if not self._schedule:
+                    if self._stopping:
+                        return None
+                    self._condition.wait()
+                    continue
+
+                run_at, _, job = self._schedule[0]
+                remaining = run_at - self._clock()
+                if remaining > 0 and not self._stopping:
+                    self._condition.wait(remaining)
+                    continue
+
+                heapq.heappop(self._schedule)
+                metrics.MAKE_QUEUE_DEPTH.set(len(self._schedule))
+                if job.cancelled:
+                    continue
+                if self._pending.get(job.vm_id) is job:
+                    # Later requests for this VM queue a new make
+                    del self._pending[job.vm_id]
+                job.finished.clear()
+                self._running[job.vm_id] = job
+                return job
+
+    def _worker_loop(self) -> None:
+        """
+        Runs makes until asked to stop
+        """
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            finally:
+                with self._condition:
+                    if self._running.get(job.vm_id) is job:
+                        del self._running[job.vm_id]
+                job.finished.set()
+
+    def _run(self, job: _MakeJob) -> None:
+        """
+        Runs a single make, rescheduling it if it should be retried
+        """
+        job.attempts += 1
+        try:
+            aq_api.aq_make(job.addresses)
+        except _RETRYABLE_ERRORS:
+            if job.attempts < self._max_attempts:
+                delay = self._retry_seconds * 2 ** (job.attempts - 1)
+                logger.warning(
+                    "Make for %s failed, retrying in %.0fs", job.hostname, delay
+                )
+                self._retry(job, delay)
+                return
+            self._record_failure(job)
+            return
+        except Exception:  # pylint: disable=broad-exception-caught
+            self._record_failure(job)
+            return
+
+        self._record_success(job)
+        if job.cancelled:
+            return
+        for callback in job.on_success:
+            try:
+                callback()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Failed to complete make for %s", job.hostname)
+
+    def _retry(self, job: _MakeJob, delay: float) -> None:
+        """
+        Reschedules a failed job, unless it was cancelled or a newer
+        make for the same VM is already waiting which can take its place
+        """
+        with self._condition:
+            if job.cancelled:
+                return
+            newer = self._pending.get(job.vm_id)
+            if newer:
+                newer.on_success.extend(job.on_success)
+                return
+            self._pending[job.vm_id] = job
+            self._schedule_job(job, delay)
+
+    def _record_success(self, job: _MakeJob) -> None:
+        latency = self._clock() - job.queued_at
+        metrics.STAGE_LATENCY.labels("make").observe(latency)
+        with self._condition:
+            self._completed += 1
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+        logger.info("Made templates for %s in %.1fs", job.hostname, latency)
+
+    def _record_failure(self, job: _MakeJob) -> None:
+        metrics.MAKES_FAILED.inc()
+        with self._condition:
+            self._failed += 1
+        logger.exception(
+            "Make for %s failed after %s attempts", job.hostname, job.attempts
+        )
+
+    def stats(self) -> MakeQueueStats:
+        """
+        Returns the queue depth and make latency so far
+        """
+        with self._condition:
+            return MakeQueueStats(
+                depth=len(self._schedule),
+                completed=self._completed,
+                failed=self._failed,
+                latency_seconds_total=self._latency_total,
+                latency_seconds_max=self._latency_max,
+            )
+
+
+_make_queue: Optional[MakeQueue] = None  # pylint: disable=invalid-name
+
+
+def get_make_queue() -> Optional[MakeQueue]:
+    """
+    Returns the running make queue, or None if makes should
+    be run synchronously
+    """
+    return _make_queue
+
+
+@contextmanager
+def deferred_makes(config: ConsumerConfig) -> Iterator[Optional[MakeQueue]]:
+    """
+    Runs makes on a queue for the duration of the block, unless
+    disabled by setting AQ_MAKE_WORKERS to 0. Queued makes are
+    completed before the block exits.
+    """
+    global _make_queue  # pylint: disable=global-statement
+    if config.aq_make_workers < 1:
+        yield None
+        return
+
+    make_queue = MakeQueue(
+        workers=config.aq_make_workers,
+        debounce_seconds=config.aq_make_debounce_seconds,
+        max_attempts=config.aq_make_attempts,
+        retry_seconds=config.aq_make_retry_seconds,
+    )
+    with make_queue:
+        _make_queue = make_queue
+        try:
+            yield make_queue
+        finally:
+            _make_queue = None
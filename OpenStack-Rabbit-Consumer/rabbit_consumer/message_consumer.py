@@ -4,27 +4,57 @@
 This file manages how rabbit messages stating AQ VM creation and deletion 
 should be handled and processed between the consumer and Aquilon
 """
-import json
 import logging
-import socket
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Dict, Optional, List
 
 import rabbitpy
+from openstack.compute.v2.server import Server
+from openstack.exceptions import NotFoundException
 
 from rabbit_consumer import aq_api
+from rabbit_consumer import metrics
 from rabbit_consumer import openstack_api
 from rabbit_consumer.aq_api import verify_kerberos_ticket
-from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.backend_limiter import wait_for_backends
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.consumer_config import ConsumerConfig, get_config
+from rabbit_consumer.dns_resolver import get_resolver
+from rabbit_consumer.idempotency_store import (
+    STAGE_COMPLETE,
+    STAGE_HOST_CREATED,
+    STAGE_MADE,
+    MessageKey,
+    get_idempotency_store,
+    idempotency_store,
+)
+from rabbit_consumer.make_queue import deferred_makes, get_make_queue
 from rabbit_consumer.aq_metadata import AqMetadata
+from rabbit_consumer.message_filter import json_loads, peek_event_type
 from rabbit_consumer.openstack_address import OpenstackAddress
+from rabbit_consumer.pipeline import PipelineJob, Stage, StagedPipeline
 from rabbit_consumer.rabbit_message import RabbitMessage, MessageEventType
+from rabbit_consumer.retry_queue import RetryRouter
+from rabbit_consumer.sharding import (
+    ShardRouter,
+    consume_concurrently,
+    declare_shards,
+    get_replica_index,
+    owned_shards,
+    shard_queue,
+)
 from rabbit_consumer.vm_data import VmData
+from rabbit_consumer.worker_pool import BaseWorkerPool, MessageWorkerPool
 
 logger = logging.getLogger(__name__)
 SUPPORTED_MESSAGE_TYPES = {
     "create": "compute.instance.create.end",
     "delete": "compute.instance.delete.start",
 }
+# Glance events which change the metadata of cached images
+IMAGE_EVENT_TYPES = {"image.update", "image.delete"}
 
 
 def is_aq_managed_image(vm_data: VmData) -> bool:
@@ -37,7 +67,7 @@ def is_aq_managed_image(vm_data: VmData) -> bool:
         logger.info("No image found for %s", vm_data.virtual_machine_id)
         return False
 
-    if "AQ_OS" not in image.metadata:
+    if not image.is_aq_managed:
         logger.debug("Skipping non-Aquilon image: %s", image.name)
         return False
     return True
@@ -49,7 +79,7 @@ def get_aq_build_metadata(vm_data: VmData) -> AqMetadata:
     VM metadata takes precedence) to determine the AQ params
     """
     image = openstack_api.get_image(vm_data)
-    image_meta = AqMetadata.from_dict(image.metadata)
+    image_meta = image.get_aq_metadata()
 
     vm_metadata = openstack_api.get_server_metadata(vm_data)
     image_meta.override_from_vm_meta(vm_metadata)
@@ -61,14 +91,15 @@ def consume(message: RabbitMessage) -> None:
     Consumes a message from the rabbit queue and calls the appropriate
     handler based on the event type.
     """
-    if message.event_type == SUPPORTED_MESSAGE_TYPES["create"]:
-        handle_create_machine(message)
+    with openstack_api.server_cache():
+        if message.event_type == SUPPORTED_MESSAGE_TYPES["create"]:
+            handle_create_machine(message)
 
-    elif message.event_type == SUPPORTED_MESSAGE_TYPES["delete"]:
-        handle_machine_delete(message)
+        elif message.event_type == SUPPORTED_MESSAGE_TYPES["delete"]:
+            handle_machine_delete(message)
 
-    else:
-        raise ValueError(f"Unsupported message type: {message.event_type}")
+        else:
+            raise ValueError(f"Unsupported message type: {message.event_type}")
 
 
 def delete_machine(
@@ -79,24 +110,48 @@ def delete_machine(
     the serial, MAC and hostname provided. This is the best effort attempt
     to clean-up, since we can have partial or incorrect information.
     """
-    # First handle hostnames
-    if network_details and aq_api.check_host_exists(network_details.hostname):
-        logger.info("Deleting host %s", network_details.hostname)
-        aq_api.delete_host(network_details.hostname)
+    # The lookups are made concurrently where they do not depend on each
+    # other, whilst the deletes stay in the order Aquilon enforces:
+    #
+    #   check_host_exists   search_machine_by_serial
+    #           |                     |
+    #      delete_host                |
+    #           +----------+----------+
+    #                      |
+    #   search_host_by_machine   get_machine_details
+    #           +----------+----------+
+    #                      |
+    #     delete host or interfaces, then delete_machine
+    with ThreadPoolExecutor(
+        max_workers=2, thread_name_prefix="aq-delete-lookup"
+    ) as executor:
+        host_exists = (
+            executor.submit(aq_api.check_host_exists, network_details.hostname)
+            if network_details
+            else None
+        )
+        serial_search = executor.submit(aq_api.search_machine_by_serial, vm_data)
 
-    machine_name = aq_api.search_machine_by_serial(vm_data)
-    if not machine_name:
-        logger.info("No existing record found for %s", vm_data.virtual_machine_id)
-        return
+        # First handle hostnames
+        if host_exists and host_exists.result():
+            logger.info("Deleting host %s", network_details.hostname)
+            aq_api.delete_host(network_details.hostname)
+
+        machine_name = serial_search.result()
+        if not machine_name:
+            logger.info("No existing record found for %s", vm_data.virtual_machine_id)
+            return
 
-    # We have to do this manually because AQ has neither a:
-    # - Just delete the machine please
-    # - Delete this if it exists
-    # So alas we have to do everything by hand, whilst adhering to random rules
-    # of deletion orders which it enforces...
+        # We have to do this manually because AQ has neither a:
+        # - Just delete the machine please
+        # - Delete this if it exists
+        # So alas we have to do everything by hand, whilst adhering to random rules
+        # of deletion orders which it enforces...
 
-    hostname = aq_api.search_host_by_machine(machine_name)
-    machine_details = aq_api.get_machine_details(machine_name)
+        host_search = executor.submit(aq_api.search_host_by_machine, machine_name)
+        details_search = executor.submit(aq_api.get_machine_details, machine_name)
+        hostname = host_search.result()
+        machine_details = details_search.result()
 
     # We have to clean-up all the interfaces and addresses first
     # we could have a machine which points to a different hostname
@@ -108,7 +163,7 @@ def delete_machine(
             aq_api.delete_host(hostname)
         else:
             # Delete the interfaces
-            ipv4_address = socket.gethostbyname(hostname)
+            ipv4_address = get_resolver().forward(hostname)
             if ipv4_address in machine_details:
                 aq_api.delete_address(ipv4_address, machine_name)
 
@@ -140,43 +195,147 @@ def check_machine_valid(rabbit_message: RabbitMessage) -> bool:
     return True
 
 
+@dataclass
+class ProvisioningResult:
+    """
+    What creating a VM found out about it, kept so that writing its
+    Aquilon details back needs nothing fetched from Aquilon or Nova again
+    """
+
+    server: Optional[Server] = None
+    hostnames: List[str] = field(default_factory=list)
+    # Not known when resuming a create whose machine was already made
+    machine_name: Optional[str] = None
+
+
+@dataclass
+class CreateJob:  # pylint: disable=too-many-instance-attributes
+    """
+    A create message as it passes through each step of
+    handle_create_machine, holding what later steps need
+    """
+
+    rabbit_message: RabbitMessage
+    vm_data: VmData
+    key: Optional[MessageKey]
+    # The stage reached by an earlier delivery of this message
+    resume_stage: Optional[str] = None
+    image_meta: Optional[AqMetadata] = None
+    network_details: List[OpenstackAddress] = field(default_factory=list)
+    # Server records fetched from Nova, shared by every step
+    servers: Dict = field(default_factory=dict)
+    result: ProvisioningResult = field(default_factory=ProvisioningResult)
+
+
 def handle_create_machine(rabbit_message: RabbitMessage) -> None:
     """
     Handles the creation of a machine in Aquilon. This includes
     creating the machine, adding the nics, and managing the host.
     """
+    job = start_create(rabbit_message)
+    if job and enrich_create(job) and resolve_create(job) and provision_create(job):
+        finish_create(job)
+
+
+def start_create(rabbit_message: RabbitMessage) -> Optional[CreateJob]:
+    """
+    Starts handling a create message, returning None if an earlier
+    delivery of it already completed
+    """
     logger.info("=== Received Aquilon VM create message ===")
     _print_debug_logging(rabbit_message)
 
-    if not check_machine_valid(rabbit_message):
-        return
+    key = MessageKey.from_message(rabbit_message)
+    stage = _completed_stage(key)
+    if stage == STAGE_COMPLETE:
+        logger.info("Skipping redelivered create message %s", key.message_id)
+        return None
+    return CreateJob(
+        rabbit_message, VmData.from_message(rabbit_message), key, resume_stage=stage
+    )
 
-    vm_data = VmData.from_message(rabbit_message)
 
-    image_meta = get_aq_build_metadata(vm_data)
-    network_details = openstack_api.get_server_networks(vm_data)
+def enrich_create(job: CreateJob) -> bool:
+    """
+    Fetches the image metadata and addresses of the VM from Openstack,
+    returning False if it should not be created in Aquilon
+    """
+    if not check_machine_valid(job.rabbit_message):
+        return False
 
-    if not network_details or not network_details[0].hostname:
-        vm_name = rabbit_message.payload.vm_name
-        logger.info("Skipping novalocal only host: %s", vm_name)
-        return
+    job.result.server = openstack_api.get_server_details(job.vm_data)
+    job.image_meta = get_aq_build_metadata(job.vm_data)
+    job.network_details = openstack_api.get_server_networks(
+        job.vm_data, resolve_hostnames=False
+    )
+    return True
 
-    logger.info("Clearing any existing records from Aquilon")
-    delete_machine(vm_data, network_details[0])
 
-    # Configure networking
-    machine_name = aq_api.create_machine(rabbit_message, vm_data)
-    aq_api.add_machine_nics(machine_name, network_details)
-    aq_api.set_interface_bootable(machine_name, "eth0")
+def resolve_create(job: CreateJob) -> bool:
+    """
+    Looks up the hostnames of the VM's addresses, returning
+    False if it has none to register with Aquilon
+    """
+    OpenstackAddress.resolve_hostnames(
+        [address for address in job.network_details if not address.hostname]
+    )
+    if not job.network_details or not job.network_details[0].hostname:
+        vm_name = job.rabbit_message.payload.vm_name
+        logger.info("Skipping novalocal only host: %s", vm_name)
+        return False
+    job.result.hostnames = [address.hostname for address in job.network_details]
+    return True
+
 
-    # Manage host in Aquilon
-    aq_api.create_host(image_meta, network_details, machine_name)
+def provision_create(job: CreateJob, queue_make: bool = True) -> bool:
+    """
+    Creates the machine and host in Aquilon then compiles its templates,
+    returning False if the compile was queued to finish the create later.
+    With queue_make False the compile always runs inline, even if a make
+    queue is running.
+    """
+    key, stage, network_details = job.key, job.resume_stage, job.network_details
+    if stage:
+        # A redelivered message whose host was already created
+        logger.info("Resuming create for %s after %s", key.instance_id, stage)
+    else:
+        logger.info("Clearing any existing records from Aquilon")
+        delete_machine(job.vm_data, network_details[0])
+
+        # Configure networking
+        machine_name = aq_api.create_machine(job.rabbit_message, job.vm_data)
+        job.result.machine_name = machine_name
+        aq_api.add_machine_nics(machine_name, network_details)
+        aq_api.set_interface_bootable(machine_name, "eth0")
+
+        # Manage host in Aquilon
+        aq_api.create_host(job.image_meta, network_details, machine_name)
+        _record_stage(key, STAGE_HOST_CREATED)
+
+    if stage == STAGE_MADE:
+        return True
+    make_queue = get_make_queue() if queue_make else None
+    if make_queue:
+        # The metadata reports success, so is only set once templates compile
+        make_queue.submit(
+            job.vm_data.virtual_machine_id,
+            network_details,
+            on_success=partial(finish_create, job),
+        )
+        logger.info("Queued make for VM %s", job.vm_data.virtual_machine_id)
+        return False
     aq_api.aq_make(network_details)
+    return True
 
-    add_aq_details_to_metadata(vm_data, network_details)
 
+def finish_create(job: CreateJob) -> None:
+    """
+    Writes the Aquilon details back to the VM once its templates have compiled
+    """
+    _finish_create(job.key, job.vm_data, job.result)
     logger.info(
-        "=== Finished Aquilon creation hook for VM %s ===", vm_data.virtual_machine_id
+        "=== Finished Aquilon creation hook for VM %s ===",
+        job.vm_data.virtual_machine_id,
     )
 
 
@@ -202,58 +361,372 @@ def handle_machine_delete(rabbit_message: RabbitMessage) -> None:
     logger.info("=== Received Aquilon VM delete message ===")
     _print_debug_logging(rabbit_message)
 
+    key = MessageKey.from_message(rabbit_message)
+    if _completed_stage(key) == STAGE_COMPLETE:
+        logger.info("Skipping redelivered delete message %s", key.message_id)
+        return
+
     vm_data = VmData.from_message(rabbit_message)
+    make_queue = get_make_queue()
+    if make_queue:
+        # Otherwise a make queued by the create could recreate its templates
+        make_queue.cancel(vm_data.virtual_machine_id)
     delete_machine(vm_data=vm_data)
+    _record_stage(key, STAGE_COMPLETE)
 
     logger.info(
         "=== Finished Aquilon deletion hook for VM %s ===", vm_data.virtual_machine_id
     )
 
 
-def add_aq_details_to_metadata(
-    vm_data: VmData, network_details: List[OpenstackAddress]
+def _completed_stage(key: Optional[MessageKey]) -> Optional[str]:
+    """
+    Returns the last stage completed for a redelivered message
+    """
+    store = get_idempotency_store()
+    if not store or not key:
+        return None
+    return store.completed_stage(key)
+
+
+def _record_stage(key: Optional[MessageKey], stage: str) -> None:
+    """
+    Records the stage as completed, so it is skipped if the message is redelivered
+    """
+    store = get_idempotency_store()
+    if store and key:
+        store.record(key, stage)
+
+
+def _finish_create(
+    key: Optional[MessageKey], vm_data: VmData, result: ProvisioningResult
 ) -> None:
     """
-    Adds the hostname to the metadata of the VM.
+    Writes the Aquilon details back to the VM once its templates have compiled
     """
-    if not openstack_api.check_machine_exists(vm_data):
+    _record_stage(key, STAGE_MADE)
+    add_aq_details_to_metadata(vm_data, result)
+    _record_stage(key, STAGE_COMPLETE)
+
+
+def add_aq_details_to_metadata(vm_data: VmData, result: ProvisioningResult) -> None:
+    """
+    Adds the hostname to the metadata of the VM, using what was found
+    whilst creating it. Aquilon is only searched for the machine name
+    when resuming a create whose machine was made by an earlier delivery.
+    """
+    machine_name = result.machine_name or aq_api.search_machine_by_serial(vm_data)
+    metadata = {
+        "HOSTNAMES": ",".join(result.hostnames),
+        "AQ_STATUS": "SUCCESS",
+        "AQ_MACHINE": machine_name,
+    }
+    try:
+        openstack_api.update_metadata(vm_data, metadata, result.server)
+    except NotFoundException:
         # User has likely deleted the machine since we got here
         logger.warning(
             "Machine %s does not exist, skipping metadata update",
             vm_data.virtual_machine_id,
         )
-        return
 
-    hostnames = [i.hostname for i in network_details]
-    metadata = {
-        "HOSTNAMES": ",".join(hostnames),
-        "AQ_STATUS": "SUCCESS",
-        "AQ_MACHINE": aq_api.search_machine_by_serial(vm_data),
-    }
-    openstack_api.update_metadata(vm_data, metadata)
 
+def _enrich_stage(job: PipelineJob) -> bool:
+    """
+    Starts a create and fetches its details from Openstack. Deletes
+    only need Aquilon, so are passed straight through.
+    """
+    if job.decoded.event_type != SUPPORTED_MESSAGE_TYPES["create"]:
+        return True
+    job.state = start_create(job.decoded)
+    if not job.state:
+        return False
+    with openstack_api.server_cache(job.state.servers):
+        return enrich_create(job.state)
 
-def on_message(message: rabbitpy.Message) -> None:
+
+def _resolve_stage(job: PipelineJob) -> bool:
     """
-    Deserializes the message and calls the consume function on message.
+    Looks up the hostnames of a create's addresses
+    """
+    return job.state is None or resolve_create(job.state)
+
+
+def _provision_stage(job: PipelineJob) -> bool:
+    """
+    Creates the VM in Aquilon, or handles any other message in full.
+    The make runs inline, so the metadata stage always follows it.
+    """
+    if job.state is None:
+        consume(job.decoded)
+        return False
+    with openstack_api.server_cache(job.state.servers):
+        return provision_create(job.state, queue_make=False)
+
+
+def _metadata_stage(job: PipelineJob) -> bool:
+    """
+    Writes the Aquilon details of a created VM back to Openstack
+    """
+    with openstack_api.server_cache(job.state.servers):
+        finish_create(job.state)
+    return False
+
+
+def pipeline_stages(config: ConsumerConfig) -> List[Stage]:
+    """
+    Returns the stages messages pass through once decoded, which
+    split handle_create_machine by the backend each step waits on
+    """
+    return [
+        Stage("enrich", _enrich_stage, config.pipeline_enrich_workers),
+        Stage("dns", _resolve_stage, config.pipeline_dns_workers),
+        Stage("provision", _provision_stage, config.pipeline_provision_workers),
+        Stage("metadata", _metadata_stage, config.pipeline_metadata_workers),
+    ]
+
+
+def _ignore_message(event_type: str) -> None:
+    """
+    Records a message which will be acked without being handled
+    """
+    logger.info("Ignoring event_type: %s", event_type)
+    metrics.MESSAGES_IGNORED.labels(event_type).inc()
+
+
+def decode_message(message: rabbitpy.Message) -> Optional[RabbitMessage]:
+    """
+    Deserializes the message, returning None if the event type is
+    not one we handle. The event type is checked before decoding
+    where possible, as most messages on the bus are ignored.
     """
     raw_body = message.body
     logger.debug("New message: %s", raw_body)
 
-    body = json.loads(raw_body.decode("utf-8"))["oslo.message"]
-    parsed_event = MessageEventType.from_json(body)
-    if parsed_event.event_type not in SUPPORTED_MESSAGE_TYPES.values():
-        logger.info("Ignoring event_type: %s", parsed_event.event_type)
-        message.ack()
-        return
-
-    decoded = RabbitMessage.from_json(body)
+    with metrics.observe_stage("decode"):
+        event_type = peek_event_type(raw_body)
+        if (
+            event_type is not None
+            and event_type not in SUPPORTED_MESSAGE_TYPES.values()
+            and event_type not in IMAGE_EVENT_TYPES
+        ):
+            metrics.message_received(event_type)
+            _ignore_message(event_type)
+            return None
+
+        try:
+            body = json_loads(json_loads(raw_body)["oslo.message"])
+            parsed_event = MessageEventType.from_dict(body)
+        except Exception:
+            metrics.message_received(metrics.UNKNOWN_EVENT_TYPE)
+            metrics.MESSAGES_FAILED.labels(metrics.UNKNOWN_EVENT_TYPE).inc()
+            raise
+
+        metrics.message_received(parsed_event.event_type)
+        if parsed_event.event_type in IMAGE_EVENT_TYPES:
+            # There is nothing else to do for images, so these are not handled
+            image_id = body.get("payload", {}).get("id")
+            if image_id:
+                openstack_api.invalidate_image_cache(image_id)
+            metrics.MESSAGES_IGNORED.labels(parsed_event.event_type).inc()
+            return None
+
+        if parsed_event.event_type not in SUPPORTED_MESSAGE_TYPES.values():
+            _ignore_message(parsed_event.event_type)
+            return None
+
+        decoded = RabbitMessage.from_dict(body)
     logger.debug("Decoded message: %s", decoded)
+    return decoded
+
 
-    consume(decoded)
+def on_message(message: rabbitpy.Message) -> None:
+    """
+    Deserializes the message and calls the consume function on message.
+    """
+    decoded = decode_message(message)
+    if decoded:
+        with metrics.MESSAGES_IN_FLIGHT.track_inprogress():
+            try:
+                consume(decoded)
+            except Exception:
+                metrics.MESSAGES_FAILED.labels(decoded.event_type).inc()
+                raise
+        metrics.MESSAGES_ACKED.labels(decoded.event_type).inc()
     message.ack()
 
 
+def dispatch_message(pool: BaseWorkerPool, message: rabbitpy.Message) -> None:
+    """
+    Decodes the message then hands it to the pool, acking messages we
+    do not handle, possibly in a batch, and dead-lettering those which
+    cannot be decoded.
+    Waits first whilst a backend is down, so messages stay on the queue.
+    """
+    wait_for_backends()
+    try:
+        decoded = decode_message(message)
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        # Retrying cannot help a message we cannot read
+        logger.exception("Failed to decode message")
+        pool.reject(message, err, metrics.UNKNOWN_EVENT_TYPE, retry=False)
+        return
+
+    if decoded:
+        pool.submit(message, decoded)
+    else:
+        pool.ignore(message)
+
+
+def _declare_retry_router(
+    conn: rabbitpy.Connection, config: ConsumerConfig
+) -> Optional[RetryRouter]:
+    """
+    Declares the queues failed messages are moved onto, returning
+    None if failures should stop the consumer instead. The router has
+    its own channel, so waiting for its publishes to be confirmed does
+    not hold up consuming.
+    """
+    if config.consumer_retry_attempts < 1:
+        return None
+
+    channel = conn.channel()
+    channel.enable_publisher_confirms()
+    retry_router = RetryRouter(
+        channel,
+        queue_name="ral.info",
+        max_attempts=config.consumer_retry_attempts,
+        retry_seconds=config.consumer_retry_seconds,
+    )
+    retry_router.declare()
+    return retry_router
+
+
+def _consume_queue(pool: BaseWorkerPool, queue: rabbitpy.Queue) -> None:
+    """
+    Hands every message from the queue to the pool until it stops
+    """
+    message: rabbitpy.Message
+    for message in queue:
+        dispatch_message(pool, message)
+
+
+def _route_queue(
+    pool: BaseWorkerPool, queue: rabbitpy.Queue, router: ShardRouter
+) -> None:
+    """
+    Forwards VM messages from the queue onto their shard queues, and image
+    events onto every shard, handing any others to the pool, until it stops
+    """
+    message: rabbitpy.Message
+    for message in queue:
+        if router.forward(message) is None and not router.broadcast(message):
+            dispatch_message(pool, message)
+        else:
+            pool.ack(message)
+
+
+def _consume_shards(
+    conn: rabbitpy.Connection, config: ConsumerConfig, pool: BaseWorkerPool
+) -> None:
+    """
+    Consumes the shard queues owned by this replica, each on its own
+    channel and thread. The first replica also routes ral.info onto the
+    shards, as only one router can keep messages for a VM in order.
+    Whilst it is down, messages wait on ral.info until it is back. Image
+    events are copied onto every shard, so each replica's image cache
+    is invalidated.
+    """
+    replica = get_replica_index(config)
+    shards = owned_shards(config.consumer_shards, config.consumer_replicas, replica)
+    logger.info(
+        "Replica %s of %s consuming shards: %s",
+        replica,
+        config.consumer_replicas,
+        shards,
+    )
+
+    loops = {}
+    if replica == 0:
+        router_channel = conn.channel()
+        router_channel.enable_publisher_confirms()
+        router = ShardRouter(
+            router_channel,
+            config.consumer_shards,
+            event_types=SUPPORTED_MESSAGE_TYPES.values(),
+            broadcast_types=IMAGE_EVENT_TYPES,
+        )
+        loops["shard-router"] = partial(
+            _route_queue,
+            pool,
+            rabbitpy.Queue(
+                _limit_prefetch(conn.channel(), pool, config), name="ral.info"
+            ),
+            router,
+        )
+    for shard in shards:
+        loops[f"shard-{shard}"] = partial(
+            _consume_queue,
+            pool,
+            rabbitpy.Queue(
+                _limit_prefetch(conn.channel(), pool, config), name=shard_queue(shard)
+            ),
+        )
+    consume_concurrently(loops)
+
+
+def _worker_pool(
+    config: ConsumerConfig,
+    coalescer: CreateDeleteCoalescer,
+    retry_router: Optional[RetryRouter],
+) -> BaseWorkerPool:
+    """
+    Returns the pool decoded messages are handed to, which is a pipeline
+    of stages when PIPELINE_QUEUE_SIZE is set
+    """
+    if not config.pipeline_queue_size:
+        return MessageWorkerPool(
+            config.consumer_workers,
+            consume,
+            coalescer,
+            retry_router,
+            config.consumer_ack_batch_size,
+            queue_size=config.consumer_queue_size,
+        )
+    return StagedPipeline(
+        pipeline_stages(config),
+        config.pipeline_queue_size,
+        coalescer,
+        retry_router,
+        config.consumer_ack_batch_size,
+    )
+
+
+def _limit_prefetch(
+    channel: rabbitpy.Channel, pool: BaseWorkerPool, config: ConsumerConfig
+) -> rabbitpy.Channel:
+    """
+    Limits the un-acked messages RabbitMQ delivers on the channel to
+    CONSUMER_PREFETCH_COUNT, or otherwise to what the pool can hold, so
+    a full pool leaves messages on the queue
+    """
+    prefetch_count = config.consumer_prefetch_count or pool.prefetch_count
+    if prefetch_count:
+        logger.debug("Setting prefetch count to %s", prefetch_count)
+        channel.prefetch_count(prefetch_count)
+    return channel
+
+
+def consumed_exchanges(config: ConsumerConfig) -> List[str]:
+    """
+    Returns the exchanges ral.info is bound to
+    """
+    exchanges = ["nova"]
+    if config.rabbit_image_exchange:
+        exchanges.append(config.rabbit_image_exchange)
+    return exchanges
+
+
 def initiate_consumer() -> None:
     """
     Initiates the message consumer and starts consuming messages in a loop.
@@ -263,7 +736,7 @@ def initiate_consumer() -> None:
     # Ensure we have valid creds before trying to contact rabbit
     verify_kerberos_ticket()
 
-    config = ConsumerConfig()
+    config = get_config()
 
     host = config.rabbit_host
     port = config.rabbit_port
@@ -272,8 +745,6 @@ def initiate_consumer() -> None:
     logger.debug(
         "Connecting to rabbit with: amqp://%s:<password>@%s:%s/", login_user, host, port
     )
-    exchanges = ["nova"]
-
     login_str = f"amqp://{login_user}:{login_pass}@{host}:{port}/"
     with rabbitpy.Connection(login_str) as conn:
         with conn.channel() as channel:
@@ -281,12 +752,27 @@ def initiate_consumer() -> None:
 
             # Durable indicates that the queue will survive a broker restart
             queue = rabbitpy.Queue(channel, name="ral.info", durable=True)
-            for exchange in exchanges:
+            for exchange in consumed_exchanges(config):
                 logger.debug("Binding to exchange: %s", exchange)
                 queue.bind(exchange, routing_key="ral.info")
 
-            # Consume the messages from generator
-            message: rabbitpy.Message
-            logger.debug("Starting to consume messages")
-            for message in queue:
-                on_message(message)
+            if config.consumer_shards:
+                declare_shards(channel, config.consumer_shards)
+
+            retry_router = _declare_retry_router(conn, config)
+            coalescer = CreateDeleteCoalescer(
+                config.consumer_coalesce_seconds,
+                create_event_type=SUPPORTED_MESSAGE_TYPES["create"],
+                delete_event_type=SUPPORTED_MESSAGE_TYPES["delete"],
+            )
+            # The pool stops first, so makes it queued are still run and
+            # can record their progress before the store is closed
+            with idempotency_store(config), deferred_makes(config), _worker_pool(
+                config, coalescer, retry_router
+            ) as pool:
+                logger.debug("Starting to consume messages")
+                _limit_prefetch(channel, pool, config)
+                if config.consumer_shards:
+                    _consume_shards(conn, config, pool)
+                else:
+                    _consume_queue(pool, queue)
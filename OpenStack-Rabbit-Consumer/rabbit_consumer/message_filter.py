@@ -0,0 +1,41 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file provides a cheap check of a raw message's event type, so the
+majority of notifications which we ignore can skip full decoding
+"""
+import json
+import re
+from typing import Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# The oslo.message envelope holds the notification as an escaped JSON string:
+# {"oslo.message": "{\"event_type\": \"compute.instance.create.end\", ...}"}
+_EVENT_TYPE_PATTERN = re.compile(rb'\\"event_type\\":\s*\\"([\w.\-]+)\\"')
+
+
+def json_loads(data: Union[bytes, str]) -> Any:
+    """
+    Deserializes JSON using orjson if it is installed, as it is
+    significantly faster than the standard library for large messages
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def peek_event_type(raw_body: bytes) -> Optional[str]:
+    """
+    Extracts the event type from a raw oslo message without decoding it.
+    Returns None if this cannot be done unambiguously, e.g. if the payload
+    also contains an event_type key, in which case the caller should fully
+    decode the message instead.
+    """
+    found = _EVENT_TYPE_PATTERN.findall(raw_body)
+    if len(found) != 1:
+        return None
+    return found[0].decode("utf-8")
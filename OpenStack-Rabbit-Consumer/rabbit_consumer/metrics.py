@@ -0,0 +1,172 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file defines the Prometheus metrics exported by the consumer,
+and serves them over HTTP for scraping
+"""
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# Used when a message could not be decoded far enough to find its type
+UNKNOWN_EVENT_TYPE = "unknown"
+
+# Aquilon template compiles can take several minutes
+_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+MESSAGES_CONSUMED = Counter(
+    "rabbit_consumer_messages_consumed_total",
+    "Messages received from RabbitMQ",
+    ["event_type"],
+)
+MESSAGES_IGNORED = Counter(
+    "rabbit_consumer_messages_ignored_total",
+    "Messages acked without being handled, such as unused event types "
+    "or creates cancelled by a delete",
+    ["event_type"],
+)
+MESSAGES_ACKED = Counter(
+    "rabbit_consumer_messages_acked_total",
+    "Messages acked after being handled successfully",
+    ["event_type"],
+)
+MESSAGES_FAILED = Counter(
+    "rabbit_consumer_messages_failed_total",
+    "Messages which raised an error whilst being handled",
+    ["event_type"],
+)
+MESSAGES_RETRIED = Counter(
+    "rabbit_consumer_messages_retried_total",
+    "Failed messages moved onto a delayed retry queue",
+    ["event_type"],
+)
+MESSAGES_DEAD_LETTERED = Counter(
+    "rabbit_consumer_messages_dead_lettered_total",
+    "Failed messages parked on the dead-letter queue",
+    ["event_type"],
+)
+MESSAGES_SHARDED = Counter(
+    "rabbit_consumer_messages_sharded_total",
+    "Messages forwarded from ral.info onto a shard queue",
+    ["shard"],
+)
+ACKS_SENT = Counter(
+    "rabbit_consumer_acks_sent_total",
+    "Acks sent to RabbitMQ, where a batch ack also covers earlier messages",
+    ["kind"],
+)
+MESSAGES_IN_FLIGHT = Gauge(
+    "rabbit_consumer_messages_in_flight",
+    "Messages received but not yet acked or failed",
+)
+
+STAGE_LATENCY = Histogram(
+    "rabbit_consumer_stage_duration_seconds",
+    "Time spent in each stage of handling a message",
+    ["stage"],
+    buckets=_LATENCY_BUCKETS,
+)
+AQ_REQUEST_LATENCY = Histogram(
+    "rabbit_consumer_aq_request_duration_seconds",
+    "Time taken by each type of Aquilon request",
+    ["request"],
+    buckets=_LATENCY_BUCKETS,
+)
+OPENSTACK_BATCH_SIZE = Histogram(
+    "rabbit_consumer_openstack_batch_size",
+    "Servers looked up by each batched Nova request",
+    buckets=(2, 5, 10, 20, 50, 100, 200),
+)
+
+CACHE_REQUESTS = Counter(
+    "rabbit_consumer_cache_requests_total",
+    "Lookups served from (hit) or missing (miss) each cache",
+    ["cache", "result"],
+)
+MAKE_QUEUE_DEPTH = Gauge(
+    "rabbit_consumer_make_queue_depth",
+    "Aquilon template compiles waiting to run, including retries",
+)
+PIPELINE_QUEUE_DEPTH = Gauge(
+    "rabbit_consumer_pipeline_queue_depth",
+    "Messages waiting for each stage of the pipeline",
+    ["stage"],
+)
+MAKES_FAILED = Counter(
+    "rabbit_consumer_makes_failed_total",
+    "Aquilon template compiles abandoned after failing",
+)
+
+BACKEND_CONCURRENCY_LIMIT = Gauge(
+    "rabbit_consumer_backend_concurrency_limit",
+    "Concurrent requests currently allowed to each backend",
+    ["backend"],
+)
+BACKEND_REQUESTS_IN_FLIGHT = Gauge(
+    "rabbit_consumer_backend_requests_in_flight",
+    "Requests currently running against each backend",
+    ["backend"],
+)
+BACKEND_CIRCUIT_STATE = Gauge(
+    "rabbit_consumer_backend_circuit_state",
+    "Circuit breaker state of each backend: 0 closed, 1 half open, 2 open",
+    ["backend"],
+)
+BACKEND_CIRCUIT_OPENED = Counter(
+    "rabbit_consumer_backend_circuit_opened_total",
+    "Times each backend's circuit breaker has opened",
+    ["backend"],
+)
+BACKEND_REQUESTS_REJECTED = Counter(
+    "rabbit_consumer_backend_requests_rejected_total",
+    "Requests failed without being sent, as the backend's circuit was open",
+    ["backend"],
+)
+
+_last_message_time = time.time()  # pylint: disable=invalid-name
+SECONDS_SINCE_LAST_MESSAGE = Gauge(
+    "rabbit_consumer_seconds_since_last_message",
+    "Seconds since a message was last received, or since the consumer started",
+)
+SECONDS_SINCE_LAST_MESSAGE.set_function(lambda: time.time() - _last_message_time)
+
+
+def message_received(event_type: str) -> None:
+    """
+    Records a message being received from RabbitMQ
+    """
+    global _last_message_time  # pylint: disable=global-statement
+    _last_message_time = time.time()
+    MESSAGES_CONSUMED.labels(event_type).inc()
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    """
+    Records whether a lookup was served from the given cache
+    """
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+@contextmanager
+def observe_stage(stage: str) -> Iterator[None]:
+    """
+    Records how long the block takes against the given stage
+    """
+    with STAGE_LATENCY.labels(stage).time():
+        yield
+
+
+def start_metrics_server(port: int) -> None:
+    """
+    Serves the metrics on /metrics on the given port, where 0 disables them
+    """
+    if not port:
+        logger.info("Metrics endpoint disabled")
+        return
+    start_http_server(port)
+    logger.info("Serving metrics on port %s", port)
@@ -5,12 +5,13 @@ This file deserializes a server's network address from an
 OpenStack API response
 """
 import logging
-import socket
 from dataclasses import dataclass, field
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from mashumaro import DataClassDictMixin, field_options
 
+from rabbit_consumer.dns_resolver import get_resolver
+
 logger = logging.getLogger(__name__)
 
 
@@ -28,43 +29,52 @@ class OpenstackAddress(DataClassDictMixin):
     hostname: Optional[str] = None
 
     @staticmethod
-    def get_internal_networks(addresses: Dict) -> list["OpenstackAddress"]:
+    def get_internal_networks(
+        addresses: Dict, resolve_hostnames: bool = True
+    ) -> list["OpenstackAddress"]:
         """
         Returns a list of internal network addresses. This
         is expected to be called from the OpenstackAPI. To get an actual
         list use the Openstack API wrapper directly.
         """
-        internal_networks = []
-        for address in addresses["Internal"]:
-            found = OpenstackAddress.from_dict(address)
-            found.hostname = OpenstackAddress.convert_hostnames(found.addr)
-            internal_networks.append(found)
-        return internal_networks
+        return OpenstackAddress._from_list(addresses["Internal"], resolve_hostnames)
 
     @staticmethod
-    def get_services_networks(addresses: Dict) -> list["OpenstackAddress"]:
+    def get_services_networks(
+        addresses: Dict, resolve_hostnames: bool = True
+    ) -> list["OpenstackAddress"]:
         """
         Returns a list of network addresses on the services subnet. This
         is expected to be called from the OpenstackAPI. To get an actual
         list use the Openstack API wrapper directly.
         """
-        services_networks = []
-        for address in addresses["Services"]:
-            found = OpenstackAddress.from_dict(address)
-            found.hostname = OpenstackAddress.convert_hostnames(found.addr)
-            services_networks.append(found)
-        return services_networks
+        return OpenstackAddress._from_list(addresses["Services"], resolve_hostnames)
+
+    @staticmethod
+    def _from_list(
+        addresses: List[Dict], resolve_hostnames: bool
+    ) -> list["OpenstackAddress"]:
+        """
+        Deserializes each address, optionally looking up their hostnames
+        """
+        found = [OpenstackAddress.from_dict(address) for address in addresses]
+        if resolve_hostnames:
+            OpenstackAddress.resolve_hostnames(found)
+        return found
+
+    @staticmethod
+    def resolve_hostnames(addresses: List["OpenstackAddress"]) -> None:
+        """
+        Looks up the hostname of each address, which are resolved
+        concurrently for servers with several addresses
+        """
+        hostnames = get_resolver().reverse_many([i.addr for i in addresses])
+        for address, hostname in zip(addresses, hostnames):
+            address.hostname = hostname
 
     @staticmethod
     def convert_hostnames(ip_addr: str) -> str:
         """
-        Converts an ip address to a hostname using DNS lookup.
+        Converts an ip address to a hostname using a cached DNS lookup.
         """
-        try:
-            return socket.gethostbyaddr(ip_addr)[0]
-        except socket.herror:
-            logger.info("No hostname found for ip %s", ip_addr)
-            raise
-        except Exception:
-            logger.error("Problem converting ip to hostname")
-            raise
+        return get_resolver().reverse(ip_addr)
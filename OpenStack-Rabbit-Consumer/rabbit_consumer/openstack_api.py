@@ -5,76 +5,258 @@ This file defines methods for connecting and interacting with the
 OpenStack API
 """
 import logging
-from typing import List, Optional
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional, Set
 
 import openstack
-from openstack.compute.v2.image import Image
+from openstack.connection import Connection
 from openstack.compute.v2.server import Server
+from openstack.exceptions import HttpException
 
-from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer import metrics
+from rabbit_consumer.backend_limiter import OPENSTACK, get_limiter
+from rabbit_consumer.consumer_config import get_config
+from rabbit_consumer.image_details import ImageDetails
 from rabbit_consumer.openstack_address import OpenstackAddress
+from rabbit_consumer.server_batcher import ServerBatcher
+from rabbit_consumer.ttl_cache import TtlLruCache
 from rabbit_consumer.vm_data import VmData
 
 logger = logging.getLogger(__name__)
 
 
+# Server records fetched whilst handling the current message, keyed by VM ID.
+# None is cached for servers which were not found.
+_server_cache: ContextVar[Optional[Dict[str, Optional[Server]]]] = ContextVar(
+    "server_cache", default=None
+)
+
+# Images fetched from Openstack, keyed by image ID. These rarely change, so
+# are shared between messages until they expire or are updated in Glance
+_image_cache: Optional[TtlLruCache] = None  # pylint: disable=invalid-name
+_image_cache_lock = threading.Lock()
+
+# Gathers server lookups from concurrent handlers into batched requests
+_server_batcher: Optional[ServerBatcher] = None  # pylint: disable=invalid-name
+_server_batcher_lock = threading.Lock()
+
+# Each worker thread holds its own connection, as the underlying
+# requests session is not safe to share between threads
+_thread_connections = threading.local()
+
+
+def _connect() -> Connection:
+    """
+    Creates a new authenticated connection to Openstack
+    """
+    logger.debug("Opening new Openstack connection")
+    config = get_config()
+    return openstack.connect(
+        auth_url=config.openstack_auth_url,
+        username=config.openstack_username,
+        password=config.openstack_password,
+        project_name="admin",
+        user_domain_name="Default",
+        project_domain_name="default",
+    )
+
+
+def reset_connection() -> None:
+    """
+    Closes and discards the current thread's Openstack connection,
+    so the next use re-authenticates from scratch
+    """
+    conn = getattr(_thread_connections, "conn", None)
+    _thread_connections.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:  # pylint: disable=broad-exception-caught
+            logger.debug("Ignoring error closing stale Openstack connection")
+
+
 class OpenstackConnection:
     """
     Wrapper for Openstack connection, to reduce boilerplate code
     in subsequent functions.
+
+    The connection is authenticated once per thread and re-used, Keystone
+    tokens are refreshed by the session as they expire. Connection and auth
+    errors raised whilst the connection is in use discard it, so the next
+    use reconnects. Requests Openstack rejected, such as for a server which
+    does not exist, keep it.
     """
 
     def __init__(self):
         self.conn = None
+        self._started: Optional[float] = None
 
-    def __enter__(self):
-        self.conn = openstack.connect(
-            auth_url=ConsumerConfig().openstack_auth_url,
-            username=ConsumerConfig().openstack_username,
-            password=ConsumerConfig().openstack_password,
-            project_name="admin",
-            user_domain_name="Default",
-            project_domain_name="default",
-        )
+    def __enter__(self) -> Connection:
+        limiter = get_limiter(OPENSTACK)
+        self._started = limiter.acquire()
+        try:
+            conn = getattr(_thread_connections, "conn", None)
+            if conn is None:
+                conn = _connect()
+                _thread_connections.conn = conn
+        except Exception as err:
+            limiter.release(self._started, failed=_is_backend_failure(err))
+            raise
+        self.conn = conn
         return self.conn
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.conn.close()
+        get_limiter(OPENSTACK).release(
+            self._started, failed=exc_val is not None and _is_backend_failure(exc_val)
+        )
+        if exc_val is not None and _needs_reconnect(exc_val):
+            logger.warning("Resetting Openstack connection after error: %s", exc_val)
+            reset_connection()
+
+
+def _is_backend_failure(err: BaseException) -> bool:
+    """
+    Returns whether an error suggests Openstack is unhealthy, rather
+    than rejecting a request such as for a server which does not exist
+    """
+    if isinstance(err, HttpException) and err.status_code:
+        return err.status_code >= 500
+    return True
+
+
+def _needs_reconnect(err: BaseException) -> bool:
+    """
+    Returns whether an error means the connection may be broken or its
+    token rejected, so it should be replaced rather than re-used
+    """
+    if isinstance(err, HttpException) and err.status_code == 401:
+        return True
+    return _is_backend_failure(err)
+
+
+@contextmanager
+def server_cache(cache: Optional[Dict[str, Optional[Server]]] = None) -> Iterator[None]:
+    """
+    Caches server lookups for the duration of the block, so handling
+    a single message fetches each server record from Nova at most once.
+    A message handled over several blocks can pass the same dict to each.
+    """
+    token = _server_cache.set({} if cache is None else cache)
+    try:
+        yield
+    finally:
+        _server_cache.reset(token)
+
+
+def _find_server(vm_data: VmData) -> Optional[Server]:
+    """
+    Looks up the server with details included, returning None if it does
+    not exist. Results are served from the active server_cache if any.
+    """
+    cache = _server_cache.get()
+    if cache is not None and vm_data.virtual_machine_id in cache:
+        return cache[vm_data.virtual_machine_id]
+
+    server = get_server_batcher().find(vm_data.virtual_machine_id)
+
+    if cache is not None:
+        cache[vm_data.virtual_machine_id] = server
+    return server
+
+
+def _fetch_server(server_id: str) -> Optional[Server]:
+    """
+    Fetches a single server with details included from Nova
+    """
+    with metrics.observe_stage("openstack_server"), OpenstackConnection() as conn:
+        # Workaround for details missing from find_server
+        # on the current version of openstacksdk
+        found = list(conn.compute.servers(uuid=server_id, all_projects=True))
+    return found[0] if found else None
+
+
+def _fetch_servers(server_ids: Set[str]) -> Dict[str, Server]:
+    """
+    Fetches the given servers with one listing of every server changed
+    recently, as Nova cannot filter by several IDs. Servers which were
+    deleted or changed before the lookback are left out.
+    """
+    lookback = timedelta(seconds=get_config().openstack_batch_lookback_seconds)
+    changes_since = (datetime.now(timezone.utc) - lookback).isoformat()
+    with metrics.observe_stage("openstack_servers"), OpenstackConnection() as conn:
+        return {
+            server.id: server
+            for server in conn.compute.servers(
+                all_projects=True, changes_since=changes_since
+            )
+            if server.id in server_ids and server.status != "DELETED"
+        }
+
+
+def get_server_batcher() -> ServerBatcher:
+    """
+    Returns the server batcher, creating it from the config on first use
+    """
+    global _server_batcher  # pylint: disable=global-statement
+    with _server_batcher_lock:
+        if _server_batcher is None:
+            config = get_config()
+            _server_batcher = ServerBatcher(
+                _fetch_server,
+                _fetch_servers,
+                window_seconds=config.openstack_batch_seconds,
+                max_batch=config.openstack_batch_size,
+            )
+        return _server_batcher
+
+
+def reset_server_batcher() -> None:
+    """
+    Discards the server batcher, so the next lookup
+    creates a new one from the current config
+    """
+    global _server_batcher  # pylint: disable=global-statement
+    with _server_batcher_lock:
+        _server_batcher = None
 
 
 def check_machine_exists(vm_data: VmData) -> bool:
     """
     Checks to see if the machine exists in Openstack.
     """
-    with OpenstackConnection() as conn:
-        return bool(conn.compute.find_server(vm_data.virtual_machine_id))
+    return _find_server(vm_data) is not None
 
 
 def get_server_details(vm_data: VmData) -> Server:
     """
     Gets the server details from Openstack with details included
     """
-    with OpenstackConnection() as conn:
-        # Workaround for details missing from find_server
-        # on the current version of openstacksdk
-        found = list(
-            conn.compute.servers(uuid=vm_data.virtual_machine_id, all_projects=True)
-        )
-        if not found:
-            raise ValueError(f"Server not found for id: {vm_data.virtual_machine_id}")
-        return found[0]
+    server = _find_server(vm_data)
+    if not server:
+        raise ValueError(f"Server not found for id: {vm_data.virtual_machine_id}")
+    return server
 
 
-def get_server_networks(vm_data: VmData) -> List[OpenstackAddress]:
+def get_server_networks(
+    vm_data: VmData, resolve_hostnames: bool = True
+) -> List[OpenstackAddress]:
     """
     Gets the networks from Openstack for the virtual machine as a list
-    of deserialized OpenstackAddresses.
+    of deserialized OpenstackAddresses. Their hostnames can be looked up
+    later with OpenstackAddress.resolve_hostnames instead.
     """
     server = get_server_details(vm_data)
     if "Internal" in server.addresses:
-        return OpenstackAddress.get_internal_networks(server.addresses)
+        return OpenstackAddress.get_internal_networks(
+            server.addresses, resolve_hostnames
+        )
     if "Services" in server.addresses:
-        return OpenstackAddress.get_services_networks(server.addresses)
+        return OpenstackAddress.get_services_networks(
+            server.addresses, resolve_hostnames
+        )
     logger.warning("No internal or services network found for server %s", server.name)
     return []
 
@@ -87,26 +269,69 @@ def get_server_metadata(vm_data: VmData) -> dict:
     return server.metadata
 
 
-def get_image(vm_data: VmData) -> Optional[Image]:
+def get_image_cache() -> TtlLruCache:
     """
-    Gets the image name from Openstack for the virtual machine.
+    Returns the image cache, creating it from the config on first use
+    """
+    global _image_cache  # pylint: disable=global-statement
+    with _image_cache_lock:
+        if _image_cache is None:
+            config = get_config()
+            _image_cache = TtlLruCache(
+                config.openstack_image_cache_size, config.openstack_image_cache_ttl
+            )
+        return _image_cache
+
+
+def reset_image_cache() -> None:
+    """
+    Discards the image cache, so the next lookup
+    creates a new one from the current config
+    """
+    global _image_cache  # pylint: disable=global-statement
+    with _image_cache_lock:
+        _image_cache = None
+
+
+def invalidate_image_cache(image_id: str) -> None:
+    """
+    Drops a cached image, so it is fetched again on next use
+    """
+    logger.debug("Invalidating cached image %s", image_id)
+    get_image_cache().invalidate(image_id)
+
+
+def get_image(vm_data: VmData) -> Optional[ImageDetails]:
+    """
+    Gets the image details from Openstack for the virtual machine.
     """
     server = get_server_details(vm_data)
     uuid = server.image.id
     if not uuid:
         return None
 
-    with OpenstackConnection() as conn:
+    cache = get_image_cache()
+    found, details = cache.get(uuid)
+    metrics.cache_lookup("image", found)
+    if found:
+        return details
+
+    with metrics.observe_stage("openstack_image"), OpenstackConnection() as conn:
         image = conn.compute.find_image(uuid)
-        return image
+    details = ImageDetails.from_image(image) if image else None
+    cache.put(uuid, details)
+    return details
 
 
-def update_metadata(vm_data: VmData, metadata) -> None:
+def update_metadata(vm_data: VmData, metadata, server: Optional[Server] = None) -> None:
     """
-    Updates the metadata for the virtual machine.
+    Updates the metadata for the virtual machine. The server record is
+    looked up unless it is passed in, and a NotFoundException is raised
+    if the server has since been deleted.
     """
-    server = get_server_details(vm_data)
-    with OpenstackConnection() as conn:
+    if server is None:
+        server = get_server_details(vm_data)
+    with metrics.observe_stage("metadata_update"), OpenstackConnection() as conn:
         conn.compute.set_server_metadata(server, **metadata)
 
     logger.debug("Setting metadata successful")
@@ -0,0 +1,193 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file runs messages through a series of stages, each with its own
+workers and bounded queues, so a slow stage holds back the consumer
+rather than building an unbounded backlog
+"""
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+
+import rabbitpy
+
+from rabbit_consumer import metrics
+from rabbit_consumer.backend_limiter import run_when_available
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.retry_queue import RetryRouter
+from rabbit_consumer.worker_pool import BaseWorkerPool, partition
+
+logger = logging.getLogger(__name__)
+
+# Sentinel placed onto each stage queue to request a clean shutdown
+_STOP = object()
+
+
+@dataclass
+class PipelineJob:
+    """
+    A message as it passes through the stages, where each stage keeps
+    whatever later stages need in state
+    """
+
+    message: rabbitpy.Message
+    decoded: RabbitMessage
+    state: Any = None
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A step of the pipeline run by its own workers. The handler returns
+    False once the message needs no further stages.
+    """
+
+    name: str
+    handler: Callable[[PipelineJob], bool]
+    workers: int
+
+
+class StagedPipeline(BaseWorkerPool):
+    """
+    Passes decoded messages through each stage in turn. Every worker has a
+    queue holding up to queue_size messages, and messages are partitioned
+    by their instance ID at each stage, so all events for a given VM are
+    handled in the order they were received. Once a stage's queues fill,
+    the stage before it waits, and finally submit blocks the consuming
+    thread, leaving messages with RabbitMQ. Messages are acked once a
+    stage finishes them or they reach the end.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        queue_size: int,
+        coalescer: Optional[CreateDeleteCoalescer] = None,
+        retry_router: Optional[RetryRouter] = None,
+        ack_batch_size: int = 1,
+    ) -> None:
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        if queue_size < 1:
+            raise ValueError(f"Queue size must be at least 1, got {queue_size}")
+        for stage in stages:
+            if stage.workers < 1:
+                raise ValueError(
+                    f"Stage {stage.name} needs at least 1 worker, got {stage.workers}"
+                )
+
+        super().__init__(coalescer, retry_router, ack_batch_size)
+        self._stages = stages
+        self._queue_size = queue_size
+        self._queues: List[List[queue.Queue]] = [
+            [queue.Queue(maxsize=queue_size) for _ in range(stage.workers)]
+            for stage in stages
+        ]
+        self._threads: List[List[threading.Thread]] = [
+            [
+                threading.Thread(
+                    target=self._worker_loop,
+                    args=(index, work_queue),
+                    name=f"pipeline-{stage.name}-{worker}",
+                    daemon=True,
+                )
+                for worker, work_queue in enumerate(queues)
+            ]
+            for index, (stage, queues) in enumerate(zip(stages, self._queues))
+        ]
+        for stage, queues in zip(stages, self._queues):
+            metrics.PIPELINE_QUEUE_DEPTH.labels(stage.name).set_function(
+                lambda queues=queues: sum(q.qsize() for q in queues)
+            )
+
+    @property
+    def prefetch_count(self) -> int:
+        """
+        The number of messages the stages can hold, including those being
+        handled, so RabbitMQ keeps the rest once the pipeline is full
+        """
+        return sum(stage.workers * (self._queue_size + 1) for stage in self._stages)
+
+    def depth(self, stage: str) -> int:
+        """
+        Returns the number of messages waiting for the given stage
+        """
+        index = [s.name for s in self._stages].index(stage)
+        return sum(work_queue.qsize() for work_queue in self._queues[index])
+
+    def start(self) -> None:
+        """
+        Starts the workers of every stage
+        """
+        logger.debug(
+            "Starting pipeline stages: %s",
+            ", ".join(f"{s.name} ({s.workers})" for s in self._stages),
+        )
+        for threads in self._threads:
+            for thread in threads:
+                thread.start()
+
+    def shutdown(self) -> None:
+        """
+        Waits for all queued messages to pass through every stage, then
+        stops the workers. Each stage is stopped once the stage before it
+        has, so no messages are left part way through.
+        """
+        for queues, threads in zip(self._queues, self._threads):
+            for work_queue in queues:
+                work_queue.put(_STOP)
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+        logger.debug("All pipeline stages stopped")
+
+    def _enqueue(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Queues the message onto the first stage, waiting whilst it is full
+        """
+        self._put(0, PipelineJob(message, decoded))
+
+    def _put(self, index: int, job: PipelineJob) -> None:
+        """
+        Queues the job onto the worker of the given stage owning its instance ID
+        """
+        queues = self._queues[index]
+        worker = partition(job.decoded.payload.instance_id, len(queues))
+        queues[worker].put(job)
+
+    def _worker_loop(self, index: int, work_queue: queue.Queue) -> None:
+        """
+        Runs a single stage's messages from one partition until asked to stop
+        """
+        while True:
+            job = work_queue.get()
+            if job is _STOP:
+                return
+
+            if self._run_stage(index, job):
+                self._put(index + 1, job)
+            else:
+                metrics.MESSAGES_IN_FLIGHT.dec()
+
+    def _run_stage(self, index: int, job: PipelineJob) -> bool:
+        """
+        Runs a stage for the job, returning True if it should be passed on
+        to the next stage. Otherwise it has been acked, or failed and
+        moved onto the retry queues.
+        """
+        if index == 0 and not self._claim(job.message, job.decoded):
+            return False
+
+        try:
+            proceed = run_when_available(self._stages[index].handler, job)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            self._fail(job.message, job.decoded, err)
+            return False
+
+        if proceed and index + 1 < len(self._stages):
+            return True
+        self._complete(job.message, job.decoded)
+        return False
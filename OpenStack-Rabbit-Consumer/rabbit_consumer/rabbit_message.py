@@ -58,3 +58,5 @@ class RabbitMessage(DataClassJSONMixin):
     project_id: str = field(metadata=field_options(alias="_context_project_id"))
     user_name: str = field(metadata=field_options(alias="_context_user_name"))
     payload: RabbitPayload
+    # Identifies the notification, so it is the same when redelivered
+    message_id: Optional[str] = None
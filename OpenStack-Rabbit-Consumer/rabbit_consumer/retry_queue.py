@@ -0,0 +1,177 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file moves messages which failed to be handled onto delayed
+retry queues, and finally a dead-letter queue, so a single bad
+message does not stop the rest of the stream
+"""
+import logging
+from typing import Dict, Optional, Tuple
+
+import rabbitpy
+
+from rabbit_consumer import metrics
+
+logger = logging.getLogger(__name__)
+
+# Headers added to messages we republish
+ATTEMPTS_HEADER = "x-consumer-attempts"
+ERROR_HEADER = "x-consumer-error"
+
+# Keeps the error attached to dead-lettered messages to a sensible size
+_MAX_ERROR_LENGTH = 1000
+
+
+class RetryRouter:
+    """
+    Republishes failed messages onto retry queues, which hold them for
+    an exponentially increasing delay before RabbitMQ dead-letters them
+    back onto the consumed queue. Each delay has its own queue, as
+    RabbitMQ only expires messages from the head of a queue. Once
+    max_attempts have failed, the message is parked on the dead-letter
+    queue with the error attached.
+
+    The router publishes on a channel with publisher confirms enabled,
+    so the original message is only acked once RabbitMQ has taken its
+    copy, and callers must serialise access to it. Consumers publishing
+    with another client pass no channel, and publish what prepare
+    returns themselves.
+    """
+
+    def __init__(
+        self,
+        channel: Optional[rabbitpy.Channel],
+        queue_name: str,
+        max_attempts: int,
+        retry_seconds: float,
+    ):
+        if max_attempts < 1:
+            raise ValueError(f"Max attempts must be at least 1, got {max_attempts}")
+        self._channel = channel
+        self._queue_name = queue_name
+        self._max_attempts = max_attempts
+        self._retry_seconds = retry_seconds
+
+    @property
+    def dead_letter_queue(self) -> str:
+        """
+        The name of the queue holding messages which will not be retried
+        """
+        return f"{self._queue_name}.dead"
+
+    def retry_delay_ms(self, attempt: int) -> int:
+        """
+        Returns how long to hold a message after its given failed attempt
+        """
+        return int(self._retry_seconds * 1000 * 2 ** (attempt - 1))
+
+    def retry_queue(self, attempt: int) -> str:
+        """
+        Returns the queue holding messages after their given failed attempt.
+        The delay is part of the name, as RabbitMQ refuses to redeclare
+        an existing queue with a different TTL.
+        """
+        return f"{self._queue_name}.retry.{self.retry_delay_ms(attempt)}ms"
+
+    def retry_queue_arguments(self) -> Dict[str, Dict]:
+        """
+        Returns the arguments to declare each retry queue with, keyed by name
+        """
+        return {
+            self.retry_queue(attempt): {
+                # Set directly, as rabbitpy drops a TTL of 0 and the default exchange
+                "x-message-ttl": self.retry_delay_ms(attempt),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self._queue_name,
+            }
+            for attempt in range(1, self._max_attempts)
+        }
+
+    def declare(self) -> None:
+        """
+        Declares the retry and dead-letter queues, which are durable
+        like the consumed queue
+        """
+        for name, arguments in self.retry_queue_arguments().items():
+            logger.debug("Declaring retry queue: %s", name)
+            rabbitpy.Queue(
+                self._channel, name=name, durable=True, arguments=arguments
+            ).declare()
+
+        logger.debug("Declaring dead-letter queue: %s", self.dead_letter_queue)
+        rabbitpy.Queue(
+            self._channel, name=self.dead_letter_queue, durable=True
+        ).declare()
+
+    @staticmethod
+    def attempts(message: rabbitpy.Message) -> int:
+        """
+        Returns how many times the message has already failed
+        """
+        headers = message.properties.get("headers") or {}
+        return int(headers.get(ATTEMPTS_HEADER, 0))
+
+    def route(
+        self,
+        message: rabbitpy.Message,
+        error: Exception,
+        event_type: str,
+        retry: bool = True,
+    ) -> str:
+        """
+        Republishes the failed message onto its next retry queue, or the
+        dead-letter queue if it has no attempts left or retry is False.
+        Returns the name of the queue used once RabbitMQ has confirmed it,
+        or raises a RuntimeError if it did not. The original message must
+        still be acked by the caller.
+        """
+        destination, properties = self.prepare(message, error, event_type, retry)
+        published = rabbitpy.Message(
+            self._channel, message.body, properties=properties
+        ).publish("", routing_key=destination)
+        if not published:
+            raise RuntimeError(f"RabbitMQ did not confirm the message on {destination}")
+        return destination
+
+    def prepare(
+        self,
+        message: rabbitpy.Message,
+        error: Exception,
+        event_type: str,
+        retry: bool = True,
+    ) -> Tuple[str, Dict]:
+        """
+        Chooses the queue a failed message should be republished onto,
+        returning it with the properties to publish the message with
+        """
+        attempt = self.attempts(message) + 1
+        if retry and attempt < self._max_attempts:
+            destination = self.retry_queue(attempt)
+            logger.warning(
+                "Retrying message in %.0fs after attempt %s failed: %s",
+                self.retry_delay_ms(attempt) / 1000,
+                attempt,
+                error,
+            )
+            metrics.MESSAGES_RETRIED.labels(event_type).inc()
+        else:
+            destination = self.dead_letter_queue
+            logger.error("Dead-lettering message after %s attempts: %s", attempt, error)
+            metrics.MESSAGES_DEAD_LETTERED.labels(event_type).inc()
+        return destination, self._failed_properties(message, error, attempt)
+
+    @staticmethod
+    def _failed_properties(
+        message: rabbitpy.Message, error: Exception, attempt: int
+    ) -> Dict:
+        """
+        Copies the message properties, recording the failed attempt
+        """
+        properties = dict(message.properties)
+        headers = dict(properties.get("headers") or {})
+        headers[ATTEMPTS_HEADER] = attempt
+        headers[ERROR_HEADER] = f"{type(error).__name__}: {error}"[:_MAX_ERROR_LENGTH]
+        properties["headers"] = headers
+        # Persistent, so failed messages survive a broker restart
+        properties["delivery_mode"] = 2
+        return properties
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file gathers server lookups made at around the same time into a
+single Nova request, so a burst of creates does not look up each VM
+one at a time
+"""
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from openstack.compute.v2.server import Server
+
+from rabbit_consumer import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# pylint: disable=too-few-public-methods
+class _Batch:
+    """
+    Server IDs waiting on the same request, and its outcome once made
+    """
+
+    def __init__(self) -> None:
+        self.server_ids: Set[str] = set()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.servers: Dict[str, Optional[Server]] = {}
+        self.error: Optional[Exception] = None
+
+
+class ServerBatcher:
+    """
+    Looks up servers by ID, holding the first lookup for window_seconds
+    so lookups from other threads can join it. A lookup made whilst no
+    others are in flight has nothing to wait for, so is fetched straight
+    away. The thread which started the batch fetches every server in it
+    with one request, then hands each waiting thread its result. Servers
+    missing from the batched request, such as those changed before it
+    looks back to, are fetched individually. A window of 0 fetches every
+    server individually.
+    """
+
+    def __init__(
+        self,
+        fetch_one: Callable[[str], Optional[Server]],
+        fetch_many: Callable[[Set[str]], Dict[str, Server]],
+        window_seconds: float,
+        max_batch: int,
+    ):
+        if max_batch < 1:
+            raise ValueError(f"Batch size must be at least 1, got {max_batch}")
+        self._fetch_one = fetch_one
+        self._fetch_many = fetch_many
+        self._window_seconds = window_seconds
+        self._max_batch = max_batch
+        self._lock = threading.Lock()
+        self._pending: Optional[_Batch] = None
+        # Lookups waiting on a batch or being fetched
+        self._in_flight = 0
+
+    def find(self, server_id: str) -> Optional[Server]:
+        """
+        Returns the server with the given ID, or None if it does not
+        exist. Raises the error of the request made for it, if any.
+        """
+        if not self._window_seconds:
+            return self._fetch_one(server_id)
+
+        with self._lock:
+            self._in_flight += 1
+            batch = self._pending
+            leader = batch is None
+            if leader:
+                batch = self._pending = _Batch()
+            batch.server_ids.add(server_id)
+            if len(batch.server_ids) >= self._max_batch or self._in_flight == 1:
+                # Later lookups start a new batch rather than joining this one
+                self._pending = None
+                batch.full.set()
+
+        try:
+            if leader:
+                batch.full.wait(self._window_seconds)
+                with self._lock:
+                    if self._pending is batch:
+                        self._pending = None
+                self._fetch(batch)
+            else:
+                batch.done.wait()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+        if batch.error:
+            raise batch.error
+        return batch.servers[server_id]
+
+    def _fetch(self, batch: _Batch) -> None:
+        """
+        Fetches every server in the batch, then wakes the threads waiting on it
+        """
+        try:
+            if len(batch.server_ids) == 1:
+                (server_id,) = batch.server_ids
+                batch.servers[server_id] = self._fetch_one(server_id)
+            else:
+                metrics.OPENSTACK_BATCH_SIZE.observe(len(batch.server_ids))
+                batch.servers.update(self._fetch_many(batch.server_ids))
+                self._fetch_missing(batch, batch.server_ids - batch.servers.keys())
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            batch.error = err
+        finally:
+            batch.done.set()
+
+    def _fetch_missing(self, batch: _Batch, server_ids: Iterable[str]) -> None:
+        """
+        Fetches servers the batched request did not return one at a time
+        """
+        for server_id in server_ids:
+            logger.debug("Server %s missing from batched lookup", server_id)
+            batch.servers[server_id] = self._fetch_one(server_id)
@@ -0,0 +1,230 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file spreads VM messages over a fixed number of shard queues by
+instance ID, so several consumer replicas can each own some of the
+shards whilst messages for a given VM stay in order
+"""
+import logging
+import queue
+import re
+import socket
+import threading
+import zlib
+from typing import Callable, Collection, Dict, List, Optional
+
+import rabbitpy
+
+from rabbit_consumer import metrics
+from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.message_filter import json_loads, peek_event_type
+
+logger = logging.getLogger(__name__)
+
+# Direct exchange routing each message to its shard queue by shard number
+SHARD_EXCHANGE = "ral.info.shards"
+
+# Every shard queue is also bound with this key, so messages each replica
+# must see, such as image updates, reach all of them with one publish
+BROADCAST_ROUTING_KEY = "all"
+
+# Only one consumer receives from each shard queue at a time, so a shard
+# claimed by two replicas whilst they are rolled is still handled in order
+_SHARD_QUEUE_ARGUMENTS = {"x-single-active-consumer": True}
+
+# StatefulSet pods are named after the set, followed by their ordinal
+_ORDINAL_PATTERN = re.compile(r"-(\d+)$")
+
+
+def shard_queue(shard: int) -> str:
+    """
+    Returns the name of the queue holding the given shard
+    """
+    return f"ral.info.shard.{shard}"
+
+
+def shard_for(instance_id: str, shard_count: int) -> int:
+    """
+    Returns the shard holding messages for the given instance ID.
+    This is stable between runs and replicas, unlike the built-in hash.
+    """
+    return zlib.crc32(instance_id.encode("utf-8")) % shard_count
+
+
+def owned_shards(shard_count: int, replica_count: int, replica_index: int) -> List[int]:
+    """
+    Returns the shards consumed by the given replica, dealing them out
+    in turn so every shard has exactly one owner
+    """
+    return list(range(replica_index, shard_count, replica_count))
+
+
+def get_replica_index(config: ConsumerConfig, hostname: Optional[str] = None) -> int:
+    """
+    Returns the index of this replica, which is CONSUMER_REPLICA_INDEX if
+    set, or otherwise the ordinal at the end of the StatefulSet pod's name.
+    Raises a ValueError if neither gives a valid index.
+    """
+    if config.consumer_replica_index >= 0:
+        return config.consumer_replica_index
+    if config.consumer_replicas == 1:
+        return 0
+
+    hostname = hostname or socket.gethostname()
+    match = _ORDINAL_PATTERN.search(hostname)
+    if not match:
+        raise ValueError(
+            f"Cannot find a replica index in hostname {hostname}, "
+            "set CONSUMER_REPLICA_INDEX instead"
+        )
+    index = int(match.group(1))
+    if index >= config.consumer_replicas:
+        raise ValueError(
+            f"Replica index {index} is not below "
+            f"CONSUMER_REPLICAS ({config.consumer_replicas})"
+        )
+    return index
+
+
+def declare_shards(channel: rabbitpy.Channel, shard_count: int) -> None:
+    """
+    Declares the shard exchange, and a durable queue bound to it for each
+    shard by its shard number and the broadcast key
+    """
+    exchange = rabbitpy.DirectExchange(channel, SHARD_EXCHANGE, durable=True)
+    exchange.declare()
+    for shard in range(shard_count):
+        logger.debug("Declaring shard queue: %s", shard_queue(shard))
+        shard_q = rabbitpy.Queue(
+            channel,
+            name=shard_queue(shard),
+            durable=True,
+            arguments=dict(_SHARD_QUEUE_ARGUMENTS),
+        )
+        shard_q.declare()
+        shard_q.bind(exchange, routing_key=str(shard))
+        shard_q.bind(exchange, routing_key=BROADCAST_ROUTING_KEY)
+
+
+class ShardRouter:
+    """
+    Forwards messages from ral.info onto the shard queue for their instance
+    ID. Only the given event types are forwarded, and the broadcast types
+    are copied onto every shard, so each replica sees them. Other messages
+    do not depend on ordering and are left for the caller to handle directly.
+
+    The router publishes on its own channel, which must have publisher
+    confirms enabled so messages are only acked once RabbitMQ holds
+    their copy, and it must only be used from a single thread.
+    """
+
+    def __init__(
+        self,
+        channel: rabbitpy.Channel,
+        shard_count: int,
+        event_types: Collection[str],
+        broadcast_types: Collection[str] = (),
+    ):
+        if shard_count < 1:
+            raise ValueError(f"Shard count must be at least 1, got {shard_count}")
+        self._channel = channel
+        self._shard_count = shard_count
+        self._event_types = frozenset(event_types)
+        self._broadcast_types = frozenset(broadcast_types)
+
+    def shard_key(self, raw_body: bytes) -> Optional[str]:
+        """
+        Returns the instance ID of a message which should be forwarded,
+        or None if it should be handled directly
+        """
+        event_type = peek_event_type(raw_body)
+        if event_type is not None and event_type not in self._event_types:
+            return None
+
+        try:
+            body = json_loads(json_loads(raw_body)["oslo.message"])
+        except Exception:  # pylint: disable=broad-exception-caught
+            # Handled directly, which dead-letters it
+            return None
+        if body.get("event_type") not in self._event_types:
+            return None
+        return (body.get("payload") or {}).get("instance_id")
+
+    def forward(self, message: rabbitpy.Message) -> Optional[int]:
+        """
+        Publishes the message onto its shard queue, returning the shard used,
+        or None if the message was not forwarded. Raises a RuntimeError if
+        RabbitMQ did not confirm the copy. The original message must still
+        be acked by the caller.
+        """
+        instance_id = self.shard_key(message.body)
+        if not instance_id:
+            return None
+
+        shard = shard_for(instance_id, self._shard_count)
+        self._publish(message, str(shard))
+        logger.debug("Forwarded message for %s to shard %s", instance_id, shard)
+        metrics.MESSAGES_SHARDED.labels(str(shard)).inc()
+        return shard
+
+    def broadcast(self, message: rabbitpy.Message) -> bool:
+        """
+        Publishes the message onto every shard queue if it is one of the
+        broadcast types, returning whether it was. A replica owning several
+        shards receives a copy from each. The original message must still
+        be acked by the caller.
+        """
+        event_type = peek_event_type(message.body)
+        if event_type is None:
+            try:
+                body = json_loads(json_loads(message.body)["oslo.message"])
+                event_type = body.get("event_type")
+            except Exception:  # pylint: disable=broad-exception-caught
+                # Handled directly, which dead-letters it
+                return False
+        if event_type not in self._broadcast_types:
+            return False
+
+        self._publish(message, BROADCAST_ROUTING_KEY)
+        logger.debug("Broadcast %s message to every shard", event_type)
+        return True
+
+    def _publish(self, message: rabbitpy.Message, routing_key: str) -> None:
+        """
+        Publishes a persistent copy of the message onto the shard exchange,
+        raising a RuntimeError if RabbitMQ did not confirm it
+        """
+        properties = dict(message.properties)
+        # Persistent, as the shard queues are durable
+        properties["delivery_mode"] = 2
+        published = rabbitpy.Message(
+            self._channel, message.body, properties=properties
+        ).publish(SHARD_EXCHANGE, routing_key=routing_key)
+        if not published:
+            raise RuntimeError(
+                f"RabbitMQ did not confirm the message routed by {routing_key}"
+            )
+
+
+def consume_concurrently(loops: Dict[str, Callable[[], None]]) -> None:
+    """
+    Runs each consuming loop on its own named thread, returning once any
+    of them stops and raising its error if it failed. The remaining
+    threads are daemons, which stop when their connection is closed.
+    """
+    stopped: queue.Queue = queue.Queue()
+
+    def run(loop: Callable[[], None]) -> None:
+        try:
+            loop()
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            stopped.put(err)
+            return
+        stopped.put(None)
+
+    for name, loop in loops.items():
+        threading.Thread(target=run, args=(loop,), name=name, daemon=True).start()
+
+    error = stopped.get()
+    if error:
+        raise error
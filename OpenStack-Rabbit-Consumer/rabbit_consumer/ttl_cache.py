@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file provides a thread-safe, size bounded cache where
+each entry expires after its own time to live
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """
+    A snapshot of the hit and miss counts of a cache
+    """
+
+    hits: int
+    misses: int
+    size: int
+
+    @property
+    def hit_rate(self) -> float:
+        """
+        Returns the fraction of lookups served from the cache
+        """
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class TtlLruCache(Generic[V]):
+    """
+    Least recently used cache where entries also expire after a TTL.
+    Expired entries are dropped when next looked up, or evicted
+    as the least recently used once the cache is full.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Returns a tuple of whether the key was found, and its value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > self._clock():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return True, value
+                del self._entries[key]
+            self._misses += 1
+            return False, None
+
+    def put(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """
+        Stores a value, using the cache's TTL unless one is given
+        """
+        ttl = self._ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Removes a key from the cache if present
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes every entry from the cache
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> CacheStats:
+        """
+        Returns the current hit and miss counts
+        """
+        with self._lock:
+            return CacheStats(
+                hits=self._hits, misses=self._misses, size=len(self._entries)
+            )
@@ -0,0 +1,356 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+This file provides a pool of workers which process rabbit messages
+concurrently, whilst keeping messages for the same VM in order
+"""
+import abc
+import logging
+import queue
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional
+
+import rabbitpy
+
+from rabbit_consumer import metrics
+from rabbit_consumer.ack_batcher import Ack, AckBatcher
+from rabbit_consumer.backend_limiter import run_when_available
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.rabbit_message import RabbitMessage
+from rabbit_consumer.retry_queue import RetryRouter
+
+logger = logging.getLogger(__name__)
+
+# Sentinel placed onto each worker queue to request a clean shutdown
+_STOP = object()
+
+
+def partition(instance_id: str, worker_count: int) -> int:
+    """
+    Returns the index of the worker which handles the given instance ID.
+    This is stable between runs, unlike the built-in hash.
+    """
+    return zlib.crc32(instance_id.encode("utf-8")) % worker_count
+
+
+def record_failure(decoded: RabbitMessage, error: Exception) -> None:
+    """
+    Logs and counts a message which raised an error whilst being handled
+    """
+    logger.error(
+        "Failed to handle message for %s",
+        decoded.payload.instance_id,
+        exc_info=error,
+    )
+    metrics.MESSAGES_FAILED.labels(decoded.event_type).inc()
+
+
+class BaseWorkerPool(abc.ABC):
+    """
+    Acks, coalesces and retries messages handled on worker threads.
+    Subclasses queue submitted messages onto their workers, which call
+    _claim before handling a message, then _complete or _fail after.
+    If a coalescer is given, creates cancelled by a later message are
+    acked without being handled. If a retry router is given, failed
+    messages are moved onto it and acked, otherwise the first failure
+    stops the pool. With an ack_batch_size above 1, ignored messages are
+    acked in batches per channel, as described by AckBatcher.
+    """
+
+    def __init__(
+        self,
+        coalescer: Optional[CreateDeleteCoalescer] = None,
+        retry_router: Optional[RetryRouter] = None,
+        ack_batch_size: int = 1,
+    ) -> None:
+        if ack_batch_size < 1:
+            raise ValueError(f"Ack batch size must be at least 1, got {ack_batch_size}")
+        self._coalescer = coalescer
+        self._retry_router = retry_router
+        self._ack_batch_size = ack_batch_size
+        # Acks can come from the consuming thread or any worker
+        self._ack_lock = threading.Lock()
+        self._ack_batchers: Dict[rabbitpy.Channel, AckBatcher] = {}
+        self._error: Optional[Exception] = None
+
+    def __enter__(self) -> "BaseWorkerPool":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
+        # Held messages are only ignored again if redelivered, so
+        # there is no need to ack them if consuming failed
+        if exc_type is None:
+            self.flush_acks()
+
+    @property
+    def prefetch_count(self) -> int:
+        """
+        The number of un-acked messages RabbitMQ should deliver at once,
+        where 0 is unlimited
+        """
+        return 0
+
+    @abc.abstractmethod
+    def start(self) -> None:
+        """
+        Starts all worker threads
+        """
+
+    @abc.abstractmethod
+    def shutdown(self) -> None:
+        """
+        Waits for all queued messages to be handled, then stops the workers
+        """
+
+    def submit(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Queues a decoded message onto the worker owning its instance ID.
+        Raises the first handler error which could not be retried, so the
+        consumer stops and the un-acked message is redelivered.
+        """
+        if self._error:
+            raise self._error
+
+        if self._coalescer:
+            cancelled = self._coalescer.submitted(message, decoded)
+            if cancelled:
+                self.ack(cancelled)
+
+        metrics.MESSAGES_IN_FLIGHT.inc()
+        if self._ack_batch_size > 1:
+            with self._ack_lock:
+                self._ack_batcher(message).handed_on(message)
+        self._enqueue(message, decoded)
+
+    def ack(self, message: rabbitpy.Message) -> None:
+        """
+        Acks the given message, serialising access to the channel
+        """
+        with self._ack_lock:
+            self._send_acks([(message, False)])
+
+    def ignore(self, message: rabbitpy.Message) -> None:
+        """
+        Acks a message which needs no handling, which may be held
+        to be acked in a batch with others
+        """
+        if self._ack_batch_size == 1:
+            self.ack(message)
+            return
+        with self._ack_lock:
+            self._send_acks(self._ack_batcher(message).ignore(message))
+
+    def flush_acks(self) -> None:
+        """
+        Acks every ignored message still held
+        """
+        with self._ack_lock:
+            for batcher in self._ack_batchers.values():
+                self._send_acks(batcher.flush())
+
+    def reject(
+        self,
+        message: rabbitpy.Message,
+        error: Exception,
+        event_type: str,
+        retry: bool = True,
+    ) -> None:
+        """
+        Moves a failed message onto the retry router then acks it. Raises
+        the error if there is no router, or the message could not be moved,
+        leaving the message un-acked to be redelivered.
+        """
+        if not self._retry_router:
+            raise error
+
+        with self._ack_lock:
+            self._retry_router.route(message, error, event_type, retry=retry)
+            self._send_acks([(message, False)])
+
+    @abc.abstractmethod
+    def _enqueue(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Queues a message which has been counted as in flight
+        """
+
+    def _ack_batcher(self, message: rabbitpy.Message) -> AckBatcher:
+        """
+        Returns the batcher for the message's channel, as delivery tags are
+        per channel. Batches are kept within the channel's prefetch count,
+        as RabbitMQ stops delivering once that many messages are un-acked.
+        """
+        batcher = self._ack_batchers.get(message.channel)
+        if batcher is None:
+            batch_size = self._ack_batch_size
+            if self.prefetch_count:
+                batch_size = min(batch_size, self.prefetch_count)
+            batcher = self._ack_batchers[message.channel] = AckBatcher(batch_size)
+        return batcher
+
+    def _send_acks(self, acks: List[Ack]) -> None:
+        """
+        Sends each ack, which must be called with the ack lock held
+        """
+        for message, multiple in acks:
+            message.ack(all_previous=multiple)
+            metrics.ACKS_SENT.labels("batch" if multiple else "single").inc()
+            if not multiple and self._ack_batch_size > 1:
+                self._ack_batcher(message).settled(message)
+
+    def _claim(self, message: rabbitpy.Message, decoded: RabbitMessage) -> bool:
+        """
+        Waits out the coalescing period of a create, returning False if
+        the message was cancelled and should not be handled
+        """
+        if self._coalescer and not self._coalescer.claim(message, decoded):
+            # Already acked when it was cancelled
+            metrics.MESSAGES_IGNORED.labels(decoded.event_type).inc()
+            return False
+        return True
+
+    def _complete(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Acks a message which has been handled successfully
+        """
+        self.ack(message)
+        metrics.MESSAGES_ACKED.labels(decoded.event_type).inc()
+
+    def _fail(
+        self, message: rabbitpy.Message, decoded: RabbitMessage, error: Exception
+    ) -> None:
+        """
+        Retries a message which failed to be handled, or otherwise
+        records the first error to stop the pool
+        """
+        record_failure(decoded, error)
+        try:
+            self.reject(message, error, decoded.event_type)
+        except Exception as reject_err:  # pylint: disable=broad-exception-caught
+            if reject_err is not error:
+                logger.exception("Failed to move message onto a retry queue")
+            if not self._error:
+                self._error = error
+
+
+class MessageWorkerPool(BaseWorkerPool):
+    """
+    Dispatches decoded messages onto a fixed number of worker threads.
+    Messages are partitioned by their instance ID, so all events for a given
+    VM are handled by a single worker in the order they were received.
+    Each worker queues up to queue_size messages, after which submit blocks
+    the consuming thread, leaving messages with RabbitMQ. Messages are only
+    acked once the handler has completed.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        worker_count: int,
+        handler: Callable[[RabbitMessage], None],
+        coalescer: Optional[CreateDeleteCoalescer] = None,
+        retry_router: Optional[RetryRouter] = None,
+        ack_batch_size: int = 1,
+        *,
+        queue_size: int = 10,
+    ) -> None:
+        if worker_count < 1:
+            raise ValueError(f"Worker count must be at least 1, got {worker_count}")
+        if queue_size < 1:
+            raise ValueError(f"Queue size must be at least 1, got {queue_size}")
+
+        super().__init__(coalescer, retry_router, ack_batch_size)
+        self._handler = handler
+        self._queue_size = queue_size
+        self._queues: List[queue.Queue] = [
+            queue.Queue(maxsize=queue_size) for _ in range(worker_count)
+        ]
+        self._threads = [
+            threading.Thread(
+                target=self._worker_loop,
+                args=(work_queue,),
+                name=f"consumer-worker-{i}",
+                daemon=True,
+            )
+            for i, work_queue in enumerate(self._queues)
+        ]
+
+    @property
+    def worker_count(self) -> int:
+        """
+        The number of workers in the pool
+        """
+        return len(self._queues)
+
+    @property
+    def prefetch_count(self) -> int:
+        """
+        The number of messages the workers can hold, including those being
+        handled, so RabbitMQ keeps the rest once every queue is full
+        """
+        return self.worker_count * (self._queue_size + 1)
+
+    def start(self) -> None:
+        """
+        Starts all worker threads
+        """
+        logger.debug("Starting %s message workers", self.worker_count)
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self) -> None:
+        """
+        Waits for all queued messages to be handled, then stops the workers
+        """
+        for work_queue in self._queues:
+            work_queue.put(_STOP)
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
+        logger.debug("All message workers stopped")
+
+    def partition(self, instance_id: str) -> int:
+        """
+        Returns the index of the worker which handles the given instance ID.
+        This is stable between runs, unlike the built-in hash.
+        """
+        return partition(instance_id, self.worker_count)
+
+    def _enqueue(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Queues the message onto the worker owning its instance ID
+        """
+        worker = self.partition(decoded.payload.instance_id)
+        self._queues[worker].put((message, decoded))
+
+    def _worker_loop(self, work_queue: queue.Queue) -> None:
+        """
+        Handles messages from a single partition until asked to stop
+        """
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                return
+
+            message, decoded = item
+            try:
+                self._handle(message, decoded)
+            finally:
+                metrics.MESSAGES_IN_FLIGHT.dec()
+
+    def _handle(self, message: rabbitpy.Message, decoded: RabbitMessage) -> None:
+        """
+        Handles then acks a single message, retrying it if it fails or
+        otherwise recording the first error
+        """
+        if not self._claim(message, decoded):
+            return
+
+        try:
+            run_when_available(self._handler, decoded)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            self._fail(message, decoded, err)
+            return
+        self._complete(message, decoded)
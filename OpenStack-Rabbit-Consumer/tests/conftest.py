@@ -3,16 +3,73 @@
 """
 Fixtures for unit tests, used to create mock objects
 """
+import json
 import uuid
+from typing import Callable, Dict, Optional
 
 import pytest
 
+from rabbit_consumer import backend_limiter, dns_resolver, openstack_api
 from rabbit_consumer.aq_metadata import AqMetadata
 from rabbit_consumer.openstack_address import OpenstackAddress
 from rabbit_consumer.rabbit_message import RabbitMessage, RabbitMeta, RabbitPayload
+from rabbit_consumer.server_batcher import ServerBatcher
 from rabbit_consumer.vm_data import VmData
 
 
+@pytest.fixture(name="resolver", autouse=True)
+def fixture_resolver():
+    """
+    Provides each test with an empty DNS cache, so
+    lookups are not shared between tests
+    """
+    resolver = dns_resolver.DnsResolver(
+        cache_size=16, positive_ttl=300, negative_ttl=30, lookup_workers=4
+    )
+    dns_resolver._resolver = resolver  # pylint: disable=protected-access
+    yield resolver
+    dns_resolver.reset_resolver()
+
+
+@pytest.fixture(name="limiters", autouse=True)
+def fixture_limiters():
+    """
+    Provides each test with backend limiters which never open their circuit,
+    so failures in one test do not hold requests in the next
+    """
+    # pylint: disable=protected-access
+    for backend in (backend_limiter.AQ, backend_limiter.OPENSTACK):
+        backend_limiter._limiters[backend] = backend_limiter.BackendLimiter(
+            backend,
+            min_limit=1,
+            max_limit=100,
+            slow_seconds=0,
+            error_rate=0,
+            window=1,
+            open_seconds=0,
+        )
+    yield backend_limiter._limiters
+    backend_limiter.reset_limiters()
+
+
+@pytest.fixture(name="server_batcher", autouse=True)
+def fixture_server_batcher():
+    """
+    Provides each test with a server batcher which looks up
+    each server individually, without reading the config
+    """
+    # pylint: disable=protected-access
+    batcher = ServerBatcher(
+        openstack_api._fetch_server,
+        openstack_api._fetch_servers,
+        window_seconds=0,
+        max_batch=1,
+    )
+    openstack_api._server_batcher = batcher
+    yield batcher
+    openstack_api.reset_server_batcher()
+
+
 @pytest.fixture(name="image_metadata")
 def fixture_image_metadata():
     """
@@ -85,3 +142,43 @@ def fixture_openstack_address_list(openstack_address):
         # will return the same object twice
         i.hostname = str(uuid.uuid4())
     return addresses
+
+
+@pytest.fixture(name="example_notification")
+def fixture_example_notification() -> Dict:
+    """
+    Returns an example notification for testing, based on real data from the RabbitMQ queue
+    """
+    return {
+        "event_type": "compute.instance.create.end",
+        "_context_project_name": "project_name",
+        "_context_project_id": "project_id",
+        "_context_user_name": "user_name",
+        "payload": {
+            "instance_id": "instance_id",
+            "display_name": "vm_name",
+            "vcpus": 1,
+            "memory_mb": 1024,
+            "host": "vm_host",
+            "metadata": {},
+        },
+    }
+
+
+@pytest.fixture(name="oslo_body_factory")
+def fixture_oslo_body_factory(example_notification) -> Callable[..., bytes]:
+    """
+    Returns a function which creates a raw message body wrapping the example
+    notification in an oslo envelope, with the given event type and
+    extra payload entries
+    """
+
+    def _create(event_type: str, payload: Optional[Dict] = None) -> bytes:
+        notification = dict(example_notification, event_type=event_type)
+        notification["payload"] = dict(
+            example_notification["payload"], **(payload or {})
+        )
+        envelope = {"oslo.version": "2.0", "oslo.message": json.dumps(notification)}
+        return json.dumps(envelope).encode("utf-8")
+
+    return _create
@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests ignored messages are acked in batches, without a batch covering
+messages which are still being handled
+"""
+from unittest.mock import NonCallableMock
+
+import pytest
+
+from rabbit_consumer.ack_batcher import AckBatcher
+
+
+def _messages(count: int):
+    """
+    Returns mocked messages with delivery tags counting up from 1
+    """
+    return [NonCallableMock(delivery_tag=tag) for tag in range(1, count + 1)]
+
+
+def test_batcher_rejects_invalid_size():
+    """
+    Test that a batch must hold at least one message
+    """
+    with pytest.raises(ValueError):
+        AckBatcher(0)
+
+
+def test_full_batch_acked_with_latest_tag():
+    """
+    Test that messages are held until the batch is full, then acked
+    together by the latest of them
+    """
+    batcher = AckBatcher(3)
+    messages = _messages(3)
+
+    assert batcher.ignore(messages[0]) == []
+    assert batcher.ignore(messages[1]) == []
+    assert batcher.ignore(messages[2]) == [(messages[2], True)]
+    assert batcher.flush() == []
+
+
+def test_batch_stops_before_message_handed_on():
+    """
+    Test that a batch only covers messages delivered before one still
+    being handled, acking those after it individually once a full
+    batch is held behind it
+    """
+    batcher = AckBatcher(3)
+    messages = _messages(5)
+    batcher.handed_on(messages[1])
+
+    batcher.ignore(messages[0])
+    batcher.ignore(messages[2])
+    assert batcher.ignore(messages[3]) == [(messages[0], True)]
+    assert batcher.ignore(messages[4]) == [
+        (messages[2], False),
+        (messages[3], False),
+        (messages[4], False),
+    ]
+
+
+def test_settled_message_no_longer_blocks_batch():
+    """
+    Test that a message acked by itself can be covered by a batch again
+    """
+    batcher = AckBatcher(2)
+    messages = _messages(3)
+    batcher.handed_on(messages[0])
+    batcher.settled(messages[0])
+
+    batcher.ignore(messages[1])
+    assert batcher.ignore(messages[2]) == [(messages[2], True)]
+
+
+def test_flush_acks_held_messages():
+    """
+    Test that flushing acks every held message, batching those it can
+    """
+    batcher = AckBatcher(10)
+    messages = _messages(4)
+    batcher.handed_on(messages[2])
+    for message in (messages[0], messages[1], messages[3]):
+        batcher.ignore(message)
+
+    assert batcher.flush() == [(messages[1], True), (messages[3], False)]
+    assert batcher.flush() == []
@@ -4,15 +4,24 @@
 Tests that we perform the correct REST requests against
 the Aquilon API
 """
+import threading
+import time
 from unittest import mock
-from unittest.mock import patch, call, NonCallableMock
+from unittest.mock import Mock, patch, call, NonCallableMock
 
 import pytest
+import requests
 
 # noinspection PyUnresolvedReferences
 from rabbit_consumer.aq_api import (
     verify_kerberos_ticket,
     setup_requests,
+    AqSessionPool,
+    AQ_CERT_CHAIN,
+    get_session_pool,
+    reset_session_pool,
+    get_ticket_cache,
+    reset_ticket_cache,
     aq_make,
     aq_manage,
     create_machine,
@@ -54,80 +63,316 @@ def test_verify_kerberos_ticket_invalid(subprocess):
     subprocess.assert_called_once_with(["klist", "-s"])
 
 
-@patch("rabbit_consumer.aq_api.requests")
+@pytest.fixture(name="session_pool", autouse=True)
+def fixture_session_pool():
+    """
+    Ensures each test starts without a cached session pool
+    """
+    reset_session_pool()
+    yield
+    reset_session_pool()
+
+
+@patch("rabbit_consumer.aq_api.requests.Session")
 @patch("rabbit_consumer.aq_api.Retry")
 @patch("rabbit_consumer.aq_api.HTTPAdapter")
-@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
-def test_setup_requests(verify_kerb, adapter, retry, requests):
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_session_pool_creates_session(kerb_auth, adapter, retry, session_class):
     """
-    Test that setup_requests sets up the Kerberos ticket and the requests session
-    correctly
+    Test that the pool sets up new sessions with retries, certs and Kerberos
     """
-    session = requests.Session.return_value
-    response = session.get.return_value
-    response.status_code = 200
-
-    setup_requests(NonCallableMock(), NonCallableMock(), NonCallableMock())
-    assert (
-        session.verify
-        == "/etc/grid-security/certificates/aquilon-gridpp-rl-ac-uk-chain.pem"
-    )
+    pool = AqSessionPool(1)
+    with pool.session() as session:
+        assert session == session_class.return_value
 
-    verify_kerb.assert_called_once()
+    assert session.verify == AQ_CERT_CHAIN
     retry.assert_called_once_with(total=5, backoff_factor=0.1, status_forcelist=[503])
     adapter.assert_called_once_with(max_retries=retry.return_value)
     session.mount.assert_called_once_with("https://", adapter.return_value)
+    kerb_auth.assert_called_once_with(force_preemptive=True)
+    assert session.auth == kerb_auth.return_value
 
 
-@patch("rabbit_consumer.aq_api.requests")
-@patch("rabbit_consumer.aq_api.Retry")
-@patch("rabbit_consumer.aq_api.HTTPAdapter")
-@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
-def test_setup_requests_throws_for_failed(verify_kerb, adapter, retry, requests):
+@patch("rabbit_consumer.aq_api.requests.Session")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_session_pool_reuses_sessions(_, session_class):
+    """
+    Test that sessions are kept alive and re-used between requests
+    """
+    pool = AqSessionPool(2)
+    with pool.session() as first:
+        pass
+    with pool.session() as second:
+        pass
+
+    session_class.assert_called_once()
+    assert first is second
+    first.close.assert_not_called()
+
+
+@patch("rabbit_consumer.aq_api.requests.Session")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_session_pool_concurrent_sessions(_, session_class):
+    """
+    Test that concurrent users get different sessions
+    """
+    session_class.side_effect = Mock
+    pool = AqSessionPool(2)
+    with pool.session() as first:
+        with pool.session() as second:
+            assert first is not second
+
+
+@patch("rabbit_consumer.aq_api.requests.Session")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_session_pool_limits_size(_, session_class):
+    """
+    Test that callers block once every session is in use
+    """
+    session_class.side_effect = Mock
+    pool = AqSessionPool(1)
+    acquired = threading.Event()
+
+    def borrow():
+        with pool.session():
+            acquired.set()
+
+    with pool.session():
+        thread = threading.Thread(target=borrow)
+        thread.start()
+        assert not acquired.wait(timeout=0.1)
+
+    assert acquired.wait(timeout=5)
+    thread.join()
+
+
+@patch("rabbit_consumer.aq_api.requests.Session")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_session_pool_discards_broken_session(_, session_class):
+    """
+    Test that a session which hit a connection error is not re-used
+    """
+    session_class.side_effect = [Mock(), Mock()]
+    pool = AqSessionPool(1)
+
+    with pytest.raises(requests.ConnectionError):
+        with pool.session() as broken:
+            raise requests.ConnectionError()
+
+    broken.close.assert_called_once()
+    with pool.session() as session:
+        assert session is not broken
+
+
+@patch("rabbit_consumer.aq_api.requests.Session")
+@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
+def test_session_pool_keeps_session_after_other_errors(_, session_class):
+    """
+    Test that an error unrelated to the connection keeps the session alive
+    """
+    pool = AqSessionPool(1)
+
+    with pytest.raises(ValueError):
+        with pool.session() as first:
+            raise ValueError()
+
+    with pool.session() as second:
+        assert first is second
+    session_class.assert_called_once()
+
+
+@pytest.mark.parametrize("size", [0, -1])
+def test_session_pool_rejects_invalid_size(size):
+    """
+    Test that the pool requires at least one session
+    """
+    with pytest.raises(ValueError):
+        AqSessionPool(size)
+
+
+@patch("rabbit_consumer.aq_api.get_config")
+def test_get_session_pool_is_shared(config):
+    """
+    Test that the session pool is created once from the config
+    """
+    config.return_value.aq_pool_size = 3
+    assert get_session_pool() is get_session_pool()
+    config.assert_called_once_with()
+
+
+@pytest.fixture(name="request_config")
+def fixture_request_config():
+    """
+    Patches the config used when making requests
+    """
+    with patch("rabbit_consumer.aq_api.get_config") as config:
+        config.return_value.aq_connect_timeout = 10
+        config.return_value.aq_read_timeout = 0
+        config.return_value.aq_slow_request_seconds = 0
+        yield config.return_value
+
+
+@pytest.fixture(name="pooled_session")
+def fixture_pooled_session():
+    """
+    Patches the session pool to hand out a single mocked session
+    """
+    with patch("rabbit_consumer.aq_api.get_session_pool") as get_pool:
+        yield get_pool.return_value.session.return_value.__enter__.return_value
+
+
+@pytest.mark.usefixtures("request_config")
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_setup_requests(ticket_cache, pooled_session):
+    """
+    Test that setup_requests checks the Kerberos ticket and uses a pooled session
+    """
+    pooled_session.get.return_value.status_code = 200
+
+    url, desc = NonCallableMock(), NonCallableMock()
+    setup_requests(url, "get", desc)
+
+    ticket_cache.return_value.ensure_valid.assert_called_once()
+    pooled_session.get.assert_called_once_with(url, params=None, timeout=(10, None))
+
+
+@pytest.mark.usefixtures("request_config")
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_setup_requests_throws_for_failed(ticket_cache, pooled_session):
     """
     Test that setup_requests throws an exception when the connection fails
     """
-    session = requests.Session.return_value
-    response = session.get.return_value
-    response.status_code = 500
+    pooled_session.get.return_value.status_code = 500
 
     with pytest.raises(ConnectionError):
         setup_requests(NonCallableMock(), NonCallableMock(), NonCallableMock())
 
-    assert (
-        session.verify
-        == "/etc/grid-security/certificates/aquilon-gridpp-rl-ac-uk-chain.pem"
-    )
+    ticket_cache.return_value.ensure_valid.assert_called_once()
+    pooled_session.get.assert_called_once()
 
-    verify_kerb.assert_called_once()
-    retry.assert_called_once_with(total=5, backoff_factor=0.1, status_forcelist=[503])
-    adapter.assert_called_once_with(max_retries=retry.return_value)
-    session.mount.assert_called_once_with("https://", adapter.return_value)
-    session.get.assert_called_once()
+
+@pytest.mark.usefixtures("request_config")
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_setup_requests_invalidates_ticket_on_401(ticket_cache, pooled_session):
+    """
+    Test that an auth failure forces the Kerberos ticket to be rechecked
+    """
+    pooled_session.get.return_value.status_code = 401
+
+    with pytest.raises(ConnectionError):
+        setup_requests(NonCallableMock(), "get", NonCallableMock())
+
+    ticket_cache.return_value.invalidate.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "status_code,error,limit", [(500, ConnectionError, 50), (400, AquilonError, 100)]
+)
+@pytest.mark.usefixtures("request_config")
+@patch("rabbit_consumer.aq_api.get_ticket_cache", Mock())
+def test_setup_requests_limited(
+    pooled_session, limiters, status_code, error, limit
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Test that failed requests reduce the Aquilon concurrency,
+    unlike errors Aquilon raised deliberately
+    """
+    pooled_session.get.return_value.status_code = status_code
+
+    with pytest.raises(error):
+        setup_requests(NonCallableMock(), "get", NonCallableMock())
+
+    assert limiters["aq"].limit == limit
+
+
+@patch("rabbit_consumer.aq_api.KerberosTicketCache")
+def test_get_ticket_cache_uses_ccache_env(cache_class, monkeypatch):
+    """
+    Test that the ticket cache watches the ccache named by KRB5CCNAME
+    """
+    reset_ticket_cache()
+    monkeypatch.setenv("KRB5CCNAME", "FILE:/shared/krb5cc")
+
+    assert get_ticket_cache() is get_ticket_cache()
+    cache_class.assert_called_once_with("/shared/krb5cc")
+    reset_ticket_cache()
+
+
+@patch("rabbit_consumer.aq_api.KerberosTicketCache")
+def test_get_ticket_cache_created_once_across_threads(cache_class):
+    """
+    Test that workers asking for the ticket cache at once share a single one
+    """
+    reset_ticket_cache()
+    started = threading.Barrier(4)
+
+    def _slow_cache(_):
+        time.sleep(0.01)
+        return Mock()
+
+    cache_class.side_effect = _slow_cache
+    found = []
+
+    def _get():
+        started.wait(timeout=5)
+        found.append(get_ticket_cache())
+
+    threads = [threading.Thread(target=_get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    cache_class.assert_called_once()
+    assert all(cache is found[0] for cache in found)
+    reset_ticket_cache()
+
+
+@pytest.mark.usefixtures("request_config")
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_setup_requests_throws_aquilon_error(_, pooled_session):
+    """
+    Test that setup_requests raises an AquilonError for a bad request
+    """
+    pooled_session.get.return_value.status_code = 400
+
+    with pytest.raises(AquilonError):
+        setup_requests(NonCallableMock(), NonCallableMock(), NonCallableMock())
 
 
 @pytest.mark.parametrize("rest_verb", ["get", "post", "put", "delete"])
-@patch("rabbit_consumer.aq_api.requests")
-@patch("rabbit_consumer.aq_api.HTTPKerberosAuth")
-@patch("rabbit_consumer.aq_api.verify_kerberos_ticket")
-def test_setup_requests_rest_methods(_, kerb_auth, requests, rest_verb):
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+def test_setup_requests_rest_methods(_, rest_verb, request_config, pooled_session):
     """
     Test that setup_requests calls the correct REST method
     """
+    request_config.aq_connect_timeout = 5
+    request_config.aq_read_timeout = 60
     url, desc, params = NonCallableMock(), NonCallableMock(), NonCallableMock()
 
-    session = requests.Session.return_value
-
-    rest_method = getattr(session, rest_verb)
+    rest_method = getattr(pooled_session, rest_verb)
     response = rest_method.return_value
     response.status_code = 200
 
     assert setup_requests(url, rest_verb, desc, params) == response.text
-    rest_method.assert_called_once_with(url, auth=kerb_auth.return_value, params=params)
+    rest_method.assert_called_once_with(url, params=params, timeout=(5, 60))
+
+
+@patch("rabbit_consumer.aq_api.get_ticket_cache")
+@patch("rabbit_consumer.aq_api.logger")
+def test_setup_requests_warns_slow_requests(logger, _, request_config, pooled_session):
+    """
+    Test that requests slower than the configured threshold log a warning
+    """
+    request_config.aq_slow_request_seconds = 0.000001
+    pooled_session.get.return_value.status_code = 200
+
+    setup_requests(NonCallableMock(), "get", NonCallableMock())
+    logger.warning.assert_called_once()
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_make_calls(config, setup, openstack_address_list):
     """
     Test that aq_make calls the correct URLs with the correct parameters
@@ -143,7 +388,7 @@ def test_aq_make_calls(config, setup, openstack_address_list):
 
 @pytest.mark.parametrize("hostname", ["  ", "", None])
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_make_none_hostname(config, setup, openstack_address, hostname):
     """
     Test that aq_make throws an exception if the field is missing
@@ -161,7 +406,7 @@ def test_aq_make_none_hostname(config, setup, openstack_address, hostname):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_manage(config, setup, openstack_address_list, image_metadata):
     """
     Test that aq_manage calls the correct URLs with the correct parameters
@@ -182,7 +427,7 @@ def test_aq_manage(config, setup, openstack_address_list, image_metadata):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_manage_with_sandbox(config, setup, openstack_address_list, image_metadata):
     """
     Test that aq_manage calls the correct URLs with the sandbox
@@ -205,7 +450,7 @@ def test_aq_manage_with_sandbox(config, setup, openstack_address_list, image_met
     setup.assert_called_once_with(expected_url, "post", mock.ANY, params=expected_param)
 
 
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 @patch("rabbit_consumer.aq_api.setup_requests")
 def test_aq_create_machine(setup, config, rabbit_message, vm_data):
     """
@@ -230,7 +475,7 @@ def test_aq_create_machine(setup, config, rabbit_message, vm_data):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_delete_machine(config, setup):
     """
     Test that aq_delete_machine calls the correct URL with the correct parameters
@@ -246,7 +491,7 @@ def test_aq_delete_machine(config, setup):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_create_host(config, setup, openstack_address_list, image_metadata):
     """
     Test that aq_create_host calls the correct URL with the correct parameters
@@ -274,7 +519,7 @@ def test_aq_create_host(config, setup, openstack_address_list, image_metadata):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_create_host_with_sandbox(
     config, setup, openstack_address_list, image_metadata
 ):
@@ -307,7 +552,7 @@ def test_aq_create_host_with_sandbox(
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_aq_delete_host(config, setup):
     """
     Test that aq_delete_host calls the correct URL with the correct parameters
@@ -323,7 +568,7 @@ def test_aq_delete_host(config, setup):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_add_machine_nic(config, setup, openstack_address_list):
     """
     Test that add_machine_interface calls the correct URL with the correct parameters
@@ -344,7 +589,7 @@ def test_add_machine_nic(config, setup, openstack_address_list):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_update_machine_interface(config, setup):
     """
     Test that update_machine_interface calls the correct URL with the correct parameters
@@ -361,7 +606,7 @@ def test_update_machine_interface(config, setup):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_check_host_exists(config, setup):
     """
     Test that check_host_exists calls the correct URL with the correct parameters
@@ -377,7 +622,7 @@ def test_check_host_exists(config, setup):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_check_host_exists_returns_false(config, setup):
     """
     Test that check_host_exists calls the correct URL with the correct parameters
@@ -391,7 +636,7 @@ def test_check_host_exists_returns_false(config, setup):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_search_machine_by_serial(config, setup, vm_data):
     """
     Test that search_machine_by_serial calls the correct URL with the correct parameters
@@ -406,7 +651,7 @@ def test_search_machine_by_serial(config, setup, vm_data):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_search_machine_by_serial_not_found(config, setup, vm_data):
     """
     Test that search_machine_by_serial calls the correct URL with the correct parameters
@@ -422,7 +667,7 @@ def test_search_machine_by_serial_not_found(config, setup, vm_data):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_search_host_by_machine(config, setup):
     """
     Test that search_host_by_machine calls the correct URL with the correct parameters
@@ -438,7 +683,7 @@ def test_search_host_by_machine(config, setup):
 
 
 @patch("rabbit_consumer.aq_api.setup_requests")
-@patch("rabbit_consumer.aq_api.ConsumerConfig")
+@patch("rabbit_consumer.aq_api.get_config")
 def test_search_host_by_machine_not_found(config, setup):
     """
     Test that search_host_by_machine calls the correct URL with the correct parameters
@@ -0,0 +1,138 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests aq_api against the fake Aquilon server, so the fake
+stays in step with the requests the consumer makes
+"""
+import time
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+import requests
+
+from benchmarks.aq_server import fake_kerberos, run_fake_aq_server
+from rabbit_consumer import aq_api
+from rabbit_consumer.aq_api import AquilonError
+from rabbit_consumer.message_consumer import delete_machine
+
+
+@pytest.fixture(name="server")
+def fixture_server():
+    """
+    Runs a fake Aquilon server, with aq_api pointed at it
+    """
+    with run_fake_aq_server() as server, fake_kerberos():
+        config = NonCallableMock(
+            aq_url=server.url,
+            aq_prefix="vm-openstack-",
+            aq_pool_size=2,
+            aq_connect_timeout=1,
+            aq_read_timeout=5,
+            aq_slow_request_seconds=0,
+        )
+        with patch("rabbit_consumer.aq_api.get_config", return_value=config):
+            yield server
+
+
+@pytest.fixture(name="machine_name")
+def fixture_machine_name(server, rabbit_message, vm_data, openstack_address):
+    """
+    Creates a machine with an interface through aq_api
+    """
+    machine_name = aq_api.create_machine(rabbit_message, vm_data)
+    aq_api.add_machine_nics(machine_name, [openstack_address])
+    aq_api.set_interface_bootable(machine_name, "eth0")
+    assert server.state.machines[machine_name].bootable == "eth0"
+    return machine_name
+
+
+def test_create_host(server, machine_name, vm_data, image_metadata, openstack_address):
+    """
+    Test that a host created through aq_api can be found, made and managed
+    """
+    hostname = openstack_address.hostname
+    aq_api.create_host(image_metadata, [openstack_address], machine_name)
+    aq_api.aq_make([openstack_address])
+    aq_api.aq_manage([openstack_address], image_metadata)
+
+    assert machine_name == "vm-openstack-1"
+    assert aq_api.check_host_exists(hostname)
+    assert aq_api.search_machine_by_serial(vm_data) == machine_name
+    assert aq_api.search_host_by_machine(machine_name) == hostname
+    details = aq_api.get_machine_details(machine_name)
+    assert "eth0" in details
+    assert openstack_address.addr in details
+    assert server.state.hosts[hostname].makes == 1
+    assert server.requests["manage"] == 1
+
+
+def test_delete_machine_flow(
+    server, machine_name, vm_data, image_metadata, openstack_address
+):
+    """
+    Test that the consumer's delete flow removes everything it created
+    """
+    aq_api.create_host(image_metadata, [openstack_address], machine_name)
+
+    delete_machine(vm_data, openstack_address)
+
+    assert not server.state.hosts
+    assert not server.state.machines
+    assert not aq_api.check_host_exists(openstack_address.hostname)
+    assert aq_api.search_machine_by_serial(vm_data) is None
+
+
+def test_delete_order_enforced(machine_name, image_metadata, openstack_address):
+    """
+    Test that a machine cannot be deleted whilst it has a host, as in Aquilon
+    """
+    aq_api.create_host(image_metadata, [openstack_address], machine_name)
+    with pytest.raises(AquilonError, match="still in use"):
+        aq_api.delete_machine(machine_name)
+
+
+def test_missing_host(server):
+    """
+    Test that unknown hosts are reported as not found
+    """
+    assert not aq_api.check_host_exists("missing.example.com")
+    with pytest.raises(AquilonError):
+        aq_api.delete_host("missing.example.com")
+    assert server.requests["delete_host"] == 1
+
+
+def test_auth_can_be_switched(server):
+    """
+    Test that requests without a token are refused until auth is switched off
+    """
+    url = server.url + "/find/host"
+    response = requests.get(url, params={"machine": "missing"}, timeout=5)
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Negotiate"
+
+    server.require_auth = False
+    assert requests.get(url, params={"machine": "missing"}, timeout=5).text == ""
+
+
+def test_unknown_route(server):
+    """
+    Test that requests the fake does not implement are rejected
+    """
+    with pytest.raises(ConnectionError):
+        aq_api.setup_requests(server.url + "/unknown", "get", "Unknown")
+
+
+def test_route_latency(server, openstack_address, machine_name, image_metadata):
+    """
+    Test that routes can be slowed down individually
+    """
+    aq_api.create_host(image_metadata, [openstack_address], machine_name)
+    server.route_latencies["make"] = 0.2
+
+    start = time.perf_counter()
+    aq_api.check_host_exists(openstack_address.hostname)
+    assert time.perf_counter() - start < 0.2
+
+    start = time.perf_counter()
+    aq_api.aq_make([openstack_address])
+    assert time.perf_counter() - start >= 0.2
@@ -0,0 +1,278 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the asyncio consumer handles messages concurrently whilst
+keeping per-VM ordering, and behaves as the threaded consumer
+"""
+import asyncio
+import threading
+from unittest.mock import AsyncMock, MagicMock, Mock, NonCallableMock, patch
+
+import pytest
+
+from rabbit_consumer import async_consumer
+from rabbit_consumer.async_consumer import (
+    AsyncMessage,
+    AsyncMessageDispatcher,
+    AsyncRetryPublisher,
+    initiate_async_consumer,
+)
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.retry_queue import RetryRouter
+
+
+def _message() -> NonCallableMock:
+    """
+    Returns a mocked message with an awaitable ack
+    """
+    return NonCallableMock(body=b"body", properties={}, ack=AsyncMock())
+
+
+def _decoded(instance_id: str, event_type: str = "event") -> NonCallableMock:
+    """
+    Returns a mocked decoded message for the given instance
+    """
+    decoded = NonCallableMock(event_type=event_type)
+    decoded.payload.instance_id = instance_id
+    return decoded
+
+
+async def _dispatch_all(dispatcher, items):
+    """
+    Dispatches each message, decoding to its paired value, then waits
+    for them all to be handled
+    """
+    async with dispatcher:
+        for message, decoded in items:
+            with patch.object(async_consumer, "decode_message", return_value=decoded):
+                await dispatcher.dispatch(message)
+
+
+@pytest.mark.parametrize("concurrency", [0, -1])
+def test_dispatcher_rejects_invalid_concurrency(concurrency):
+    """
+    Test that the dispatcher requires at least one handler at a time
+    """
+    with pytest.raises(ValueError):
+        AsyncMessageDispatcher(concurrency, Mock())
+
+
+def test_dispatch_handles_and_acks():
+    """
+    Test that decoded messages are handled then acked, and others are acked
+    """
+    handler = Mock()
+    handled, ignored = _message(), _message()
+    decoded = _decoded("instance_id")
+
+    dispatcher = AsyncMessageDispatcher(4, handler)
+    asyncio.run(_dispatch_all(dispatcher, [(handled, decoded), (ignored, None)]))
+
+    handler.assert_called_once_with(decoded)
+    handled.ack.assert_awaited_once()
+    ignored.ack.assert_awaited_once()
+
+
+def test_same_instance_handled_in_order():
+    """
+    Test that messages for one VM are handled one at a time, in order
+    """
+    order = []
+    running = []
+
+    def handler(decoded):
+        running.append(decoded)
+        assert len(running) == 1
+        order.append(decoded.event_type)
+        running.pop()
+
+    items = [(_message(), _decoded("instance_id", str(i))) for i in range(20)]
+    asyncio.run(_dispatch_all(AsyncMessageDispatcher(8, handler), items))
+
+    assert order == [str(i) for i in range(20)]
+
+
+def test_concurrency_is_bounded():
+    """
+    Test that no more than the given number of handlers run at once
+    """
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def handler(_):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        threading.Event().wait(0.01)
+        with lock:
+            running.pop()
+
+    items = [(_message(), _decoded(f"instance-{i}")) for i in range(20)]
+    asyncio.run(_dispatch_all(AsyncMessageDispatcher(3, handler), items))
+
+    assert max(peak) == 3
+
+
+def test_failed_message_is_retried():
+    """
+    Test that a failed message is moved onto the retry queues and acked
+    """
+    error = ValueError("Failed")
+    publisher = NonCallableMock(publish=AsyncMock())
+    failed, decoded = _message(), _decoded("instance_id")
+
+    dispatcher = AsyncMessageDispatcher(
+        2, Mock(side_effect=error), retry_publisher=publisher
+    )
+    asyncio.run(_dispatch_all(dispatcher, [(failed, decoded)]))
+
+    publisher.publish.assert_awaited_once_with(failed, error, "event", retry=True)
+    failed.ack.assert_awaited_once()
+
+
+def test_failure_without_retries_stops_consumer():
+    """
+    Test that without a publisher the failed message is left un-acked,
+    and the error is raised from the next dispatch
+    """
+    failed, decoded = _message(), _decoded("instance_id")
+    dispatcher = AsyncMessageDispatcher(2, Mock(side_effect=ValueError("Failed")))
+    asyncio.run(_dispatch_all(dispatcher, [(failed, decoded)]))
+
+    failed.ack.assert_not_awaited()
+    with pytest.raises(ValueError, match="Failed"):
+        asyncio.run(dispatcher.dispatch(_message()))
+
+
+@pytest.mark.parametrize("is_open", [False, True])
+@patch.object(async_consumer, "wait_for_backends")
+@patch.object(async_consumer, "backends_open")
+def test_dispatch_waits_only_while_circuit_open(backends_open, wait, is_open):
+    """
+    Test that messages only wait on a thread whilst a circuit is open,
+    so ignored messages are otherwise acked on the event loop
+    """
+    backends_open.return_value = is_open
+    message = _message()
+    asyncio.run(_dispatch_all(AsyncMessageDispatcher(2, Mock()), [(message, None)]))
+
+    assert wait.called == is_open
+    message.ack.assert_awaited_once()
+
+
+@patch.object(async_consumer, "decode_message")
+def test_undecodable_message_is_dead_lettered(decode_message):
+    """
+    Test that a message which cannot be decoded is not retried
+    """
+    error = ValueError("Bad")
+    decode_message.side_effect = error
+    publisher = NonCallableMock(publish=AsyncMock())
+    message = _message()
+
+    dispatcher = AsyncMessageDispatcher(2, Mock(), retry_publisher=publisher)
+    asyncio.run(dispatcher.dispatch(message))
+
+    publisher.publish.assert_awaited_once_with(message, error, "unknown", retry=False)
+    message.ack.assert_awaited_once()
+
+
+def test_coalesced_create_is_not_handled():
+    """
+    Test that a create cancelled by a following delete is acked unhandled
+    """
+    handler = Mock()
+    coalescer = CreateDeleteCoalescer(
+        10, create_event_type="create", delete_event_type="delete"
+    )
+    create, delete = _message(), _message()
+    items = [
+        (create, _decoded("instance_id", "create")),
+        (delete, _decoded("instance_id", "delete")),
+    ]
+
+    dispatcher = AsyncMessageDispatcher(2, handler, coalescer)
+    asyncio.run(_dispatch_all(dispatcher, items))
+
+    handler.assert_called_once_with(items[1][1])
+    create.ack.assert_awaited_once()
+    delete.ack.assert_awaited_once()
+
+
+def test_async_message_properties():
+    """
+    Test that the headers and set properties of a received message are kept
+    """
+    received = NonCallableMock(
+        body=b"body",
+        headers={"x-consumer-attempts": 1},
+        content_type="application/json",
+        content_encoding=None,
+        correlation_id=None,
+        message_id="id",
+        timestamp=None,
+        type=None,
+        app_id=None,
+        ack=AsyncMock(),
+    )
+    message = AsyncMessage(received)
+
+    assert message.body == b"body"
+    assert message.properties == {
+        "headers": {"x-consumer-attempts": 1},
+        "content_type": "application/json",
+        "message_id": "id",
+    }
+    assert RetryRouter.attempts(message) == 1
+    asyncio.run(message.ack())
+    received.ack.assert_awaited_once()
+
+
+@patch.object(async_consumer, "aio_pika")
+def test_retry_publisher(aio_pika):
+    """
+    Test that the retry queues are declared and failed messages
+    published onto them as the threaded consumer would
+    """
+    channel = NonCallableMock(declare_queue=AsyncMock())
+    channel.default_exchange.publish = AsyncMock()
+    router = RetryRouter(None, "ral.info", max_attempts=2, retry_seconds=1)
+    publisher = AsyncRetryPublisher(channel, router)
+
+    asyncio.run(publisher.declare())
+    assert [c.args[0] for c in channel.declare_queue.await_args_list] == [
+        "ral.info.retry.1000ms",
+        "ral.info.dead",
+    ]
+
+    message = NonCallableMock(body=b"body", properties={})
+    destination = asyncio.run(publisher.publish(message, ValueError("x"), "event"))
+
+    assert destination == "ral.info.retry.1000ms"
+    assert aio_pika.Message.call_args.args == (b"body",)
+    assert aio_pika.Message.call_args.kwargs["delivery_mode"] == 2
+    channel.default_exchange.publish.assert_awaited_once_with(
+        aio_pika.Message.return_value, routing_key=destination
+    )
+
+
+@patch.object(async_consumer, "aio_pika", None)
+def test_initiate_requires_aio_pika():
+    """
+    Test that a clear error is raised when aio-pika is not installed
+    """
+    with pytest.raises(RuntimeError, match="aio-pika"):
+        initiate_async_consumer()
+
+
+@patch.object(async_consumer, "aio_pika", MagicMock())
+@patch.object(async_consumer, "verify_kerberos_ticket")
+@patch.object(async_consumer, "get_config")
+def test_initiate_rejects_shards(config, _):
+    """
+    Test that sharding is refused, as only the threaded consumer routes shards
+    """
+    config.return_value.consumer_shards = 4
+    with pytest.raises(ValueError, match="CONSUMER_SHARDS"):
+        initiate_async_consumer()
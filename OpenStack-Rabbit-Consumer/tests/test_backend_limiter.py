@@ -0,0 +1,269 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that backend concurrency adapts to failures and latency,
+and the circuit breaker stops requests whilst a backend is down
+"""
+import threading
+from unittest.mock import NonCallableMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.backend_limiter import (
+    AQ,
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    BackendLimiter,
+    CircuitOpenError,
+    backends_open,
+    get_limiter,
+    reset_limiters,
+    wait_for_backends,
+)
+
+
+def _sample(name: str) -> float:
+    """
+    Returns the current value of a metric for the test limiter
+    """
+    return REGISTRY.get_sample_value(name, {"backend": "test"}) or 0.0
+
+
+# pylint: disable=too-few-public-methods
+class FakeClock:
+    """
+    A clock which only moves when told to
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(name="clock")
+def fixture_clock():
+    """
+    Returns a fake clock starting at 0
+    """
+    return FakeClock()
+
+
+@pytest.fixture(name="limiter")
+def fixture_limiter(clock):
+    """
+    Returns a limiter allowing 1 to 8 requests, which opens its circuit
+    for 30 seconds when half of the last 10 requests fail
+    """
+    return BackendLimiter(
+        "test",
+        min_limit=1,
+        max_limit=8,
+        slow_seconds=5,
+        error_rate=0.5,
+        window=10,
+        open_seconds=30,
+        clock=clock,
+    )
+
+
+def _complete(limiter, clock, failed=False, seconds=0.0):
+    """
+    Runs a single request through the limiter taking the given time
+    """
+    started = limiter.acquire()
+    clock.now += seconds
+    limiter.release(started, failed)
+
+
+@pytest.mark.parametrize("limits", [(0, 4), (4, 2)])
+def test_limiter_rejects_invalid_limits(limits):
+    """
+    Test that the minimum must be at least 1 and no more than the maximum
+    """
+    with pytest.raises(ValueError):
+        BackendLimiter(
+            "test",
+            min_limit=limits[0],
+            max_limit=limits[1],
+            slow_seconds=0,
+            error_rate=0,
+            window=1,
+            open_seconds=0,
+        )
+
+
+def test_failure_halves_limit_once_per_burst(limiter, clock):
+    """
+    Test that concurrent failures halve the limit once, not once each
+    """
+    started = [limiter.acquire() for _ in range(3)]
+    clock.now += 1
+    for start in started:
+        limiter.release(start, failed=True)
+    assert limiter.limit == 4
+
+    _complete(limiter, clock, seconds=5)
+    assert limiter.limit == 2
+
+
+def test_slow_request_reduces_limit(limiter, clock):
+    """
+    Test that a request slower than slow_seconds counts against the limit
+    """
+    _complete(limiter, clock, seconds=5)
+    assert limiter.limit == 4
+    assert limiter.state == CLOSED
+
+
+def test_success_grows_limit(limiter, clock):
+    """
+    Test that the limit grows additively back to the maximum
+    """
+    for _ in range(3):
+        _complete(limiter, clock, seconds=5)
+    assert limiter.limit == 1
+
+    for _ in range(50):
+        _complete(limiter, clock)
+    assert limiter.limit == 8
+    assert _sample("rabbit_consumer_backend_concurrency_limit") == 8
+
+
+def test_acquire_waits_for_free_slot(limiter, clock):
+    """
+    Test that requests beyond the limit wait for one to finish
+    """
+    for _ in range(3):
+        _complete(limiter, clock, seconds=5)
+    started = limiter.acquire()
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    limiter.release(started, failed=False)
+    assert acquired.wait(1)
+    thread.join()
+
+
+def test_circuit_opens_and_rejects(limiter, clock):
+    """
+    Test that enough failures open the circuit, failing requests immediately
+    """
+    rejected = _sample("rabbit_consumer_backend_requests_rejected_total")
+    for failed in (False, True) * 5:
+        _complete(limiter, clock, failed=failed)
+
+    assert limiter.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        limiter.acquire()
+    assert _sample("rabbit_consumer_backend_requests_rejected_total") == rejected + 1
+    assert _sample("rabbit_consumer_backend_circuit_state") == OPEN
+
+
+@pytest.mark.parametrize("probe_failed,expected", [(False, CLOSED), (True, OPEN)])
+def test_circuit_probe(limiter, clock, probe_failed, expected):
+    """
+    Test that a single probe is let through after open_seconds,
+    which closes the circuit or opens it again
+    """
+    for _ in range(10):
+        _complete(limiter, clock, failed=True)
+    clock.now += 30
+    assert limiter.state == HALF_OPEN
+
+    started = limiter.acquire()
+    limiter.release(started, failed=probe_failed)
+    assert limiter.state == expected
+    assert limiter.limit == 1
+
+
+def test_circuit_disabled(limiter, clock):
+    """
+    Test that an error rate of 0 never opens the circuit
+    """
+    limiter._error_rate = 0  # pylint: disable=protected-access
+    for _ in range(10):
+        _complete(limiter, clock, failed=True)
+    assert limiter.state == CLOSED
+
+
+def test_request_ignores_given_errors(limiter, clock):
+    """
+    Test that errors of the ignored types do not count as failures
+    """
+    for _ in range(10):
+        with pytest.raises(KeyError):
+            with limiter.request(ignore=(KeyError,)):
+                raise KeyError("expected")
+    assert limiter.state == CLOSED
+    assert limiter.limit == 8
+
+    for _ in range(10):
+        with pytest.raises(ConnectionError):
+            with limiter.request(ignore=(KeyError,)):
+                clock.now += 1
+                raise ConnectionError("down")
+    assert limiter.state == OPEN
+
+
+def test_wait_until_available(limiter, clock):
+    """
+    Test that waiting returns once the circuit is no longer open
+    """
+    assert limiter.wait_until_available()
+    for _ in range(10):
+        _complete(limiter, clock, failed=True)
+
+    assert not limiter.wait_until_available(timeout=0)
+    clock.now += 30
+    assert limiter.wait_until_available(timeout=0)
+
+
+@patch("rabbit_consumer.backend_limiter.get_config")
+def test_get_limiter_from_config(config, limiters):
+    """
+    Test that limiters are created from the config and shared
+    """
+    limiters.clear()
+    config.return_value = NonCallableMock(
+        backend_min_concurrency=2,
+        backend_max_concurrency=6,
+        aq_slow_request_seconds=30,
+        backend_error_rate=0.5,
+        backend_error_window=10,
+        backend_open_seconds=30,
+    )
+    limiter = get_limiter(AQ)
+    assert limiter is get_limiter(AQ)
+    assert limiter.limit == 6
+
+    reset_limiters()
+    assert get_limiter(AQ) is not limiter
+
+
+def test_wait_for_backends(limiters):
+    """
+    Test that messages are held until every open circuit has recovered
+    """
+    limiters[AQ] = BackendLimiter(
+        AQ,
+        min_limit=1,
+        max_limit=1,
+        slow_seconds=0,
+        error_rate=1,
+        window=1,
+        open_seconds=0.1,
+    )
+    limiters[AQ].release(limiters[AQ].acquire(), failed=True)
+    assert limiters[AQ].state == OPEN
+    assert backends_open()
+
+    wait_for_backends()
+    assert limiters[AQ].state == HALF_OPEN
+    assert not backends_open()
@@ -0,0 +1,147 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Smoke tests for the benchmark suite, so the corpus and fakes
+stay in step with the consumer
+"""
+from unittest.mock import Mock
+
+import pytest
+
+from benchmarks import bench_create, corpus, replay
+from benchmarks.bench_decode import main
+from benchmarks.fakes import FakeAqApi, FakeOpenstackApi, FaultInjector, fake_backends
+from rabbit_consumer.message_consumer import decode_message, on_message
+from rabbit_consumer.rabbit_message import RabbitMessage
+
+
+def test_generate_is_reproducible():
+    """
+    Tests the same seed generates the same corpus
+    """
+    assert corpus.generate(20, seed=1) == corpus.generate(20, seed=1)
+
+
+def test_generated_messages_decode():
+    """
+    Tests supported messages in the corpus decode to a RabbitMessage
+    """
+    instance_id = "abc-123"
+    raw = corpus.encode(
+        corpus.make_notification(
+            "compute.instance.create.end", "large", instance_id=instance_id
+        )
+    )
+
+    message = Mock(body=raw)
+    decoded = decode_message(message)
+    assert isinstance(decoded, RabbitMessage)
+    assert decoded.payload.instance_id == instance_id
+
+
+def test_on_message_with_fakes():
+    """
+    Tests a create then delete message runs end to end against the fakes
+    """
+    aq_api, openstack_api = FakeAqApi(), FakeOpenstackApi()
+    bodies = [
+        corpus.encode(corpus.make_notification(event, instance_id="abc-123"))
+        for event in ("compute.instance.create.end", "compute.instance.delete.start")
+    ]
+
+    with fake_backends(aq_api, openstack_api):
+        for body in bodies:
+            message = Mock(body=body)
+            on_message(message)
+            message.ack.assert_called_once()
+
+    assert aq_api.calls["create_machine"] == 1
+    assert aq_api.calls["delete_machine"] == 1
+    assert "abc-123" in openstack_api.metadata
+    assert not aq_api.machines
+
+
+def test_main_reports_each_benchmark(tmp_path):
+    """
+    Tests the benchmark runner reports and writes every result
+    """
+    output = tmp_path / "results.json"
+    results = main(["--messages", "50", "--json", str(output)])
+
+    assert [r["name"] for r in results] == [
+        "MessageEventType.from_json",
+        "RabbitMessage.from_json",
+        "decode_message",
+        "on_message",
+    ]
+    assert output.exists()
+
+
+def test_fault_injector_fails_calls():
+    """
+    Tests every call fails when the error rate is 1, and none when 0
+    """
+    with pytest.raises(ConnectionError):
+        FaultInjector(error_rate=1).apply("aq_make")
+    FaultInjector(error_rate=0).apply("aq_make")
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_replay_reports_every_message(workers):
+    """
+    Tests a replay handles every message, inline or through a worker pool
+    """
+    result = replay.replay(corpus.generate(50, seed=2), workers=workers)
+
+    assert result.messages == 50
+    assert result.failed == 0
+    assert result.workers == workers
+    assert result.messages_per_sec > 0
+    assert 0 <= result.p50_ms <= result.p99_ms <= result.max_ms
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_replay_counts_injected_failures(workers):
+    """
+    Tests failures injected into Aquilon are counted without
+    stopping the replay
+    """
+    bodies = [
+        corpus.encode(corpus.make_notification("compute.instance.create.end"))
+        for _ in range(5)
+    ]
+    aq_api = FakeAqApi(faults=FaultInjector(error_rate=1))
+
+    result = replay.replay(bodies, workers=workers, aq_api=aq_api)
+
+    assert result.messages == 5
+    assert result.failed == 5
+
+
+def test_replay_main_writes_results(tmp_path):
+    """
+    Tests the replay runner writes its results
+    """
+    output = tmp_path / "replay.json"
+    result = replay.main(
+        ["--messages", "20", "--rate", "1000", "--workers", "2", "--json", str(output)]
+    )
+    assert result["messages"] == 20
+    assert result["offered_rate"] == 1000
+    assert output.exists()
+
+
+def test_create_round_trips(tmp_path):
+    """
+    Tests a create reads nothing back from Aquilon or Nova to write its
+    metadata, leaving one server lookup and one machine search, made
+    whilst clearing old records
+    """
+    output = tmp_path / "round_trips.json"
+    result = bench_create.main(["--creates", "10", "--json", str(output)])
+
+    assert result["aq_requests"]["search_machine_by_serial"] == 1
+    assert result["nova_requests"]["servers"] == 1
+    assert result["nova_requests"]["set_server_metadata"] == 1
+    assert result["baseline"]["nova.servers"] == 2
+    assert output.exists()
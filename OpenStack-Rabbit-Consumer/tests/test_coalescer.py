@@ -0,0 +1,139 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests creates are held and cancelled by a following delete
+"""
+import threading
+from unittest.mock import Mock, NonCallableMock
+
+import pytest
+
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+
+CREATE = "compute.instance.create.end"
+DELETE = "compute.instance.delete.start"
+
+
+def _decoded(event_type: str, instance_id: str = "instance_id") -> NonCallableMock:
+    """
+    Returns a mocked decoded message of the given type
+    """
+    decoded = NonCallableMock()
+    decoded.event_type = event_type
+    decoded.payload.instance_id = instance_id
+    return decoded
+
+
+@pytest.fixture(name="clock")
+def fixture_clock():
+    """
+    Provides a clock which only moves when told to
+    """
+    return Mock(return_value=100.0)
+
+
+@pytest.fixture(name="coalescer")
+def fixture_coalescer(clock):
+    """
+    Provides a coalescer which does not hold creates
+    """
+    return CreateDeleteCoalescer(0, CREATE, DELETE, clock=clock)
+
+
+def test_create_claimed(coalescer):
+    """
+    Tests a create with no following delete is handled
+    """
+    message, decoded = Mock(), _decoded(CREATE)
+    assert coalescer.submitted(message, decoded) is None
+    assert coalescer.claim(message, decoded)
+    assert coalescer.cancelled_count == 0
+
+
+def test_delete_cancels_queued_create(coalescer):
+    """
+    Tests a delete cancels a create which has not started, returning it to ack
+    """
+    create, create_decoded = Mock(), _decoded(CREATE)
+    delete, delete_decoded = Mock(), _decoded(DELETE)
+
+    coalescer.submitted(create, create_decoded)
+    assert coalescer.submitted(delete, delete_decoded) is create
+
+    assert not coalescer.claim(create, create_decoded)
+    assert coalescer.claim(delete, delete_decoded)
+    assert coalescer.cancelled_count == 1
+
+
+def test_delete_after_create_started(coalescer):
+    """
+    Tests a delete does not cancel a create which has already started
+    """
+    create, create_decoded = Mock(), _decoded(CREATE)
+    coalescer.submitted(create, create_decoded)
+    assert coalescer.claim(create, create_decoded)
+
+    assert coalescer.submitted(Mock(), _decoded(DELETE)) is None
+
+
+def test_delete_for_other_instance(coalescer):
+    """
+    Tests a delete only cancels creates for the same instance
+    """
+    create, create_decoded = Mock(), _decoded(CREATE, "first")
+    coalescer.submitted(create, create_decoded)
+
+    assert coalescer.submitted(Mock(), _decoded(DELETE, "second")) is None
+    assert coalescer.claim(create, create_decoded)
+
+
+def test_redelivered_create_replaces_pending(coalescer):
+    """
+    Tests a second create for the instance cancels the first
+    """
+    first, second, decoded = Mock(), Mock(), _decoded(CREATE)
+    coalescer.submitted(first, decoded)
+
+    assert coalescer.submitted(second, decoded) is first
+    assert not coalescer.claim(first, decoded)
+    assert coalescer.claim(second, decoded)
+
+
+def test_other_events_ignored(coalescer):
+    """
+    Tests other event types are neither tracked nor held
+    """
+    message, decoded = Mock(), _decoded("compute.instance.update")
+    assert coalescer.submitted(message, decoded) is None
+    assert coalescer.claim(message, decoded)
+
+
+def test_create_held_until_cancelled(clock):
+    """
+    Tests a held create waits, and is released early once cancelled
+    """
+    coalescer = CreateDeleteCoalescer(30, CREATE, DELETE, clock=clock)
+    create, create_decoded = Mock(), _decoded(CREATE)
+    coalescer.submitted(create, create_decoded)
+
+    result = []
+    worker = threading.Thread(
+        target=lambda: result.append(coalescer.claim(create, create_decoded))
+    )
+    worker.start()
+    coalescer.submitted(Mock(), _decoded(DELETE))
+    worker.join(timeout=5)
+
+    assert result == [False]
+
+
+def test_create_released_after_hold(clock):
+    """
+    Tests a held create is handled once the hold has passed
+    """
+    coalescer = CreateDeleteCoalescer(30, CREATE, DELETE, clock=clock)
+    create, create_decoded = Mock(), _decoded(CREATE)
+    coalescer.submitted(create, create_decoded)
+
+    clock.return_value = 130.0
+    assert coalescer.claim(create, create_decoded)
@@ -4,9 +4,16 @@
 Test the consumer config class, this handles the environment variables
 that are used to configure the consumer.
 """
+import dataclasses
+
 import pytest
 
-from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer import consumer_config
+from rabbit_consumer.consumer_config import (
+    ConsumerConfig,
+    get_config,
+    load_config,
+)
 
 AQ_FIELDS = [
     ("aq_prefix", "AQ_PREFIX"),
@@ -38,3 +45,204 @@ def test_config_gets_os_env_vars(monkeypatch, config_name, env_var):
     expected = "MOCK_ENV"
     monkeypatch.setenv(env_var, expected)
     assert getattr(ConsumerConfig(), config_name) == expected
+
+
+def test_config_consumer_workers(monkeypatch):
+    """
+    Test that the worker count is read from the environment as an integer
+    """
+    monkeypatch.setenv("CONSUMER_WORKERS", "8")
+    assert ConsumerConfig().consumer_workers == 8
+
+
+def test_config_consumer_workers_default(monkeypatch):
+    """
+    Test that a single worker is used if not otherwise configured
+    """
+    monkeypatch.delenv("CONSUMER_WORKERS", raising=False)
+    assert ConsumerConfig().consumer_workers == 1
+
+
+@pytest.mark.parametrize(
+    "config_name,env_var,value,expected",
+    [
+        ("aq_pool_size", "AQ_POOL_SIZE", "4", 4),
+        ("aq_connect_timeout", "AQ_CONNECT_TIMEOUT", "2.5", 2.5),
+        ("aq_read_timeout", "AQ_READ_TIMEOUT", "120", 120.0),
+        ("aq_slow_request_seconds", "AQ_SLOW_REQUEST_SECONDS", "0", 0.0),
+        ("aq_make_workers", "AQ_MAKE_WORKERS", "0", 0),
+        ("aq_make_debounce_seconds", "AQ_MAKE_DEBOUNCE_SECONDS", "1.5", 1.5),
+        ("aq_make_attempts", "AQ_MAKE_ATTEMPTS", "5", 5),
+        ("aq_make_retry_seconds", "AQ_MAKE_RETRY_SECONDS", "30", 30.0),
+        ("openstack_image_cache_size", "OPENSTACK_IMAGE_CACHE_SIZE", "8", 8),
+        ("openstack_image_cache_ttl", "OPENSTACK_IMAGE_CACHE_TTL", "0", 0.0),
+        ("openstack_batch_seconds", "OPENSTACK_BATCH_SECONDS", "0.2", 0.2),
+        ("openstack_batch_size", "OPENSTACK_BATCH_SIZE", "20", 20),
+        ("consumer_metrics_port", "CONSUMER_METRICS_PORT", "0", 0),
+        ("consumer_retry_attempts", "CONSUMER_RETRY_ATTEMPTS", "0", 0),
+        ("consumer_retry_seconds", "CONSUMER_RETRY_SECONDS", "2.5", 2.5),
+        ("consumer_state_retention_days", "CONSUMER_STATE_RETENTION_DAYS", "1", 1.0),
+        ("consumer_shards", "CONSUMER_SHARDS", "16", 16),
+        ("consumer_replicas", "CONSUMER_REPLICAS", "4", 4),
+        ("consumer_replica_index", "CONSUMER_REPLICA_INDEX", "2", 2),
+        ("consumer_async_concurrency", "CONSUMER_ASYNC_CONCURRENCY", "250", 250),
+        ("consumer_queue_size", "CONSUMER_QUEUE_SIZE", "5", 5),
+        ("consumer_prefetch_count", "CONSUMER_PREFETCH_COUNT", "100", 100),
+        ("consumer_ack_batch_size", "CONSUMER_ACK_BATCH_SIZE", "50", 50),
+        ("pipeline_queue_size", "PIPELINE_QUEUE_SIZE", "10", 10),
+        ("pipeline_enrich_workers", "PIPELINE_ENRICH_WORKERS", "8", 8),
+        ("pipeline_dns_workers", "PIPELINE_DNS_WORKERS", "1", 1),
+        ("pipeline_provision_workers", "PIPELINE_PROVISION_WORKERS", "6", 6),
+        ("pipeline_metadata_workers", "PIPELINE_METADATA_WORKERS", "3", 3),
+        ("dns_cache_size", "DNS_CACHE_SIZE", "100", 100),
+        ("dns_cache_ttl", "DNS_CACHE_TTL", "60", 60.0),
+        ("dns_negative_ttl", "DNS_NEGATIVE_TTL", "0", 0.0),
+        ("dns_lookup_workers", "DNS_LOOKUP_WORKERS", "8", 8),
+        ("openstack_slow_request_seconds", "OPENSTACK_SLOW_REQUEST_SECONDS", "0", 0.0),
+        ("backend_min_concurrency", "BACKEND_MIN_CONCURRENCY", "2", 2),
+        ("backend_max_concurrency", "BACKEND_MAX_CONCURRENCY", "20", 20),
+        ("backend_error_rate", "BACKEND_ERROR_RATE", "0", 0.0),
+        ("backend_error_window", "BACKEND_ERROR_WINDOW", "50", 50),
+        ("backend_open_seconds", "BACKEND_OPEN_SECONDS", "60", 60.0),
+    ],
+)
+def test_config_numeric_env_vars(monkeypatch, config_name, env_var, value, expected):
+    """
+    Test that numeric config values are parsed from the environment
+    """
+    monkeypatch.setenv(env_var, value)
+    assert getattr(ConsumerConfig(), config_name) == expected
+
+
+@pytest.fixture(name="valid_env")
+def fixture_valid_env(monkeypatch):
+    """
+    Sets every required environment variable to a valid value
+    """
+    for _, env_var in AQ_FIELDS + OPENSTACK_FIELDS + RABBIT_FIELDS:
+        monkeypatch.setenv(env_var, "MOCK_ENV")
+    yield
+    consumer_config._config = None  # pylint: disable=protected-access
+
+
+def test_config_is_immutable():
+    """
+    Test that a config snapshot cannot be modified
+    """
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        ConsumerConfig().aq_url = "changed"
+
+
+@pytest.mark.usefixtures("valid_env")
+def test_validate_accepts_complete_config():
+    """
+    Test that a config with all required values passes validation
+    """
+    config = ConsumerConfig()
+    assert config.validate() is config
+
+
+@pytest.mark.usefixtures("valid_env")
+@pytest.mark.parametrize("value", [None, "", "NOT_SET"])
+@pytest.mark.parametrize("env_var", ["AQ_URL", "RABBIT_PASSWORD"])
+def test_validate_rejects_missing_values(monkeypatch, env_var, value):
+    """
+    Test that unset, empty or placeholder values fail validation
+    """
+    if value is None:
+        monkeypatch.delenv(env_var)
+    else:
+        monkeypatch.setenv(env_var, value)
+
+    with pytest.raises(ValueError, match=env_var):
+        ConsumerConfig().validate()
+
+
+@pytest.mark.usefixtures("valid_env")
+@pytest.mark.parametrize(
+    "env_var,value",
+    [
+        ("CONSUMER_WORKERS", "0"),
+        ("CONSUMER_QUEUE_SIZE", "0"),
+        ("AQ_POOL_SIZE", "0"),
+        ("AQ_READ_TIMEOUT", "-1"),
+        ("AQ_MAKE_WORKERS", "-1"),
+        ("AQ_MAKE_ATTEMPTS", "0"),
+        ("OPENSTACK_IMAGE_CACHE_SIZE", "0"),
+        ("CONSUMER_METRICS_PORT", "70000"),
+        ("CONSUMER_RETRY_ATTEMPTS", "-1"),
+        ("CONSUMER_RETRY_SECONDS", "-1"),
+        ("CONSUMER_STATE_RETENTION_DAYS", "-1"),
+        ("CONSUMER_SHARDS", "-1"),
+        ("CONSUMER_REPLICAS", "0"),
+        ("CONSUMER_REPLICAS", "2"),
+        ("CONSUMER_REPLICA_INDEX", "1"),
+        ("CONSUMER_ASYNC_CONCURRENCY", "0"),
+        ("CONSUMER_PREFETCH_COUNT", "-1"),
+        ("CONSUMER_ACK_BATCH_SIZE", "0"),
+        ("PIPELINE_QUEUE_SIZE", "-1"),
+        ("PIPELINE_ENRICH_WORKERS", "0"),
+        ("PIPELINE_METADATA_WORKERS", "0"),
+        ("DNS_CACHE_SIZE", "0"),
+        ("DNS_LOOKUP_WORKERS", "0"),
+        ("DNS_NEGATIVE_TTL", "-1"),
+        ("OPENSTACK_SLOW_REQUEST_SECONDS", "-1"),
+        ("OPENSTACK_BATCH_SECONDS", "-1"),
+        ("OPENSTACK_BATCH_SIZE", "0"),
+        ("BACKEND_MIN_CONCURRENCY", "0"),
+        ("BACKEND_MAX_CONCURRENCY", "0"),
+        ("BACKEND_ERROR_RATE", "1.5"),
+        ("BACKEND_ERROR_WINDOW", "0"),
+        ("BACKEND_OPEN_SECONDS", "-1"),
+    ],
+)
+def test_validate_rejects_out_of_range(monkeypatch, env_var, value):
+    """
+    Test that numeric values outside their valid range fail validation
+    """
+    monkeypatch.setenv(env_var, value)
+    with pytest.raises(ValueError, match=env_var):
+        ConsumerConfig().validate()
+
+
+@pytest.mark.usefixtures("valid_env")
+def test_validate_rejects_ack_batch_above_prefetch(monkeypatch):
+    """
+    Test that an ack batch cannot be larger than the prefetch, as the
+    batch would never fill
+    """
+    monkeypatch.setenv("CONSUMER_PREFETCH_COUNT", "10")
+    monkeypatch.setenv("CONSUMER_ACK_BATCH_SIZE", "20")
+    with pytest.raises(ValueError, match="CONSUMER_ACK_BATCH_SIZE"):
+        ConsumerConfig().validate()
+
+
+@pytest.mark.usefixtures("valid_env")
+def test_validate_accepts_sharded_replicas(monkeypatch):
+    """
+    Test that several replicas are allowed once there is a shard for each
+    """
+    monkeypatch.setenv("CONSUMER_SHARDS", "8")
+    monkeypatch.setenv("CONSUMER_REPLICAS", "3")
+    assert ConsumerConfig().validate().consumer_replicas == 3
+
+
+@pytest.mark.usefixtures("valid_env")
+def test_get_config_loads_once(monkeypatch):
+    """
+    Test that the config is only read from the environment once
+    """
+    first = get_config()
+    monkeypatch.setenv("AQ_URL", "changed")
+    assert get_config() is first
+    assert get_config().aq_url == "MOCK_ENV"
+
+
+@pytest.mark.usefixtures("valid_env")
+def test_load_config_fails_fast(monkeypatch):
+    """
+    Test that loading an invalid config raises immediately
+    """
+    monkeypatch.delenv("AQ_URL")
+    with pytest.raises(ValueError):
+        load_config()
@@ -0,0 +1,128 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the cached DNS resolver
+"""
+import socket
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from rabbit_consumer import dns_resolver
+from rabbit_consumer.dns_resolver import DnsResolver, get_resolver, reset_resolver
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_reverse_cached(gethostbyaddr, resolver):
+    """
+    Tests a reverse lookup is only made once
+    """
+    gethostbyaddr.return_value = ("host.example.com", [], ["127.0.0.1"])
+
+    assert resolver.reverse("127.0.0.1") == "host.example.com"
+    assert resolver.reverse("127.0.0.1") == "host.example.com"
+    gethostbyaddr.assert_called_once_with("127.0.0.1")
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyname")
+def test_forward_cached(gethostbyname, resolver):
+    """
+    Tests a forward lookup is only made once, separately to reverse lookups
+    """
+    gethostbyname.return_value = "127.0.0.1"
+
+    assert resolver.forward("host.example.com") == "127.0.0.1"
+    assert resolver.forward("host.example.com") == "127.0.0.1"
+    gethostbyname.assert_called_once_with("host.example.com")
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_reverse_not_found_cached(gethostbyaddr, resolver):
+    """
+    Tests a missing record is cached and raised again
+    """
+    gethostbyaddr.side_effect = socket.herror(1, "Unknown host")
+
+    for _ in range(2):
+        with pytest.raises(socket.herror):
+            resolver.reverse("127.0.0.1")
+    gethostbyaddr.assert_called_once()
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_reverse_negative_ttl_disabled(gethostbyaddr):
+    """
+    Tests missing records are looked up again when the negative TTL is 0
+    """
+    resolver = DnsResolver(16, positive_ttl=300, negative_ttl=0, lookup_workers=1)
+    gethostbyaddr.side_effect = socket.herror(1, "Unknown host")
+
+    for _ in range(2):
+        with pytest.raises(socket.herror):
+            resolver.reverse("127.0.0.1")
+    assert gethostbyaddr.call_count == 2
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_reverse_failure_not_cached(gethostbyaddr, resolver):
+    """
+    Tests failures such as timeouts are retried on the next lookup
+    """
+    gethostbyaddr.side_effect = [TimeoutError(), ("host.example.com", [], [])]
+
+    with pytest.raises(TimeoutError):
+        resolver.reverse("127.0.0.1")
+    assert resolver.reverse("127.0.0.1") == "host.example.com"
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_reverse_many_concurrent(gethostbyaddr, resolver):
+    """
+    Tests several addresses are looked up concurrently, keeping their order
+    """
+    barrier = threading.Barrier(2, timeout=5)
+
+    def _lookup(ip_addr):
+        # Both lookups must be in flight at the same time to pass the barrier
+        barrier.wait()
+        return f"host-{ip_addr}", [], []
+
+    gethostbyaddr.side_effect = _lookup
+
+    hostnames = resolver.reverse_many(["127.0.0.2", "127.0.0.1"])
+    assert hostnames == ["host-127.0.0.2", "host-127.0.0.1"]
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_stats(gethostbyaddr, resolver):
+    """
+    Tests the hit rate and lookup latency are recorded
+    """
+    gethostbyaddr.return_value = ("host.example.com", [], [])
+    resolver.reverse("127.0.0.1")
+    resolver.reverse("127.0.0.1")
+
+    stats = resolver.stats()
+    assert stats.cache.hit_rate == 0.5
+    assert stats.lookups == 1
+    assert stats.lookup_seconds_max >= stats.lookup_seconds_mean >= 0
+
+
+@patch("rabbit_consumer.dns_resolver.get_config")
+def test_get_resolver_from_config(config):
+    """
+    Tests the resolver is created once from the config
+    """
+    reset_resolver()
+    config.return_value.dns_cache_size = 8
+    config.return_value.dns_cache_ttl = 60
+    config.return_value.dns_negative_ttl = 5
+    config.return_value.dns_lookup_workers = 2
+    config.return_value.dns_slow_lookup_seconds = 1
+
+    assert get_resolver() is get_resolver()
+    config.assert_called_once()
+
+    reset_resolver()
+    assert dns_resolver._resolver is None  # pylint: disable=protected-access
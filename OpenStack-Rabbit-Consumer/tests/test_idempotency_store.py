@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the progress of each message is recorded and
+survives the consumer restarting
+"""
+from unittest.mock import NonCallableMock
+
+from rabbit_consumer.idempotency_store import (
+    STAGE_COMPLETE,
+    STAGE_HOST_CREATED,
+    IdempotencyStore,
+    MessageKey,
+    get_idempotency_store,
+    idempotency_store,
+)
+
+KEY = MessageKey("instance_id", "compute.instance.create.end", "message_id")
+
+
+def test_message_key(rabbit_message):
+    """
+    Test that messages are keyed by their instance, event type and ID
+    """
+    assert MessageKey.from_message(rabbit_message) is None
+
+    rabbit_message.message_id = "message_id"
+    assert MessageKey.from_message(rabbit_message) == MessageKey(
+        "instance_id_mock", "event_type_mock", "message_id"
+    )
+
+
+def test_record_stage():
+    """
+    Test that the last recorded stage is returned for the same message only
+    """
+    store = IdempotencyStore(":memory:", retention_seconds=60)
+    assert store.completed_stage(KEY) is None
+
+    store.record(KEY, STAGE_HOST_CREATED)
+    store.record(KEY, STAGE_COMPLETE)
+
+    assert store.completed_stage(KEY) == STAGE_COMPLETE
+    assert store.completed_stage(MessageKey("instance_id", "other", "id")) is None
+
+
+def test_stages_survive_reopening(tmp_path):
+    """
+    Test that recorded stages are persisted, as for a consumer restart
+    """
+    path = str(tmp_path / "state.db")
+    store = IdempotencyStore(path, retention_seconds=60)
+    store.record(KEY, STAGE_HOST_CREATED)
+    store.close()
+
+    assert IdempotencyStore(path, retention_seconds=60).completed_stage(KEY) == (
+        STAGE_HOST_CREATED
+    )
+
+
+def test_prune_removes_old_records(tmp_path):
+    """
+    Test that records older than the retention period are pruned on opening
+    """
+    path = str(tmp_path / "state.db")
+    now = [1000.0]
+    store = IdempotencyStore(path, retention_seconds=60, clock=lambda: now[0])
+    store.record(KEY, STAGE_COMPLETE)
+    store.close()
+
+    now[0] += 30
+    assert IdempotencyStore(path, 60, clock=lambda: now[0]).completed_stage(KEY)
+
+    now[0] += 60
+    store = IdempotencyStore(path, 60, clock=lambda: now[0])
+    assert store.completed_stage(KEY) is None
+
+
+def test_store_disabled_without_path():
+    """
+    Test that progress is not recorded when no path is configured
+    """
+    config = NonCallableMock(consumer_state_path="")
+    with idempotency_store(config) as store:
+        assert store is None
+        assert get_idempotency_store() is None
+
+
+def test_store_open_for_block(tmp_path):
+    """
+    Test that the store is available for the duration of the block only
+    """
+    config = NonCallableMock(
+        consumer_state_path=str(tmp_path / "state.db"),
+        consumer_state_retention_days=7,
+    )
+    with idempotency_store(config) as store:
+        assert get_idempotency_store() is store
+        store.record(KEY, STAGE_COMPLETE)
+    assert get_idempotency_store() is None
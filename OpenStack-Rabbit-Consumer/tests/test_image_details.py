@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the cached details of an OpenStack image
+"""
+from unittest.mock import NonCallableMock
+
+import pytest
+from mashumaro.exceptions import MissingField
+
+from rabbit_consumer.image_details import ImageDetails
+
+AQ_METADATA = {
+    "AQ_ARCHETYPE": "archetype",
+    "AQ_DOMAIN": "domain",
+    "AQ_PERSONALITY": "personality",
+    "AQ_OS": "os",
+    "AQ_OSVERSION": "osversion",
+}
+
+
+def _image(metadata) -> NonCallableMock:
+    """
+    Returns a mocked OpenStack image with the given metadata
+    """
+    image = NonCallableMock()
+    image.name = "image_name"
+    image.metadata = metadata
+    return image
+
+
+def test_from_image_aq_managed():
+    """
+    Tests an Aquilon image has its metadata parsed
+    """
+    details = ImageDetails.from_image(_image(AQ_METADATA))
+
+    assert details.name == "image_name"
+    assert details.is_aq_managed
+    assert details.aq_metadata.aq_os == "os"
+
+
+@pytest.mark.parametrize("metadata", [{}, None])
+def test_from_image_not_aq_managed(metadata):
+    """
+    Tests an image without Aquilon metadata is not managed
+    """
+    details = ImageDetails.from_image(_image(metadata))
+    assert not details.is_aq_managed
+    assert details.aq_metadata is None
+
+
+def test_get_aq_metadata_returns_copy():
+    """
+    Tests changes to the returned metadata do not affect the cached image
+    """
+    details = ImageDetails.from_image(_image(AQ_METADATA))
+
+    aq_metadata = details.get_aq_metadata()
+    aq_metadata.override_from_vm_meta({"AQ_OS": "other"})
+
+    assert details.get_aq_metadata().aq_os == "os"
+
+
+def test_get_aq_metadata_incomplete():
+    """
+    Tests incomplete Aquilon metadata raises when it is used
+    """
+    details = ImageDetails.from_image(_image({"AQ_OS": "os"}))
+
+    assert details.is_aq_managed
+    with pytest.raises(MissingField):
+        details.get_aq_metadata()
@@ -0,0 +1,252 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the Kerberos ticket state is cached, and the ccache
+expiry time is read correctly
+"""
+import os
+import struct
+from typing import List
+from unittest.mock import patch
+
+import pytest
+
+from rabbit_consumer.kerberos_ticket import (
+    KerberosTicketCache,
+    get_ccache_path,
+    read_ccache_expiry,
+    REFRESH_MARGIN_SECONDS,
+    FALLBACK_TTL_SECONDS,
+)
+
+
+def _octets(data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + data
+
+
+def _principal(realm: bytes, *components: bytes) -> bytes:
+    return (
+        struct.pack(">II", 1, len(components))
+        + _octets(realm)
+        + b"".join(_octets(i) for i in components)
+    )
+
+
+def _credential(server: List[bytes], end_time: int) -> bytes:
+    client = _principal(b"EXAMPLE.COM", b"HTTP", b"host.example.com")
+    return (
+        client
+        + _principal(*server)
+        + struct.pack(">H", 18)
+        + _octets(b"key")
+        + struct.pack(">IIII", 1, 1, end_time, 0)
+        + b"\x00"
+        + struct.pack(">I", 0)
+        + struct.pack(">I", 0)
+        + struct.pack(">I", 0)
+        + _octets(b"ticket")
+        + _octets(b"")
+    )
+
+
+def _ccache(*credentials: bytes) -> bytes:
+    """
+    Builds a version 4 MIT file credential cache
+    """
+    header = struct.pack(">HH", 0x0504, 0)
+    default_principal = _principal(b"EXAMPLE.COM", b"HTTP", b"host.example.com")
+    return header + default_principal + b"".join(credentials)
+
+
+@pytest.fixture(name="ccache_file")
+def fixture_ccache_file(tmp_path):
+    """
+    Returns the path of a ccache holding a TGT which expires at 2000
+    """
+    path = tmp_path / "krb5cc"
+    path.write_bytes(
+        _ccache(
+            _credential([b"EXAMPLE.COM", b"X-CACHECONF:", b"pa_type"], 0),
+            _credential([b"EXAMPLE.COM", b"krbtgt", b"EXAMPLE.COM"], 2000),
+            _credential([b"EXAMPLE.COM", b"HTTP", b"aq.example.com"], 1500),
+        )
+    )
+    return str(path)
+
+
+@pytest.mark.parametrize(
+    "ccname,expected",
+    [
+        ("FILE:/shared/krb5cc", "/shared/krb5cc"),
+        ("/shared/krb5cc", "/shared/krb5cc"),
+        ("KEYRING:persistent:1000", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_get_ccache_path(ccname, expected):
+    """
+    Tests that only file based caches return a path
+    """
+    assert get_ccache_path(ccname) == expected
+
+
+def test_read_ccache_expiry(ccache_file):
+    """
+    Tests that the TGT expiry is read, ignoring other credentials
+    """
+    assert read_ccache_expiry(ccache_file) == 2000.0
+
+
+def test_read_ccache_expiry_missing_file(tmp_path):
+    """
+    Tests that a missing ccache returns None
+    """
+    assert read_ccache_expiry(str(tmp_path / "missing")) is None
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        b"",
+        struct.pack(">H", 0x0401),
+        _ccache(_credential([b"EXAMPLE.COM", b"krbtgt", b"EXAMPLE.COM"], 2000))[:-3],
+        _ccache(),
+    ],
+)
+def test_read_ccache_expiry_unreadable(tmp_path, contents):
+    """
+    Tests that a truncated, unsupported or empty ccache returns None
+    """
+    path = tmp_path / "krb5cc"
+    path.write_bytes(contents)
+    assert read_ccache_expiry(str(path)) is None
+
+
+@pytest.fixture(name="read_expiry")
+def fixture_read_expiry():
+    """
+    Counts the reads of the ccache expiry, whilst still reading it
+    """
+    with patch(
+        "rabbit_consumer.kerberos_ticket.read_ccache_expiry", wraps=read_ccache_expiry
+    ) as read_expiry:
+        yield read_expiry
+
+
+@patch("rabbit_consumer.kerberos_ticket.time.time")
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+def test_ticket_cache_only_checks_once(call, time, ccache_file, read_expiry):
+    """
+    Tests that the ccache is only read once whilst the ticket is valid,
+    and klist is never run as its expiry can be read
+    """
+    time.return_value = 1000
+    cache = KerberosTicketCache(ccache_file)
+
+    for _ in range(5):
+        cache.ensure_valid()
+
+    read_expiry.assert_called_once_with(ccache_file)
+    call.assert_not_called()
+
+
+@patch("rabbit_consumer.kerberos_ticket.time.time")
+def test_ticket_cache_rechecks_near_expiry(time, ccache_file, read_expiry):
+    """
+    Tests that the ticket is rechecked once it is close to expiring
+    """
+    time.return_value = 1000
+    cache = KerberosTicketCache(ccache_file)
+    cache.ensure_valid()
+
+    time.return_value = 2000 - REFRESH_MARGIN_SECONDS - 1
+    cache.ensure_valid()
+    assert read_expiry.call_count == 1
+
+    time.return_value = 2000 - REFRESH_MARGIN_SECONDS
+    cache.ensure_valid()
+    assert read_expiry.call_count == 2
+
+
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+def test_ticket_cache_rechecks_on_ccache_change(call, ccache_file, read_expiry):
+    """
+    Tests that the ticket is rechecked when the sidecar rewrites the
+    ccache, without running klist
+    """
+    cache = KerberosTicketCache(ccache_file)
+
+    with patch("rabbit_consumer.kerberos_ticket.time.time", return_value=1000):
+        cache.ensure_valid()
+        stat = os.stat(ccache_file)
+        os.utime(ccache_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        cache.ensure_valid()
+
+    assert read_expiry.call_count == 2
+    call.assert_not_called()
+
+
+@patch("rabbit_consumer.kerberos_ticket.time.time")
+def test_ticket_cache_invalidate(time, ccache_file, read_expiry):
+    """
+    Tests that invalidating the cache forces a recheck
+    """
+    time.return_value = 1000
+    cache = KerberosTicketCache(ccache_file)
+
+    cache.ensure_valid()
+    cache.invalidate()
+    cache.ensure_valid()
+
+    assert read_expiry.call_count == 2
+
+
+@patch("rabbit_consumer.kerberos_ticket.time.time")
+def test_ticket_cache_expired_ticket(time, ccache_file, read_expiry):
+    """
+    Tests that an expired ticket raises, and is not cached
+    """
+    time.return_value = 2000
+    cache = KerberosTicketCache(ccache_file)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            cache.ensure_valid()
+    assert read_expiry.call_count == 2
+
+
+@patch("rabbit_consumer.kerberos_ticket.time.time")
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+def test_ticket_cache_invalid_ticket(call, time):
+    """
+    Tests that a ticket klist rejects raises, and is not cached
+    """
+    call.side_effect = [1, 1]
+    time.return_value = 1000
+    cache = KerberosTicketCache(None)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            cache.ensure_valid()
+    assert call.call_count == 2
+
+
+@patch("rabbit_consumer.kerberos_ticket.time.time")
+@patch("rabbit_consumer.kerberos_ticket.subprocess.call")
+def test_ticket_cache_fallback_without_ccache(call, time):
+    """
+    Tests that klist is trusted for a fixed time if the ccache can't be read
+    """
+    call.return_value = 0
+    time.return_value = 1000
+    cache = KerberosTicketCache(None)
+
+    cache.ensure_valid()
+    time.return_value = 1000 + FALLBACK_TTL_SECONDS - 1
+    cache.ensure_valid()
+    assert call.call_count == 1
+
+    time.return_value = 1000 + FALLBACK_TTL_SECONDS
+    cache.ensure_valid()
+    assert call.call_count == 2
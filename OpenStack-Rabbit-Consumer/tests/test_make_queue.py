@@ -0,0 +1,214 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests template compiles are queued, debounced and retried
+"""
+import threading
+from unittest.mock import Mock, NonCallableMock, call, patch
+
+import pytest
+
+from rabbit_consumer.aq_api import AquilonError
+from rabbit_consumer.make_queue import MakeQueue, deferred_makes, get_make_queue
+
+
+def _addresses(hostname: str = "host.example.com") -> list:
+    """
+    Returns mocked addresses for the given host
+    """
+    address = NonCallableMock()
+    address.hostname = hostname
+    return [address]
+
+
+@pytest.fixture(name="aq_make")
+def fixture_aq_make():
+    """
+    Patches out the Aquilon make call
+    """
+    with patch("rabbit_consumer.make_queue.aq_api.aq_make") as aq_make:
+        yield aq_make
+
+
+def test_make_runs_then_calls_back(aq_make):
+    """
+    Tests a queued make is run before its callback
+    """
+    addresses, on_success = _addresses(), Mock()
+    with MakeQueue(2, 0, max_attempts=1, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", addresses, on_success)
+
+    aq_make.assert_called_once_with(addresses)
+    on_success.assert_called_once_with()
+    stats = make_queue.stats()
+    assert (stats.depth, stats.completed, stats.failed) == (0, 1, 0)
+
+
+def test_requests_for_same_host_debounced(aq_make):
+    """
+    Tests requests for a VM waiting to run are merged into one make,
+    whilst other VMs are made separately, even with the same hostname
+    """
+    callbacks = [Mock(), Mock(), Mock()]
+    with MakeQueue(1, 60, max_attempts=1, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses(), callbacks[0])
+        make_queue.submit("vm", _addresses(), callbacks[1])
+        make_queue.submit("other", _addresses(), callbacks[2])
+        assert make_queue.depth == 2
+        # Shutting down runs the queued makes without waiting
+
+    assert aq_make.call_count == 2
+    for callback in callbacks:
+        callback.assert_called_once()
+
+
+def test_make_does_not_block_submit(aq_make):
+    """
+    Tests makes run on the queue's workers rather than the caller
+    """
+    release = threading.Event()
+    aq_make.side_effect = lambda _: release.wait(timeout=5)
+
+    with MakeQueue(1, 0, max_attempts=1, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses())
+        make_queue.submit("other", _addresses("other.example.com"))
+        release.set()
+
+    assert aq_make.call_count == 2
+
+
+def test_connection_errors_retried(aq_make):
+    """
+    Tests makes which fail to reach Aquilon are retried
+    """
+    aq_make.side_effect = [ConnectionError(), None]
+    on_success = Mock()
+
+    with MakeQueue(1, 0, max_attempts=2, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses(), on_success)
+
+    assert aq_make.call_count == 2
+    on_success.assert_called_once()
+
+
+def test_retries_exhausted(aq_make):
+    """
+    Tests a make is abandoned after the maximum attempts
+    """
+    aq_make.side_effect = ConnectionError()
+    on_success = Mock()
+
+    with MakeQueue(1, 0, max_attempts=3, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses(), on_success)
+
+    assert aq_make.call_count == 3
+    on_success.assert_not_called()
+    assert make_queue.stats().failed == 1
+
+
+def test_compile_failure_not_retried(aq_make):
+    """
+    Tests a make rejected by Aquilon is not retried
+    """
+    aq_make.side_effect = AquilonError("Compile failed")
+
+    with MakeQueue(1, 0, max_attempts=3, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses())
+
+    aq_make.assert_called_once()
+    assert make_queue.stats().failed == 1
+
+
+def test_cancel_drops_queued_make(aq_make):
+    """
+    Tests a cancelled make never runs, whilst other VMs are still made
+    """
+    on_success = Mock()
+    with MakeQueue(1, 60, max_attempts=1, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses(), on_success)
+        make_queue.submit("other", _addresses("other.example.com"))
+        make_queue.cancel("vm")
+
+    aq_make.assert_called_once()
+    on_success.assert_not_called()
+
+
+def test_cancel_waits_for_running_make(aq_make):
+    """
+    Tests cancelling a make which has started waits for it to finish,
+    and stops it being retried
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def _make(_):
+        started.set()
+        release.wait(timeout=5)
+        raise ConnectionError()
+
+    aq_make.side_effect = _make
+    with MakeQueue(1, 0, max_attempts=3, retry_seconds=0) as make_queue:
+        make_queue.submit("vm", _addresses())
+        started.wait(timeout=5)
+
+        cancel = threading.Thread(target=make_queue.cancel, args=("vm",))
+        cancel.start()
+        cancel.join(timeout=0.1)
+        assert cancel.is_alive()
+        release.set()
+        cancel.join(timeout=5)
+
+    aq_make.assert_called_once()
+
+
+def test_retry_delay_doubles():
+    """
+    Tests the delay between retries doubles each attempt
+    """
+    make_queue = MakeQueue(1, 0, max_attempts=3, retry_seconds=10)
+    with (
+        patch("rabbit_consumer.make_queue.aq_api.aq_make") as aq_make,
+        patch.object(make_queue, "_retry") as retry,
+    ):
+        aq_make.side_effect = ConnectionError()
+        make_queue.submit("vm", _addresses())
+        # pylint: disable=protected-access
+        job = make_queue._next_job()
+        make_queue._run(job)
+        make_queue._run(job)
+
+    assert retry.call_args_list == [call(job, 10), call(job, 20)]
+
+
+def test_empty_hostname_rejected():
+    """
+    Tests a make cannot be queued without a hostname
+    """
+    with pytest.raises(ValueError):
+        MakeQueue(1, 0, max_attempts=1, retry_seconds=0).submit("vm", _addresses(" "))
+
+
+def test_deferred_makes(aq_make):
+    """
+    Tests the queue is only available for the duration of the block
+    """
+    config = NonCallableMock(
+        aq_make_workers=1,
+        aq_make_debounce_seconds=0,
+        aq_make_attempts=1,
+        aq_make_retry_seconds=0,
+    )
+    with deferred_makes(config) as make_queue:
+        assert get_make_queue() is make_queue
+        make_queue.submit("vm", _addresses())
+
+    assert get_make_queue() is None
+    aq_make.assert_called_once()
+
+
+def test_deferred_makes_disabled():
+    """
+    Tests makes are run inline when there are no make workers
+    """
+    with deferred_makes(NonCallableMock(aq_make_workers=0)) as make_queue:
+        assert make_queue is None
+        assert get_make_queue() is None
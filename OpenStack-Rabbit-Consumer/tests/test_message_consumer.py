@@ -4,104 +4,148 @@
 Tests the message consumption flow
 for the consumer
 """
+import threading
+from typing import Dict, Optional
 from unittest.mock import Mock, NonCallableMock, patch, call, MagicMock
 
 import pytest
+from openstack.exceptions import NotFoundException
 
 # noinspection PyUnresolvedReferences
 from rabbit_consumer.consumer_config import ConsumerConfig
+from rabbit_consumer.idempotency_store import (
+    STAGE_COMPLETE,
+    STAGE_HOST_CREATED,
+    STAGE_MADE,
+    IdempotencyStore,
+    MessageKey,
+)
 from rabbit_consumer.message_consumer import (
     on_message,
+    decode_message,
     initiate_consumer,
     add_aq_details_to_metadata,
     handle_create_machine,
     handle_machine_delete,
     SUPPORTED_MESSAGE_TYPES,
+    IMAGE_EVENT_TYPES,
     check_machine_valid,
     is_aq_managed_image,
     get_aq_build_metadata,
     delete_machine,
+    pipeline_stages,
+    ProvisioningResult,
 )
+from rabbit_consumer.message_consumer import consume as consume_message
+from rabbit_consumer.pipeline import PipelineJob
 from rabbit_consumer.vm_data import VmData
 
 
-@pytest.fixture(name="valid_event_type")
-def fixture_valid_event_type():
+@pytest.fixture(name="raw_message")
+def fixture_raw_message(oslo_body_factory):
     """
-    Fixture for a valid event type
+    Returns a function which creates a mocked rabbitpy message holding a
+    notification of the given event type
     """
-    mock = NonCallableMock()
-    mock.event_type = SUPPORTED_MESSAGE_TYPES["create"]
-    return mock
+
+    def _create(event_type: str, payload: Optional[Dict] = None) -> Mock:
+        message = Mock()
+        message.body = oslo_body_factory(event_type, payload)
+        return message
+
+    return _create
 
 
 @patch("rabbit_consumer.message_consumer.consume")
-@patch("rabbit_consumer.message_consumer.MessageEventType")
-@patch("rabbit_consumer.message_consumer.RabbitMessage")
-def test_on_message_parses_json(
-    message_parser, message_event_type, consume, valid_event_type
-):
+def test_on_message_parses_json(consume, raw_message):
     """
     Test that the function parses the message body as JSON
     """
-    message_event_type.from_json.return_value = valid_event_type
+    message = raw_message(SUPPORTED_MESSAGE_TYPES["create"])
+    on_message(message)
 
-    with (
-        patch("rabbit_consumer.message_consumer.json") as json,
-        patch("rabbit_consumer.message_consumer.is_aq_managed_image"),
-    ):
-        message = Mock()
-        on_message(message)
-
-    decoded_body = json.loads.return_value
-    message_parser.from_json.assert_called_once_with(decoded_body["oslo.message"])
-    consume.assert_called_once_with(message_parser.from_json.return_value)
+    consume.assert_called_once()
+    decoded = consume.call_args[0][0]
+    assert decoded.event_type == SUPPORTED_MESSAGE_TYPES["create"]
+    assert decoded.payload.instance_id == "instance_id"
+    assert decoded.project_name == "project_name"
     message.ack.assert_called_once()
 
 
 @patch("rabbit_consumer.message_consumer.consume")
 @patch("rabbit_consumer.message_consumer.is_aq_managed_image")
-@patch("rabbit_consumer.message_consumer.MessageEventType")
-def test_on_message_ignores_wrong_message_type(message_event_type, is_managed, consume):
+def test_on_message_ignores_wrong_message_type(is_managed, consume, raw_message):
     """
     Test that the function ignores messages with the wrong message type
     """
-    message_event = NonCallableMock()
-    message_event.event_type = "wrong"
-    message_event_type.from_json.return_value = message_event
-
-    with patch("rabbit_consumer.message_consumer.json"):
-        message = Mock()
-        on_message(message)
+    message = raw_message("wrong")
+    on_message(message)
 
     is_managed.assert_not_called()
     consume.assert_not_called()
     message.ack.assert_called_once()
 
 
+@patch("rabbit_consumer.message_consumer.RabbitMessage")
+@patch("rabbit_consumer.message_consumer.json_loads")
+def test_decode_message_skips_decoding_ignored_types(
+    json_loads, rabbit_message, raw_message
+):
+    """
+    Test that ignored messages are rejected before the body is decoded
+    """
+    assert decode_message(raw_message("compute.instance.update")) is None
+
+    json_loads.assert_not_called()
+    rabbit_message.from_dict.assert_not_called()
+
+
+def test_decode_message_ambiguous_event_type(raw_message):
+    """
+    Test that a message which can't be filtered cheaply is fully decoded
+    """
+    message = raw_message(
+        SUPPORTED_MESSAGE_TYPES["delete"], {"event_type": "compute.instance.update"}
+    )
+    decoded = decode_message(message)
+    assert decoded.event_type == SUPPORTED_MESSAGE_TYPES["delete"]
+
+
+def test_decode_message_ambiguous_ignored_type(raw_message):
+    """
+    Test that a fully decoded message is still ignored if unsupported
+    """
+    message = raw_message(
+        "compute.instance.update", {"event_type": SUPPORTED_MESSAGE_TYPES["create"]}
+    )
+    assert decode_message(message) is None
+
+
+@pytest.mark.parametrize("event_type", sorted(IMAGE_EVENT_TYPES))
+@patch("rabbit_consumer.message_consumer.openstack_api")
+def test_decode_message_image_event(openstack_api, raw_message, event_type):
+    """
+    Test that image events invalidate the cached image and are not handled
+    """
+    message = raw_message(event_type, {"id": "image-id"})
+    assert decode_message(message) is None
+    openstack_api.invalidate_image_cache.assert_called_once_with("image-id")
+
+
 @pytest.mark.parametrize("event_type", SUPPORTED_MESSAGE_TYPES.values())
 @patch("rabbit_consumer.message_consumer.consume")
-@patch("rabbit_consumer.message_consumer.MessageEventType")
-def test_on_message_accepts_event_types(message_event_type, consume, event_type):
+def test_on_message_accepts_event_types(consume, event_type, raw_message):
     """
     Test that the function accepts the correct event types
     """
-    message_event = NonCallableMock()
-    message_event.event_type = event_type
-    message_event_type.from_json.return_value = message_event
-
-    with (
-        patch("rabbit_consumer.message_consumer.RabbitMessage"),
-        patch("rabbit_consumer.message_consumer.json"),
-    ):
-        message = Mock()
-        on_message(message)
+    message = raw_message(event_type)
+    on_message(message)
 
     consume.assert_called_once()
     message.ack.assert_called_once()
 
 
-# pylint: disable=too-few-public-methods
+# pylint: disable=too-few-public-methods,too-many-ancestors
 class MockedConfig(ConsumerConfig):
     """
     Provides a mocked input config for the consumer
@@ -113,6 +157,23 @@ class MockedConfig(ConsumerConfig):
     rabbit_password = "rabbit_password"
 
 
+def _mock_config(config: Mock, **values) -> None:
+    """
+    Sets the values a mocked config needs to start consuming, with makes
+    inline and no retries, state store, shards or pipeline unless given
+    """
+    defaults = {
+        "aq_make_workers": 0,
+        "consumer_retry_attempts": 0,
+        "consumer_state_path": "",
+        "consumer_shards": 0,
+        "pipeline_queue_size": 0,
+    }
+    for name, value in {**defaults, **values}.items():
+        setattr(config.return_value, name, value)
+
+
+@patch("rabbit_consumer.message_consumer.RetryRouter", MagicMock())
 @patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
 @patch("rabbit_consumer.message_consumer.rabbitpy")
 def test_initiate_consumer_channel_setup(rabbitpy, _):
@@ -121,7 +182,7 @@ def test_initiate_consumer_channel_setup(rabbitpy, _):
     """
     mocked_config = MockedConfig()
 
-    with patch("rabbit_consumer.message_consumer.ConsumerConfig") as config:
+    with patch("rabbit_consumer.message_consumer.get_config") as config:
         config.return_value = mocked_config
         initiate_consumer()
 
@@ -130,7 +191,7 @@ def test_initiate_consumer_channel_setup(rabbitpy, _):
     )
 
     connection = rabbitpy.Connection.return_value.__enter__.return_value
-    connection.channel.assert_called_once()
+    assert connection.channel.call_count == 2
     channel = connection.channel.return_value.__enter__.return_value
 
     rabbitpy.Queue.assert_called_once_with(channel, name="ral.info", durable=True)
@@ -139,19 +200,300 @@ def test_initiate_consumer_channel_setup(rabbitpy, _):
 
 
 @patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
-@patch("rabbit_consumer.message_consumer.on_message")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool", MagicMock())
 @patch("rabbit_consumer.message_consumer.rabbitpy")
-def test_initiate_consumer_actual_consumption(rabbitpy, message_mock, _):
+def test_initiate_consumer_binds_image_exchange(rabbitpy, _):
     """
-    Test that the function actually consumes messages
+    Test that the queue is bound to the image exchange when configured
+    """
+    with patch("rabbit_consumer.message_consumer.get_config") as config:
+        _mock_config(config, rabbit_image_exchange="glance")
+        initiate_consumer()
+
+    rabbitpy.Queue.return_value.bind.assert_has_calls(
+        [call("nova", routing_key="ral.info"), call("glance", routing_key="ral.info")]
+    )
+
+
+@patch("rabbit_consumer.message_consumer.get_config", MockedConfig)
+@patch("rabbit_consumer.message_consumer.RetryRouter", MagicMock())
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.decode_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_actual_consumption(rabbitpy, decode, pool_class, _):
+    """
+    Test that the function actually consumes messages, handing supported
+    messages to the worker pool and having it ack the rest
     """
     queue_messages = [NonCallableMock(), NonCallableMock()]
     # We need our mocked queue to act like a generator
     rabbitpy.Queue.return_value.__iter__.return_value = queue_messages
+    decoded = NonCallableMock()
+    decode.side_effect = [decoded, None]
+
+    initiate_consumer()
+
+    decode.assert_has_calls([call(message) for message in queue_messages])
+    pool = pool_class.return_value.__enter__.return_value
+    pool.submit.assert_called_once_with(queue_messages[0], decoded)
+    pool.ignore.assert_called_once_with(queue_messages[1])
+
+
+@patch("rabbit_consumer.message_consumer.get_config", MockedConfig)
+@patch("rabbit_consumer.message_consumer.RetryRouter")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_routes_failures(rabbitpy, pool_class, _, router_class):
+    """
+    Test that failed messages are handed to a retry router with its own
+    confirmed channel, which has declared its queues before consuming
+    """
+    initiate_consumer()
+
+    channel = rabbitpy.Connection.return_value.__enter__.return_value.channel
+    channel.return_value.enable_publisher_confirms.assert_called_once_with()
+    router_class.assert_called_once_with(
+        channel.return_value,
+        queue_name="ral.info",
+        max_attempts=MockedConfig().consumer_retry_attempts,
+        retry_seconds=MockedConfig().consumer_retry_seconds,
+    )
+    router_class.return_value.declare.assert_called_once()
+    assert pool_class.call_args[0][3] == router_class.return_value
+
+
+@patch("rabbit_consumer.message_consumer.get_config")
+@patch("rabbit_consumer.message_consumer.RetryRouter")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.rabbitpy", MagicMock())
+def test_initiate_consumer_retries_disabled(pool_class, _, router_class, config):
+    """
+    Test that no retry router is used when retries are disabled
+    """
+    _mock_config(config)
+    initiate_consumer()
+
+    router_class.assert_not_called()
+    assert pool_class.call_args[0][3] is None
+
+
+@patch("rabbit_consumer.message_consumer.get_config", MockedConfig)
+@patch("rabbit_consumer.message_consumer.RetryRouter", MagicMock())
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.decode_message")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_dead_letters_undecodable(rabbitpy, decode, pool_class, _):
+    """
+    Test that messages which cannot be decoded are dead-lettered
+    without stopping the consumer
+    """
+    queue_messages = [NonCallableMock(), NonCallableMock()]
+    rabbitpy.Queue.return_value.__iter__.return_value = queue_messages
+    error = ValueError("Not JSON")
+    decoded = NonCallableMock()
+    decode.side_effect = [error, decoded]
+
+    initiate_consumer()
+
+    pool = pool_class.return_value.__enter__.return_value
+    pool.reject.assert_called_once_with(
+        queue_messages[0], error, "unknown", retry=False
+    )
+    pool.submit.assert_called_once_with(queue_messages[1], decoded)
+
+
+@pytest.mark.parametrize(
+    "replica,expected",
+    [
+        (
+            0,
+            {
+                "shard-router": "ral.info",
+                "shard-0": "ral.info.shard.0",
+                "shard-2": "ral.info.shard.2",
+            },
+        ),
+        (1, {"shard-1": "ral.info.shard.1", "shard-3": "ral.info.shard.3"}),
+    ],
+)
+@patch("rabbit_consumer.message_consumer.RetryRouter", MagicMock())
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket", MagicMock())
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool", MagicMock())
+@patch("rabbit_consumer.message_consumer.ShardRouter")
+@patch("rabbit_consumer.message_consumer.consume_concurrently")
+@patch("rabbit_consumer.message_consumer.declare_shards")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_initiate_consumer_sharded(
+    rabbitpy, declare, consume_loops, router_class, replica, expected
+):
+    """
+    Test that each replica consumes its own shards, and only the
+    first replica routes ral.info onto them
+    """
+    config = MockedConfig(
+        consumer_shards=4, consumer_replicas=2, consumer_replica_index=replica
+    )
+    with patch("rabbit_consumer.message_consumer.get_config", return_value=config):
+        initiate_consumer()
+
+    channel = rabbitpy.Connection.return_value.__enter__.return_value.channel
+    declare.assert_called_once_with(channel.return_value.__enter__.return_value, 4)
+    loops = consume_loops.call_args.args[0]
+    assert list(loops) == list(expected)
+    assert router_class.called == (replica == 0)
+    # The first queue is ral.info, declared on the main channel
+    queue_names = [c.kwargs["name"] for c in rabbitpy.Queue.call_args_list]
+    assert queue_names[1:] == list(expected.values())
+
+
+@patch("rabbit_consumer.message_consumer.get_config")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_worker_count(rabbitpy, pool_class, _, config):
+    """
+    Test that the worker pool is sized from the config, and a configured
+    prefetch overrides the pool's own
+    """
+    _mock_config(
+        config,
+        consumer_workers=4,
+        consumer_prefetch_count=200,
+        consumer_ack_batch_size=50,
+    )
+    initiate_consumer()
+    pool_class.assert_called_once()
+    assert pool_class.call_args[0][0] == 4
+    assert pool_class.call_args[0][4] == 50
+    assert pool_class.call_args.kwargs["queue_size"] == (
+        config.return_value.consumer_queue_size
+    )
+    channel = rabbitpy.Connection.return_value.__enter__.return_value.channel
+    channel.return_value.__enter__.return_value.prefetch_count.assert_called_once_with(
+        200
+    )
+
+
+@patch("rabbit_consumer.message_consumer.get_config")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.CreateDeleteCoalescer")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_coalesces(_, pool_class, coalescer_class, __, config):
+    """
+    Test that the worker pool coalesces creates and deletes
+    """
+    _mock_config(config, consumer_coalesce_seconds=5)
+    initiate_consumer()
+
+    coalescer_class.assert_called_once_with(
+        5,
+        create_event_type=SUPPORTED_MESSAGE_TYPES["create"],
+        delete_event_type=SUPPORTED_MESSAGE_TYPES["delete"],
+    )
+    assert pool_class.call_args[0][2] == coalescer_class.return_value
+
+
+@patch("rabbit_consumer.message_consumer.get_config")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.deferred_makes")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_defers_makes(_, __, deferred, ___, config):
+    """
+    Test that makes are deferred to a queue whilst consuming
+    """
+    _mock_config(config)
+    initiate_consumer()
+    deferred.assert_called_once_with(config.return_value)
+    deferred.return_value.__enter__.assert_called_once()
+
 
+@patch("rabbit_consumer.message_consumer.get_config")
+@patch("rabbit_consumer.message_consumer.verify_kerberos_ticket")
+@patch("rabbit_consumer.message_consumer.StagedPipeline")
+@patch("rabbit_consumer.message_consumer.MessageWorkerPool")
+@patch("rabbit_consumer.message_consumer.rabbitpy")
+def test_initiate_consumer_pipeline(rabbitpy, pool_class, pipeline_class, _, config):
+    """
+    Test that messages are passed through the pipeline when its queue
+    size is set, with the prefetch limited to what it can hold
+    """
+    _mock_config(config, pipeline_queue_size=5, consumer_prefetch_count=0)
+    pipeline = pipeline_class.return_value.__enter__.return_value
+    pipeline.prefetch_count = 40
     initiate_consumer()
 
-    message_mock.assert_has_calls([call(message) for message in queue_messages])
+    pool_class.assert_not_called()
+    stages, queue_size = pipeline_class.call_args[0][:2]
+    assert [stage.name for stage in stages] == [
+        "enrich",
+        "dns",
+        "provision",
+        "metadata",
+    ]
+    assert queue_size == 5
+    channel = rabbitpy.Connection.return_value.__enter__.return_value.channel
+    channel.return_value.__enter__.return_value.prefetch_count.assert_called_once_with(
+        40
+    )
+
+
+@patch("rabbit_consumer.message_consumer.consume")
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+@patch("rabbit_consumer.message_consumer.openstack_api", MagicMock())
+@patch("rabbit_consumer.message_consumer.check_machine_valid", Mock(return_value=True))
+@patch("rabbit_consumer.message_consumer.get_aq_build_metadata", Mock())
+@patch("rabbit_consumer.message_consumer.delete_machine", Mock())
+@patch("rabbit_consumer.message_consumer.get_make_queue", Mock(side_effect=Exception))
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_pipeline_stages_create(
+    metadata, aq_api, consume, rabbit_message, openstack_address_list
+):
+    """
+    Test that a create is handled in steps by the pipeline stages, passing
+    what each stage found on to the next, and making without the make queue
+    """
+    rabbit_message.event_type = SUPPORTED_MESSAGE_TYPES["create"]
+    job = PipelineJob(NonCallableMock(), rabbit_message)
+    stages = pipeline_stages(MockedConfig())
+
+    with patch(
+        "rabbit_consumer.message_consumer.openstack_api.get_server_networks",
+        return_value=openstack_address_list,
+    ):
+        assert [stage.handler(job) for stage in stages[:3]] == [True, True, True]
+    assert not stages[3].handler(job)
+
+    aq_api.add_machine_nics.assert_called_once_with(
+        aq_api.create_machine.return_value, openstack_address_list
+    )
+    aq_api.aq_make.assert_called_once_with(openstack_address_list)
+    metadata.assert_called_once_with(job.state.vm_data, job.state.result)
+    assert job.state.result.machine_name == aq_api.create_machine.return_value
+    assert job.state.result.hostnames == [i.hostname for i in openstack_address_list]
+    consume.assert_not_called()
+
+
+@patch("rabbit_consumer.message_consumer.consume")
+def test_pipeline_stages_delete(consume, rabbit_message):
+    """
+    Test that a delete passes through to the provision stage,
+    which handles it in full
+    """
+    rabbit_message.event_type = SUPPORTED_MESSAGE_TYPES["delete"]
+    job = PipelineJob(NonCallableMock(), rabbit_message)
+    stages = pipeline_stages(MockedConfig())
+
+    assert stages[0].handler(job) and stages[1].handler(job)
+    assert not stages[2].handler(job)
+    consume.assert_called_once_with(rabbit_message)
 
 
 @patch("rabbit_consumer.message_consumer.openstack_api")
@@ -160,33 +502,85 @@ def test_add_aq_details_to_metadata(
     aq_api, openstack_api, vm_data, openstack_address_list
 ):
     """
-    Test that the function adds the hostname to the metadata when the machine exists
+    Test that the function adds the hostname to the metadata from what
+    was found whilst provisioning, without looking anything up again
     """
-    openstack_api.check_machine_exists.return_value = True
-    add_aq_details_to_metadata(vm_data, openstack_address_list)
-
     hostnames = [i.hostname for i in openstack_address_list]
+    result = ProvisioningResult(NonCallableMock(), hostnames, "machine_name")
+    add_aq_details_to_metadata(vm_data, result)
+
     expected = {
         "HOSTNAMES": ",".join(hostnames),
         "AQ_STATUS": "SUCCESS",
-        "AQ_MACHINE": aq_api.search_machine_by_serial.return_value,
+        "AQ_MACHINE": "machine_name",
     }
 
-    openstack_api.check_machine_exists.assert_called_once_with(vm_data)
+    openstack_api.check_machine_exists.assert_not_called()
+    aq_api.search_machine_by_serial.assert_not_called()
+    openstack_api.update_metadata.assert_called_once_with(
+        vm_data, expected, result.server
+    )
+
+
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.aq_api")
+def test_add_aq_details_to_metadata_resumed(aq_api, openstack_api, vm_data):
+    """
+    Test that the machine name is searched for when a resumed create
+    did not make the machine itself
+    """
+    add_aq_details_to_metadata(vm_data, ProvisioningResult(hostnames=["host"]))
+
     aq_api.search_machine_by_serial.assert_called_once_with(vm_data)
-    openstack_api.update_metadata.assert_called_with(vm_data, expected)
+    metadata = openstack_api.update_metadata.call_args.args[1]
+    assert metadata["AQ_MACHINE"] == aq_api.search_machine_by_serial.return_value
 
 
 @patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.aq_api", Mock())
 def test_add_hostname_to_metadata_machine_does_not_exist(openstack_api, vm_data):
     """
-    Test that the function does not add the hostname to the metadata when the machine does not exist
+    Test that a machine deleted whilst being provisioned is skipped
     """
-    openstack_api.check_machine_exists.return_value = False
-    add_aq_details_to_metadata(vm_data, [])
+    openstack_api.update_metadata.side_effect = NotFoundException()
+    add_aq_details_to_metadata(vm_data, ProvisioningResult(machine_name="name"))
 
-    openstack_api.check_machine_exists.assert_called_once_with(vm_data)
-    openstack_api.update_metadata.assert_not_called()
+    openstack_api.update_metadata.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "event_type,handler",
+    [
+        (SUPPORTED_MESSAGE_TYPES["create"], "handle_create_machine"),
+        (SUPPORTED_MESSAGE_TYPES["delete"], "handle_machine_delete"),
+    ],
+)
+@patch("rabbit_consumer.message_consumer.openstack_api")
+def test_consume_dispatches_within_server_cache(openstack_api, event_type, handler):
+    """
+    Test that consume calls the correct handler whilst server lookups are cached
+    """
+    message = NonCallableMock()
+    message.event_type = event_type
+
+    with patch(f"rabbit_consumer.message_consumer.{handler}") as handler_mock:
+        consume_message(message)
+
+    handler_mock.assert_called_once_with(message)
+    openstack_api.server_cache.assert_called_once_with()
+    openstack_api.server_cache.return_value.__enter__.assert_called_once()
+
+
+@patch("rabbit_consumer.message_consumer.openstack_api")
+def test_consume_rejects_unsupported(_):
+    """
+    Test that consume raises for an unknown event type
+    """
+    message = NonCallableMock()
+    message.event_type = "unsupported"
+
+    with pytest.raises(ValueError):
+        consume_message(message)
 
 
 @patch("rabbit_consumer.message_consumer.check_machine_valid")
@@ -231,7 +625,7 @@ def test_consume_create_machine_hostnames_good_path(
         network_details = openstack.get_server_networks.return_value
 
     data_patch.from_message.assert_called_with(rabbit_message)
-    openstack.get_server_networks.assert_called_with(vm_data)
+    openstack.get_server_networks.assert_called_with(vm_data, resolve_hostnames=False)
 
     # Check main Aq Flow
     delete_machine_mock.assert_called_once_with(vm_data, network_details[0])
@@ -248,8 +642,130 @@ def test_consume_create_machine_hostnames_good_path(
     )
     aq_api.aq_make.assert_called_once_with(network_details)
 
-    # Metadata
-    metadata.assert_called_once_with(vm_data, network_details)
+    # Metadata, passing on what was found whilst provisioning
+    result = ProvisioningResult(
+        openstack.get_server_details.return_value,
+        [i.hostname for i in network_details],
+        machine_name,
+    )
+    metadata.assert_called_once_with(vm_data, result)
+
+
+@patch("rabbit_consumer.message_consumer.openstack_api")
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+@patch("rabbit_consumer.message_consumer.get_make_queue")
+@patch("rabbit_consumer.message_consumer.check_machine_valid", Mock(return_value=True))
+@patch("rabbit_consumer.message_consumer.get_aq_build_metadata", Mock())
+@patch("rabbit_consumer.message_consumer.delete_machine", Mock())
+def test_consume_create_machine_deferred_make(
+    make_queue, metadata, aq_api, openstack, rabbit_message
+):
+    """
+    Test that the make is queued when makes are deferred, with
+    the metadata only updated once the make completes
+    """
+    handle_create_machine(rabbit_message)
+
+    network_details = openstack.get_server_networks.return_value
+    aq_api.aq_make.assert_not_called()
+    metadata.assert_not_called()
+
+    ((args, kwargs),) = make_queue.return_value.submit.call_args_list
+    assert args == (rabbit_message.payload.instance_id, network_details)
+    kwargs["on_success"]()
+    metadata.assert_called_once()
+
+
+@pytest.fixture(name="state_store")
+def fixture_state_store(rabbit_message):
+    """
+    Gives the rabbit message an ID, and records progress in an in-memory store
+    """
+    rabbit_message.message_id = "message_id"
+    store = IdempotencyStore(":memory:", retention_seconds=60)
+    with patch(
+        "rabbit_consumer.message_consumer.get_idempotency_store", return_value=store
+    ):
+        yield store
+    store.close()
+
+
+@patch("rabbit_consumer.message_consumer.openstack_api", MagicMock())
+@patch("rabbit_consumer.message_consumer.aq_api", Mock())
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata", Mock())
+@patch("rabbit_consumer.message_consumer.check_machine_valid", Mock(return_value=True))
+@patch("rabbit_consumer.message_consumer.get_aq_build_metadata", Mock())
+@patch("rabbit_consumer.message_consumer.delete_machine", Mock())
+def test_create_machine_records_stages(state_store, rabbit_message):
+    """
+    Test that a create is recorded as complete once the metadata is written
+    """
+    handle_create_machine(rabbit_message)
+    key = MessageKey.from_message(rabbit_message)
+    assert state_store.completed_stage(key) == STAGE_COMPLETE
+
+
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.check_machine_valid")
+def test_create_machine_skips_completed(
+    check_machine, aq_api, state_store, rabbit_message
+):
+    """
+    Test that a redelivered create which already completed is skipped
+    """
+    state_store.record(MessageKey.from_message(rabbit_message), STAGE_COMPLETE)
+    handle_create_machine(rabbit_message)
+
+    check_machine.assert_not_called()
+    aq_api.create_machine.assert_not_called()
+
+
+@pytest.mark.parametrize("stage,make_calls", [(STAGE_HOST_CREATED, 1), (STAGE_MADE, 0)])
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.add_aq_details_to_metadata")
+@patch("rabbit_consumer.message_consumer.delete_machine")
+@patch("rabbit_consumer.message_consumer.openstack_api", MagicMock())
+@patch("rabbit_consumer.message_consumer.check_machine_valid", Mock(return_value=True))
+@patch("rabbit_consumer.message_consumer.get_aq_build_metadata", Mock())
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def test_create_machine_resumes(
+    delete_machine_mock,
+    metadata,
+    aq_api,
+    state_store,
+    rabbit_message,
+    stage,
+    make_calls,
+):
+    """
+    Test that a redelivered create resumes after the last completed stage
+    """
+    key = MessageKey.from_message(rabbit_message)
+    state_store.record(key, stage)
+    handle_create_machine(rabbit_message)
+
+    delete_machine_mock.assert_not_called()
+    aq_api.create_machine.assert_not_called()
+    aq_api.create_host.assert_not_called()
+    assert aq_api.aq_make.call_count == make_calls
+    metadata.assert_called_once()
+    assert state_store.completed_stage(key) == STAGE_COMPLETE
+
+
+@patch("rabbit_consumer.message_consumer.delete_machine")
+def test_delete_machine_skips_completed(
+    delete_machine_mock, state_store, rabbit_message
+):
+    """
+    Test that a delete is recorded once done, then skipped if redelivered
+    """
+    handle_machine_delete(rabbit_message)
+    handle_machine_delete(rabbit_message)
+
+    delete_machine_mock.assert_called_once()
+    key = MessageKey.from_message(rabbit_message)
+    assert state_store.completed_stage(key) == STAGE_COMPLETE
 
 
 @patch("rabbit_consumer.message_consumer.delete_machine")
@@ -267,6 +783,20 @@ def test_consume_delete_machine_good_path(delete_machine_mock, rabbit_message):
     )
 
 
+@patch("rabbit_consumer.message_consumer.get_make_queue")
+@patch("rabbit_consumer.message_consumer.delete_machine")
+def test_delete_machine_cancels_queued_make(delete_mock, make_queue, rabbit_message):
+    """
+    Test that a delete cancels any make its VM's create queued
+    """
+    handle_machine_delete(rabbit_message)
+
+    make_queue.return_value.cancel.assert_called_once_with(
+        rabbit_message.payload.instance_id
+    )
+    delete_mock.assert_called_once()
+
+
 @patch("rabbit_consumer.message_consumer.is_aq_managed_image")
 @patch("rabbit_consumer.message_consumer.openstack_api")
 def test_check_machine_valid(openstack_api, is_aq_managed):
@@ -324,7 +854,7 @@ def test_is_aq_managed_image(openstack_api, vm_data):
     """
     Test that the function returns True when the image is AQ managed
     """
-    openstack_api.get_image.return_value.metadata = {"AQ_OS": "True"}
+    openstack_api.get_image.return_value.is_aq_managed = True
 
     assert is_aq_managed_image(vm_data)
     openstack_api.get_image.assert_called_once_with(vm_data)
@@ -347,25 +877,23 @@ def test_is_aq_managed_image_missing_key(openstack_api, vm_data):
     """
     Test that the function returns False when the image is not AQ managed
     """
-    openstack_api.get_image.return_value.metadata = {}
+    openstack_api.get_image.return_value.is_aq_managed = False
 
     assert not is_aq_managed_image(vm_data)
     openstack_api.get_image.assert_called_once_with(vm_data)
 
 
-@patch("rabbit_consumer.message_consumer.AqMetadata")
 @patch("rabbit_consumer.message_consumer.openstack_api")
-def test_get_aq_build_metadata(openstack_api, aq_metadata_class, vm_data):
+def test_get_aq_build_metadata(openstack_api, vm_data):
     """
     Test that the function returns the correct metadata
     """
     aq_metadata_obj: MagicMock = get_aq_build_metadata(vm_data)
 
-    # We should first construct from an image
-    assert aq_metadata_obj == aq_metadata_class.from_dict.return_value
-    aq_metadata_class.from_dict.assert_called_once_with(
-        openstack_api.get_image.return_value.metadata
-    )
+    # We should first take a copy of the image's metadata
+    image = openstack_api.get_image.return_value
+    assert aq_metadata_obj == image.get_aq_metadata.return_value
+    image.get_aq_metadata.assert_called_once_with()
 
     # Then override with an object
     openstack_api.get_server_metadata.assert_called_once_with(vm_data)
@@ -409,32 +937,59 @@ def test_delete_machine_by_serial(aq_api, vm_data, openstack_address):
 
 
 @patch("rabbit_consumer.message_consumer.aq_api")
-@patch("rabbit_consumer.message_consumer.socket")
-def test_delete_machine_no_hostname(socket_api, aq_api, vm_data):
+def test_delete_machine_lookups_concurrent(aq_api, vm_data, openstack_address):
+    """
+    Tests that independent lookups are in flight at the same time
+    """
+    # Each pair of lookups can only pass the barrier together
+    barrier = threading.Barrier(2, timeout=5)
+
+    def _lookup(result):
+        def _wait(*_):
+            barrier.wait()
+            return result
+
+        return _wait
+
+    aq_api.check_host_exists.side_effect = _lookup(False)
+    aq_api.search_machine_by_serial.side_effect = _lookup("machine_name")
+    aq_api.search_host_by_machine.side_effect = _lookup(None)
+    aq_api.get_machine_details.side_effect = _lookup("")
+
+    delete_machine(vm_data, openstack_address)
+    aq_api.delete_machine.assert_called_once_with("machine_name")
+
+
+@patch("rabbit_consumer.message_consumer.aq_api")
+@patch("rabbit_consumer.message_consumer.get_resolver")
+def test_delete_machine_no_hostname(resolver, aq_api, vm_data):
     """
     Tests
     """
     aq_api.check_host_exists.return_value = False
 
     ip_address = "127.0.0.1"
-    socket_api.gethostbyname.return_value = ip_address
+    resolver.return_value.forward.return_value = ip_address
 
     machine_name = aq_api.search_machine_by_serial.return_value
     aq_api.get_machine_details.return_value = f"eth0: {ip_address}"
 
     delete_machine(vm_data, NonCallableMock())
+    resolver.return_value.forward.assert_called_once_with(
+        aq_api.search_host_by_machine.return_value
+    )
     aq_api.delete_address.assert_called_once_with(ip_address, machine_name)
     aq_api.delete_interface.assert_called_once_with(machine_name)
 
 
 @patch("rabbit_consumer.message_consumer.aq_api")
-@patch("rabbit_consumer.message_consumer.socket")
-def test_delete_machine_always_called(socket_api, aq_api, vm_data):
+@patch("rabbit_consumer.message_consumer.get_resolver")
+def test_delete_machine_always_called(resolver, aq_api, vm_data):
     """
     Tests that the function always calls the delete machine function
     """
     aq_api.check_host_exists.return_value = False
-    socket_api.gethostbyname.return_value = "123123"
+    resolver.return_value.forward.return_value = "123123"
 
     aq_api.get_machine_details.return_value = "Machine Details"
 
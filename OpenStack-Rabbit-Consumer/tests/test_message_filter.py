@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the raw message event type pre-filter
+"""
+import json
+from unittest.mock import patch
+
+import pytest
+
+from rabbit_consumer.message_filter import json_loads, peek_event_type
+
+
+def _envelope(notification: dict) -> bytes:
+    """
+    Wraps a notification in an oslo.message envelope as sent by Nova
+    """
+    return json.dumps(
+        {"oslo.version": "2.0", "oslo.message": json.dumps(notification)}
+    ).encode("utf-8")
+
+
+@pytest.mark.parametrize(
+    "event_type",
+    [
+        "compute.instance.create.end",
+        "compute.instance.delete.start",
+        "compute.instance.exists",
+        "scheduler.select_destinations-start",
+    ],
+)
+def test_peek_event_type(event_type):
+    """
+    Tests the event type is extracted from an encoded message
+    """
+    raw = _envelope({"message_id": "id", "event_type": event_type, "payload": {}})
+    assert peek_event_type(raw) == event_type
+
+
+def test_peek_event_type_missing():
+    """
+    Tests that None is returned when there is no event type
+    """
+    assert peek_event_type(_envelope({"payload": {}})) is None
+
+
+def test_peek_event_type_ambiguous():
+    """
+    Tests that None is returned when the payload also has an event type
+    """
+    raw = _envelope(
+        {
+            "event_type": "compute.instance.update",
+            "payload": {"event_type": "compute.instance.create.end"},
+        }
+    )
+    assert peek_event_type(raw) is None
+
+
+def test_peek_event_type_not_an_envelope():
+    """
+    Tests that an unwrapped message is left for full decoding
+    """
+    raw = json.dumps({"event_type": "compute.instance.update"}).encode("utf-8")
+    assert peek_event_type(raw) is None
+
+
+@pytest.mark.parametrize("data", [b'{"key": [1, 2]}', '{"key": [1, 2]}'])
+def test_json_loads(data):
+    """
+    Tests JSON is decoded from either bytes or strings
+    """
+    assert json_loads(data) == {"key": [1, 2]}
+
+
+@patch("rabbit_consumer.message_filter.orjson", None)
+def test_json_loads_without_orjson():
+    """
+    Tests the standard library is used when orjson is unavailable
+    """
+    assert json_loads(b'{"key": "value"}') == {"key": "value"}
@@ -0,0 +1,127 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the consumer's Prometheus metrics are recorded and served
+"""
+from typing import Dict, Optional
+from unittest.mock import Mock, NonCallableMock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer import metrics
+from rabbit_consumer.message_consumer import SUPPORTED_MESSAGE_TYPES, decode_message
+from rabbit_consumer.worker_pool import MessageWorkerPool
+
+
+def _sample(name: str, labels: Optional[Dict[str, str]] = None) -> float:
+    """
+    Returns the current value of a metric, treating unset metrics as 0
+    """
+    return REGISTRY.get_sample_value(name, labels or {}) or 0.0
+
+
+@pytest.fixture(name="raw_message")
+def fixture_raw_message(oslo_body_factory):
+    """
+    Returns a function which creates a mocked message of the given event type
+    """
+    return lambda event_type: Mock(body=oslo_body_factory(event_type))
+
+
+def test_decode_counts_ignored(raw_message):
+    """
+    Tests ignored messages are counted as consumed and ignored
+    """
+    labels = {"event_type": "compute.instance.update"}
+    consumed = _sample("rabbit_consumer_messages_consumed_total", labels)
+    ignored = _sample("rabbit_consumer_messages_ignored_total", labels)
+
+    decode_message(raw_message("compute.instance.update"))
+
+    assert _sample("rabbit_consumer_messages_consumed_total", labels) == consumed + 1
+    assert _sample("rabbit_consumer_messages_ignored_total", labels) == ignored + 1
+    assert _sample("rabbit_consumer_seconds_since_last_message") < 60
+
+
+def test_decode_records_latency(raw_message):
+    """
+    Tests the time spent decoding is recorded
+    """
+    labels = {"stage": "decode"}
+    count = _sample("rabbit_consumer_stage_duration_seconds_count", labels)
+
+    decode_message(raw_message(SUPPORTED_MESSAGE_TYPES["create"]))
+
+    assert _sample("rabbit_consumer_stage_duration_seconds_count", labels) == count + 1
+
+
+def test_decode_counts_undecodable():
+    """
+    Tests messages which cannot be decoded are counted as failed
+    """
+    labels = {"event_type": metrics.UNKNOWN_EVENT_TYPE}
+    failed = _sample("rabbit_consumer_messages_failed_total", labels)
+
+    with pytest.raises(ValueError):
+        decode_message(Mock(body=b"not json"))
+
+    assert _sample("rabbit_consumer_messages_failed_total", labels) == failed + 1
+
+
+def test_pool_counts_outcomes():
+    """
+    Tests handled messages are counted as acked or failed,
+    and are no longer in flight once finished
+    """
+    labels = {"event_type": "test.pool"}
+    acked = _sample("rabbit_consumer_messages_acked_total", labels)
+    failed = _sample("rabbit_consumer_messages_failed_total", labels)
+
+    decoded = NonCallableMock(event_type="test.pool")
+    decoded.payload.instance_id = "instance_id"
+    handler = Mock(side_effect=[None, RuntimeError()])
+    with MessageWorkerPool(1, handler) as pool:
+        pool.submit(Mock(), decoded)
+        pool.submit(Mock(), decoded)
+
+    assert _sample("rabbit_consumer_messages_acked_total", labels) == acked + 1
+    assert _sample("rabbit_consumer_messages_failed_total", labels) == failed + 1
+    assert _sample("rabbit_consumer_messages_in_flight") == 0
+
+
+def test_cache_lookup():
+    """
+    Tests cache hits and misses are counted separately
+    """
+    hit_labels = {"cache": "test", "result": "hit"}
+    hits = _sample("rabbit_consumer_cache_requests_total", hit_labels)
+
+    metrics.cache_lookup("test", True)
+    metrics.cache_lookup("test", False)
+
+    assert _sample("rabbit_consumer_cache_requests_total", hit_labels) == hits + 1
+    assert (
+        _sample(
+            "rabbit_consumer_cache_requests_total", {**hit_labels, "result": "miss"}
+        )
+        >= 1
+    )
+
+
+@patch("rabbit_consumer.metrics.start_http_server")
+def test_start_metrics_server(start_http_server):
+    """
+    Tests the metrics are served on the configured port
+    """
+    metrics.start_metrics_server(9100)
+    start_http_server.assert_called_once_with(9100)
+
+
+@patch("rabbit_consumer.metrics.start_http_server")
+def test_start_metrics_server_disabled(start_http_server):
+    """
+    Tests the metrics endpoint can be disabled
+    """
+    metrics.start_metrics_server(0)
+    start_http_server.assert_not_called()
@@ -40,7 +40,7 @@ def fixture_example_dict_two_entries_internal(example_dict_internal):
     return example_dict_internal
 
 
-@patch("rabbit_consumer.openstack_address.socket.gethostbyaddr")
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
 def test_openstack_address_single_case_internal(mock_socket, example_dict_internal):
     """
     Tests the OpenstackAddress class with a single internal network address
@@ -53,7 +53,7 @@ def test_openstack_address_single_case_internal(mock_socket, example_dict_intern
     mock_socket.assert_called_once()
 
 
-@patch("rabbit_consumer.openstack_address.socket.gethostbyaddr")
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
 def test_openstack_address_multiple_networks_internal(
     mock_socket, example_dict_two_entries_internal
 ):
@@ -68,22 +68,23 @@ def test_openstack_address_multiple_networks_internal(
     mock_socket.assert_called()
 
 
-@patch("rabbit_consumer.openstack_address.socket.gethostbyaddr")
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
 def test_openstack_address_populate_internal(
     mock_socket, example_dict_two_entries_internal
 ):
     """
     Tests the OpenstackAddress class with multiple internal network addresses
     """
-    mock_socket.side_effect = [("hostname", None, None), ("hostname2", None, None)]
+    # Lookups are concurrent, so answer by address rather than call order
+    hostnames = {"127.0.0.63": "hostname", "127.0.0.64": "hostname2"}
+    mock_socket.side_effect = lambda ip: (hostnames[ip], None, None)
     result = OpenstackAddress.get_internal_networks(example_dict_two_entries_internal)
 
     assert result[0].hostname == "hostname"
     assert result[1].hostname == "hostname2"
 
     assert mock_socket.call_count == 2
-    assert mock_socket.call_args_list[0][0][0] == "127.0.0.63"
-    assert mock_socket.call_args_list[1][0][0] == "127.0.0.64"
+    assert {c[0][0] for c in mock_socket.call_args_list} == set(hostnames)
 
 
 @pytest.fixture(name="example_dict_services")
@@ -115,7 +116,7 @@ def fixture_example_dict_two_entries_services(example_dict_services):
     return example_dict_services
 
 
-@patch("rabbit_consumer.openstack_address.socket.gethostbyaddr")
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
 def test_openstack_address_single_case_services(mock_socket, example_dict_services):
     """
     Tests the OpenstackAddress class with a single services network address
@@ -128,7 +129,7 @@ def test_openstack_address_single_case_services(mock_socket, example_dict_servic
     mock_socket.assert_called_once()
 
 
-@patch("rabbit_consumer.openstack_address.socket.gethostbyaddr")
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
 def test_openstack_address_multiple_networks_services(
     mock_socket, example_dict_two_entries_services
 ):
@@ -143,19 +144,35 @@ def test_openstack_address_multiple_networks_services(
     mock_socket.assert_called()
 
 
-@patch("rabbit_consumer.openstack_address.socket.gethostbyaddr")
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
 def test_openstack_address_populate_services(
     mock_socket, example_dict_two_entries_services
 ):
     """
     Tests the OpenstackAddress class with services multiple network addresses
     """
-    mock_socket.side_effect = [("hostname", None, None), ("hostname2", None, None)]
+    # Lookups are concurrent, so answer by address rather than call order
+    hostnames = {"127.0.0.63": "hostname", "127.0.0.64": "hostname2"}
+    mock_socket.side_effect = lambda ip: (hostnames[ip], None, None)
     result = OpenstackAddress.get_services_networks(example_dict_two_entries_services)
 
     assert result[0].hostname == "hostname"
     assert result[1].hostname == "hostname2"
 
     assert mock_socket.call_count == 2
-    assert mock_socket.call_args_list[0][0][0] == "127.0.0.63"
-    assert mock_socket.call_args_list[1][0][0] == "127.0.0.64"
+    assert {c[0][0] for c in mock_socket.call_args_list} == set(hostnames)
+
+
+@patch("rabbit_consumer.dns_resolver.socket.gethostbyaddr")
+def test_openstack_address_hostnames_cached(
+    mock_socket, example_dict_two_entries_internal
+):
+    """
+    Tests hostnames are only looked up once across messages
+    """
+    mock_socket.return_value = ("hostname", None, None)
+    OpenstackAddress.get_internal_networks(example_dict_two_entries_internal)
+    result = OpenstackAddress.get_internal_networks(example_dict_two_entries_internal)
+
+    assert [i.hostname for i in result] == ["hostname", "hostname"]
+    assert mock_socket.call_count == 2
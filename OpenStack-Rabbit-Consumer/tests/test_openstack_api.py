@@ -4,7 +4,12 @@
 Tests that the Openstack API functions are invoked
 as expected with the correct params
 """
-from unittest.mock import NonCallableMock, patch
+import threading
+from unittest.mock import Mock, NonCallableMock, patch
+
+import pytest
+from openstack.exceptions import HttpException
+from prometheus_client import REGISTRY
 
 # noinspection PyUnresolvedReferences
 from rabbit_consumer.openstack_api import (
@@ -14,10 +19,41 @@ from rabbit_consumer.openstack_api import (
     get_server_details,
     get_server_networks,
     get_image,
+    server_cache,
+    invalidate_image_cache,
+    get_image_cache,
+    reset_image_cache,
+    get_server_batcher,
+    reset_server_batcher,
+    _fetch_servers,
+    _thread_connections,
 )
+from rabbit_consumer import openstack_api
+from rabbit_consumer.ttl_cache import TtlLruCache
+
+
+@pytest.fixture(name="fresh_connection", autouse=True)
+def fixture_fresh_connection():
+    """
+    Ensures each test starts without a cached Openstack connection
+    """
+    _thread_connections.conn = None
+    yield
+    _thread_connections.conn = None
 
 
-@patch("rabbit_consumer.openstack_api.ConsumerConfig")
+@pytest.fixture(name="image_cache", autouse=True)
+def fixture_image_cache():
+    """
+    Provides each test with an empty image cache
+    """
+    cache = TtlLruCache(16, 300)
+    openstack_api._image_cache = cache  # pylint: disable=protected-access
+    yield cache
+    reset_image_cache()
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
 @patch("rabbit_consumer.openstack_api.openstack.connect")
 def test_openstack_connection(mock_connect, mock_config):
     """
@@ -36,12 +72,140 @@ def test_openstack_connection(mock_connect, mock_config):
         # Pylint is unable to see that openstack.connect returns a mock
         # pylint: disable=no-member
         assert conn == mock_connect.return_value
-        # pylint: disable=no-member
-        assert conn.close.call_count == 0
 
-    # Check close is called when the context manager exits
+    # The connection is kept open for the next caller
+    # pylint: disable=no-member
+    assert conn.close.call_count == 0
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_is_reused(mock_connect, _):
+    """
+    Test that the connection is only authenticated once per thread
+    """
+    with OpenstackConnection() as first:
+        pass
+    with OpenstackConnection() as second:
+        pass
+
+    mock_connect.assert_called_once()
+    assert first is second
+
+
+def _http_error(status_code: int) -> HttpException:
+    """
+    Returns the error openstacksdk raises for the given response status
+    """
+    response = Mock(status_code=status_code, headers={}, reason="", text="")
+    return HttpException(response=response)
+
+
+@pytest.mark.parametrize(
+    "error,limit",
+    [
+        (_http_error(404), 100),
+        (_http_error(503), 50),
+        (ConnectionError("Refused"), 50),
+    ],
+)
+@patch("rabbit_consumer.openstack_api.get_config", Mock())
+@patch("rabbit_consumer.openstack_api.openstack.connect", Mock())
+def test_openstack_connection_limited(limiters, error, limit):
+    """
+    Test that errors suggesting Openstack is unhealthy reduce its concurrency,
+    unlike requests it rejected
+    """
+    with pytest.raises(type(error)):
+        with OpenstackConnection():
+            raise error
+
+    assert limiters["openstack"].limit == limit
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_fails_to_connect(mock_connect, _, limiters):
+    """
+    Test that the limiter slot is freed and counted as
+    failed when connecting fails
+    """
+    mock_connect.side_effect = ConnectionError("Refused")
+    with pytest.raises(ConnectionError):
+        with OpenstackConnection():
+            pass
+
+    assert limiters["openstack"].limit == 50
+    assert (
+        REGISTRY.get_sample_value(
+            "rabbit_consumer_backend_requests_in_flight", {"backend": "openstack"}
+        )
+        == 0
+    )
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_is_per_thread(mock_connect, _):
+    """
+    Test that each thread holds its own connection
+    """
+    mock_connect.side_effect = lambda **_: Mock()
+    found = []
+
+    def use_connection():
+        with OpenstackConnection() as conn:
+            found.append(conn)
+
+    use_connection()
+    thread = threading.Thread(target=use_connection)
+    thread.start()
+    thread.join()
+
+    assert mock_connect.call_count == 2
+    assert found[0] is not found[1]
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_reset_on_error(mock_connect, _):
+    """
+    Test that an error discards the connection so the next use reconnects
+    """
+    mock_connect.side_effect = [Mock(), Mock()]
+
+    with pytest.raises(ConnectionError):
+        with OpenstackConnection() as failed:
+            raise ConnectionError()
+
     # pylint: disable=no-member
-    assert conn.close.call_count == 1
+    failed.close.assert_called_once()
+
+    with OpenstackConnection() as conn:
+        assert conn is not failed
+    assert mock_connect.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "error,reconnects", [(_http_error(404), False), (_http_error(401), True)]
+)
+@patch("rabbit_consumer.openstack_api.get_config", Mock())
+@patch("rabbit_consumer.openstack_api.openstack.connect")
+def test_openstack_connection_kept_after_rejected_request(
+    mock_connect, error, reconnects
+):
+    """
+    Test that a request Openstack rejected keeps the connection,
+    unless its token was not accepted
+    """
+    mock_connect.side_effect = lambda **_: Mock()
+
+    with pytest.raises(HttpException):
+        with OpenstackConnection() as first:
+            raise error
+
+    with OpenstackConnection() as conn:
+        assert (conn is not first) == reconnects
 
 
 @patch("rabbit_consumer.openstack_api.OpenstackConnection")
@@ -50,11 +214,13 @@ def test_check_machine_exists_existing_machine(conn, vm_data):
     Test that the function returns True when the machine exists
     """
     context = conn.return_value.__enter__.return_value
-    context.compute.find_server.return_value = NonCallableMock()
+    context.compute.servers.return_value = [NonCallableMock()]
     found = check_machine_exists(vm_data)
 
     conn.assert_called_once_with()
-    context.compute.find_server.assert_called_with(vm_data.virtual_machine_id)
+    context.compute.servers.assert_called_with(
+        uuid=vm_data.virtual_machine_id, all_projects=True
+    )
     assert isinstance(found, bool) and found
 
 
@@ -64,12 +230,13 @@ def test_check_machine_exists_deleted_machine(conn, vm_data):
     Test that the function returns False when the machine does not exist
     """
     context = conn.return_value.__enter__.return_value
-    context.compute.find_server.return_value = None
+    context.compute.servers.return_value = []
     found = check_machine_exists(vm_data)
 
     conn.assert_called_once_with()
-    context = conn.return_value.__enter__.return_value
-    context.compute.find_server.assert_called_with(vm_data.virtual_machine_id)
+    context.compute.servers.assert_called_with(
+        uuid=vm_data.virtual_machine_id, all_projects=True
+    )
     assert isinstance(found, bool) and not found
 
 
@@ -91,6 +258,20 @@ def test_update_metadata(server_details, conn, vm_data):
     )
 
 
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+@patch("rabbit_consumer.openstack_api.get_server_details")
+def test_update_metadata_known_server(server_details, conn, vm_data):
+    """
+    Test that a server record passed in is used without looking it up
+    """
+    server = NonCallableMock()
+    update_metadata(vm_data, {"key": "value"}, server)
+
+    server_details.assert_not_called()
+    context = conn.return_value.__enter__.return_value
+    context.compute.set_server_metadata.assert_called_once_with(server, key="value")
+
+
 @patch("rabbit_consumer.openstack_api.OpenstackConnection")
 def test_get_server_details(conn, vm_data):
     """
@@ -108,6 +289,63 @@ def test_get_server_details(conn, vm_data):
     assert result == context.compute.servers.return_value[0]
 
 
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_get_server_details_not_found(conn, vm_data):
+    """
+    Test that the function raises when the server does not exist
+    """
+    context = conn.return_value.__enter__.return_value
+    context.compute.servers.return_value = []
+
+    with pytest.raises(ValueError):
+        get_server_details(vm_data)
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_server_cache_reuses_lookups(conn, vm_data):
+    """
+    Test that lookups within a server_cache block only hit Nova once
+    """
+    context = conn.return_value.__enter__.return_value
+    context.compute.servers.return_value = [NonCallableMock()]
+
+    with server_cache():
+        assert check_machine_exists(vm_data)
+        first = get_server_details(vm_data)
+        assert get_server_details(vm_data) is first
+
+    context.compute.servers.assert_called_once()
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_server_cache_caches_missing_servers(conn, vm_data):
+    """
+    Test that a missing server is also only looked up once
+    """
+    context = conn.return_value.__enter__.return_value
+    context.compute.servers.return_value = []
+
+    with server_cache():
+        assert not check_machine_exists(vm_data)
+        assert not check_machine_exists(vm_data)
+
+    context.compute.servers.assert_called_once()
+
+
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_no_caching_outside_server_cache(conn, vm_data):
+    """
+    Test that lookups outside a server_cache block always go to Nova
+    """
+    context = conn.return_value.__enter__.return_value
+    context.compute.servers.return_value = [NonCallableMock()]
+
+    get_server_details(vm_data)
+    get_server_details(vm_data)
+
+    assert context.compute.servers.call_count == 2
+
+
 @patch("rabbit_consumer.openstack_api.get_server_details")
 @patch("rabbit_consumer.openstack_api.OpenstackAddress")
 def test_get_server_networks_internal(address, server_details, vm_data):
@@ -118,7 +356,7 @@ def test_get_server_networks_internal(address, server_details, vm_data):
 
     get_server_networks(vm_data)
     address.get_internal_networks.assert_called_once_with(
-        server_details.return_value.addresses
+        server_details.return_value.addresses, True
     )
 
 
@@ -132,7 +370,7 @@ def test_get_server_networks_services(address, server_details, vm_data):
 
     get_server_networks(vm_data)
     address.get_services_networks.assert_called_once_with(
-        server_details.return_value.addresses
+        server_details.return_value.addresses, True
     )
 
 
@@ -159,3 +397,110 @@ def test_get_image_no_image_id(server_details, vm_data):
 
     result = get_image(vm_data)
     assert not result
+
+
+@pytest.fixture(name="image_server")
+def fixture_image_server():
+    """
+    Patches out the server lookup with a server built from an image
+    """
+    with patch("rabbit_consumer.openstack_api.get_server_details") as server_details:
+        server_details.return_value = NonCallableMock()
+        server_details.return_value.image.id = "image-id"
+        yield server_details
+
+
+@pytest.mark.usefixtures("image_server")
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_get_image_cached(conn, vm_data):
+    """
+    Tests images are only fetched once, and parsed into their details
+    """
+    image = conn.return_value.__enter__.return_value.compute.find_image.return_value
+    image.name = "rocky-8-aq"
+    image.metadata = {"AQ_OS": "rocky"}
+
+    first = get_image(vm_data)
+    assert get_image(vm_data) is first
+    assert first.name == "rocky-8-aq"
+    assert first.is_aq_managed
+    conn.return_value.__enter__.return_value.compute.find_image.assert_called_once_with(
+        "image-id"
+    )
+
+
+@pytest.mark.usefixtures("image_server")
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_get_image_missing_cached(conn, vm_data):
+    """
+    Tests images which could not be found are also cached
+    """
+    find_image = conn.return_value.__enter__.return_value.compute.find_image
+    find_image.return_value = None
+
+    assert get_image(vm_data) is None
+    assert get_image(vm_data) is None
+    find_image.assert_called_once()
+
+
+@pytest.mark.usefixtures("image_server")
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_invalidate_image_cache(conn, vm_data):
+    """
+    Tests an invalidated image is fetched again
+    """
+    find_image = conn.return_value.__enter__.return_value.compute.find_image
+    find_image.return_value.metadata = {}
+
+    get_image(vm_data)
+    invalidate_image_cache("image-id")
+    get_image(vm_data)
+    assert find_image.call_count == 2
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+def test_get_image_cache_from_config(config):
+    """
+    Tests the image cache is created once from the config
+    """
+    reset_image_cache()
+    config.return_value.openstack_image_cache_size = 8
+    config.return_value.openstack_image_cache_ttl = 60
+
+    assert get_image_cache() is get_image_cache()
+    config.assert_called_once()
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+@patch("rabbit_consumer.openstack_api.OpenstackConnection")
+def test_fetch_servers_lists_recent_changes(conn, config):
+    """
+    Tests batched lookups list recently changed servers, keeping
+    only the live servers asked for
+    """
+    config.return_value.openstack_batch_lookback_seconds = 60
+    wanted, deleted, other = (
+        NonCallableMock(id="wanted", status="ACTIVE"),
+        NonCallableMock(id="deleted", status="DELETED"),
+        NonCallableMock(id="other", status="ACTIVE"),
+    )
+    context = conn.return_value.__enter__.return_value
+    context.compute.servers.return_value = [wanted, deleted, other]
+
+    assert _fetch_servers({"wanted", "deleted"}) == {"wanted": wanted}
+    kwargs = context.compute.servers.call_args.kwargs
+    assert kwargs["all_projects"] is True
+    assert "changes_since" in kwargs
+
+
+@patch("rabbit_consumer.openstack_api.get_config")
+def test_get_server_batcher_from_config(config):
+    """
+    Tests the server batcher is created once from the config
+    """
+    reset_server_batcher()
+    config.return_value.openstack_batch_seconds = 0.1
+    config.return_value.openstack_batch_size = 10
+
+    assert get_server_batcher() is get_server_batcher()
+    config.assert_called_once()
@@ -0,0 +1,141 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests messages are passed through each pipeline stage in order,
+with full stages holding back the consumer
+"""
+import threading
+from unittest.mock import Mock, NonCallableMock
+
+import pytest
+from prometheus_client import REGISTRY
+
+from rabbit_consumer.pipeline import Stage, StagedPipeline
+
+
+def _decoded(instance_id: str, event_type: str = "event") -> NonCallableMock:
+    """
+    Returns a mocked decoded message for the given instance
+    """
+    decoded = NonCallableMock(event_type=event_type)
+    decoded.payload.instance_id = instance_id
+    return decoded
+
+
+def _recording_stages(calls, names=("first", "second")):
+    """
+    Returns stages which record each message they see, then pass it on
+    """
+
+    def handler(name):
+        def _run(job):
+            calls.append((name, job.decoded.event_type))
+            return True
+
+        return _run
+
+    return [Stage(name, handler(name), workers=2) for name in names]
+
+
+@pytest.mark.parametrize(
+    "stages,queue_size",
+    [([], 1), ([Stage("first", Mock(), 1)], 0), ([Stage("first", Mock(), 0)], 1)],
+)
+def test_pipeline_rejects_invalid_config(stages, queue_size):
+    """
+    Test that a pipeline needs stages, queues and workers
+    """
+    with pytest.raises(ValueError):
+        StagedPipeline(stages, queue_size)
+
+
+def test_messages_pass_through_every_stage_in_order():
+    """
+    Test that each message runs through the stages in turn, with
+    messages for the same VM kept in the order they were received
+    """
+    calls = []
+    messages = [NonCallableMock() for _ in range(10)]
+
+    with StagedPipeline(_recording_stages(calls), queue_size=2) as pipeline:
+        for i, message in enumerate(messages):
+            pipeline.submit(message, _decoded("instance_id", str(i)))
+
+    assert [c for c in calls if c[0] == "first"] == [
+        ("first", str(i)) for i in range(10)
+    ]
+    assert [c for c in calls if c[0] == "second"] == [
+        ("second", str(i)) for i in range(10)
+    ]
+    for message in messages:
+        message.ack.assert_called_once()
+
+
+def test_stage_can_finish_message_early():
+    """
+    Test that a stage returning False acks the message without
+    running the stages after it
+    """
+    later = Mock()
+    stages = [Stage("first", Mock(return_value=False), 1), Stage("second", later, 1)]
+    message = NonCallableMock()
+
+    with StagedPipeline(stages, queue_size=1) as pipeline:
+        pipeline.submit(message, _decoded("instance_id"))
+
+    later.assert_not_called()
+    message.ack.assert_called_once()
+
+
+def test_failed_stage_retries_message():
+    """
+    Test that a message failing part way through is moved onto the
+    retry queues, without running later stages
+    """
+    error = ValueError("Failed")
+    later, router = Mock(), Mock()
+    stages = [Stage("first", Mock(side_effect=error), 1), Stage("second", later, 1)]
+    message, decoded = NonCallableMock(), _decoded("instance_id")
+
+    with StagedPipeline(stages, queue_size=1, retry_router=router) as pipeline:
+        pipeline.submit(message, decoded)
+
+    later.assert_not_called()
+    router.route.assert_called_once_with(message, error, "event", retry=True)
+    message.ack.assert_called_once()
+
+
+def test_full_stage_blocks_submit():
+    """
+    Test that once a stage's queue is full, submitting waits for space,
+    and the backlog is exported as the queue depth
+    """
+    release = threading.Event()
+    stages = [Stage("blocked", lambda _: release.wait(5), 1)]
+    pipeline = StagedPipeline(stages, queue_size=1)
+    assert pipeline.prefetch_count == 2
+
+    with pipeline:
+        # One message is being handled and one is queued
+        pipeline.submit(NonCallableMock(), _decoded("instance_id"))
+        pipeline.submit(NonCallableMock(), _decoded("instance_id"))
+        submitted = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (
+                pipeline.submit(NonCallableMock(), _decoded("instance_id")),
+                submitted.set(),
+            )
+        )
+        thread.start()
+
+        assert not submitted.wait(0.1)
+        assert pipeline.depth("blocked") == 1
+        assert (
+            REGISTRY.get_sample_value(
+                "rabbit_consumer_pipeline_queue_depth", {"stage": "blocked"}
+            )
+            == 1
+        )
+        release.set()
+        assert submitted.wait(1)
+        thread.join()
@@ -4,52 +4,27 @@
 Tests rabbit messages are consumed correctly from the queue
 """
 import json
-from typing import Dict
 
 import pytest
 
 from rabbit_consumer.rabbit_message import RabbitMessage
 
 
-def _example_dict(with_metadata: bool) -> Dict:
-    """
-    Returns an example dictionary for testing, based on real data from the RabbitMQ queue
-    """
-    example_dict = {
-        "event_type": "compute.instance.create.end",
-        "_context_project_name": "project_name",
-        "_context_project_id": "project_id",
-        "_context_user_name": "user_name",
-        "payload": {
-            "instance_id": "instance_id",
-            "display_name": "vm_name",
-            "vcpus": 1,
-            "memory_mb": 1024,
-            "host": "vm_host",
-            "metadata": {},
-        },
-    }
-
-    if with_metadata:
-        example_dict["payload"]["metadata"] = {"AQ_MACHINENAME": "machine_name"}
-
-    return example_dict
-
-
 @pytest.fixture(name="example_json")
-def fixture_example_json():
+def fixture_example_json(example_notification):
     """
     Returns an example JSON string for testing, based on real data from the RabbitMQ queue
     """
-    return json.dumps(_example_dict(with_metadata=False))
+    return json.dumps(example_notification)
 
 
 @pytest.fixture(name="example_json_with_metadata")
-def fixture_example_json_with_metadata():
+def fixture_example_json_with_metadata(example_notification):
     """
     Returns an example JSON string for testing, with metadata included
     """
-    return json.dumps(_example_dict(with_metadata=True))
+    example_notification["payload"]["metadata"] = {"AQ_MACHINENAME": "machine_name"}
+    return json.dumps(example_notification)
 
 
 def test_rabbit_json_load(example_json):
@@ -74,3 +49,12 @@ def test_with_metadata(example_json_with_metadata):
     """
     deserialized = RabbitMessage.from_json(example_json_with_metadata)
     assert deserialized.payload.metadata.machine_name == "machine_name"
+
+
+def test_message_id(example_notification):
+    """
+    Tests the message ID is read when present, and optional otherwise
+    """
+    assert RabbitMessage.from_dict(example_notification).message_id is None
+    example_notification["message_id"] = "message_id"
+    assert RabbitMessage.from_dict(example_notification).message_id == "message_id"
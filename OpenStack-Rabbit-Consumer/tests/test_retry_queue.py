@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that failed messages are moved onto retry queues,
+then finally the dead-letter queue
+"""
+from unittest.mock import NonCallableMock, patch, call
+
+import pytest
+
+from rabbit_consumer.retry_queue import ATTEMPTS_HEADER, ERROR_HEADER, RetryRouter
+
+
+@pytest.fixture(name="channel")
+def fixture_channel():
+    """
+    Returns a mocked rabbit channel
+    """
+    return NonCallableMock()
+
+
+@pytest.fixture(name="router")
+def fixture_router(channel):
+    """
+    Returns a router allowing 3 attempts, with a 10 second initial delay
+    """
+    return RetryRouter(channel, "ral.info", 3, 10)
+
+
+def _message(attempts=None) -> NonCallableMock:
+    """
+    Returns a mocked message which has already failed the given number of times
+    """
+    message = NonCallableMock()
+    message.body = b"body"
+    message.properties = {"content_type": "application/json"}
+    if attempts is not None:
+        message.properties["headers"] = {ATTEMPTS_HEADER: attempts}
+    return message
+
+
+@pytest.mark.parametrize("max_attempts", [0, -1])
+def test_router_rejects_invalid_attempts(max_attempts):
+    """
+    Test that at least one attempt is required
+    """
+    with pytest.raises(ValueError):
+        RetryRouter(NonCallableMock(), "ral.info", max_attempts, 10)
+
+
+def test_retry_delay_doubles(router):
+    """
+    Test that each retry waits twice as long as the last
+    """
+    assert [router.retry_delay_ms(i) for i in range(1, 4)] == [10000, 20000, 40000]
+    assert router.retry_queue(2) == "ral.info.retry.20000ms"
+    assert router.dead_letter_queue == "ral.info.dead"
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_declare(rabbitpy, router, channel):
+    """
+    Test that a retry queue is declared for each retry, which
+    dead-letters back onto the consumed queue
+    """
+    router.declare()
+
+    expected = [
+        call(
+            channel,
+            name=f"ral.info.retry.{delay}ms",
+            durable=True,
+            arguments={
+                "x-message-ttl": delay,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": "ral.info",
+            },
+        )
+        for delay in (10000, 20000)
+    ]
+    expected.append(call(channel, name="ral.info.dead", durable=True))
+    assert rabbitpy.Queue.call_args_list == expected
+    assert rabbitpy.Queue.return_value.declare.call_count == 3
+
+
+@pytest.mark.parametrize(
+    "attempts,expected_queue",
+    [(None, "ral.info.retry.10000ms"), (1, "ral.info.retry.20000ms")],
+)
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_route_retries(rabbitpy, router, channel, attempts, expected_queue):
+    """
+    Test that failed messages with attempts left are republished
+    onto the retry queue for their attempt
+    """
+    message = _message(attempts)
+    assert router.route(message, ValueError("Bad"), "event") == expected_queue
+
+    properties = rabbitpy.Message.call_args.kwargs["properties"]
+    assert properties["content_type"] == "application/json"
+    assert properties["delivery_mode"] == 2
+    assert properties["headers"][ATTEMPTS_HEADER] == (attempts or 0) + 1
+    rabbitpy.Message.assert_called_once_with(channel, b"body", properties=properties)
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key=expected_queue
+    )
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_route_dead_letters_last_attempt(rabbitpy, router):
+    """
+    Test that a message failing its final attempt is dead-lettered
+    with the error attached
+    """
+    assert router.route(_message(2), ValueError("Bad"), "event") == "ral.info.dead"
+
+    headers = rabbitpy.Message.call_args.kwargs["properties"]["headers"]
+    assert headers[ATTEMPTS_HEADER] == 3
+    assert headers[ERROR_HEADER] == "ValueError: Bad"
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_route_without_retry(rabbitpy, router):
+    """
+    Test that messages which should not be retried go straight to the
+    dead-letter queue, without modifying the original message
+    """
+    message = _message()
+    assert router.route(message, ValueError(), "event", retry=False) == "ral.info.dead"
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        "", routing_key="ral.info.dead"
+    )
+    assert "headers" not in message.properties
+
+
+@patch("rabbit_consumer.retry_queue.rabbitpy")
+def test_route_unconfirmed_raises(rabbitpy, router):
+    """
+    Test that a message RabbitMQ did not confirm raises, so the
+    original is left to be redelivered
+    """
+    rabbitpy.Message.return_value.publish.return_value = False
+    with pytest.raises(RuntimeError):
+        router.route(_message(), ValueError(), "event")
+
+
+def test_prepare_without_channel():
+    """
+    Test that a router without a channel can still plan where a failed
+    message goes, for consumers publishing with another client
+    """
+    router = RetryRouter(None, "ral.info", 3, 10)
+    destination, properties = router.prepare(_message(1), ValueError("x"), "event")
+
+    assert destination == "ral.info.retry.20000ms"
+    assert properties["headers"][ATTEMPTS_HEADER] == 2
+    assert properties["content_type"] == "application/json"
+    assert list(router.retry_queue_arguments()) == [
+        "ral.info.retry.10000ms",
+        "ral.info.retry.20000ms",
+    ]
@@ -0,0 +1,134 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests concurrent server lookups are gathered into batched requests,
+with each waiting thread handed its own result
+"""
+import threading
+import time
+from unittest.mock import Mock, NonCallableMock
+
+import pytest
+
+from rabbit_consumer.server_batcher import ServerBatcher
+
+
+def _find_concurrently(batcher, server_ids):
+    """
+    Looks up each server on its own thread whilst another lookup is in
+    flight, so the first waits to be joined, returning the results by ID
+    """
+    batcher._in_flight += 1  # pylint: disable=protected-access
+    results = {}
+
+    def _find(server_id):
+        try:
+            results[server_id] = batcher.find(server_id)
+        except ValueError as err:
+            results[server_id] = err
+
+    threads = [threading.Thread(target=_find, args=(i,)) for i in server_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_batcher_rejects_invalid_size():
+    """
+    Test that a batch must hold at least one server
+    """
+    with pytest.raises(ValueError):
+        ServerBatcher(Mock(), Mock(), window_seconds=1, max_batch=0)
+
+
+def test_no_window_fetches_individually():
+    """
+    Test that without a window each lookup is its own request
+    """
+    fetch_one, fetch_many = Mock(), Mock()
+    batcher = ServerBatcher(fetch_one, fetch_many, window_seconds=0, max_batch=10)
+
+    assert batcher.find("id") == fetch_one.return_value
+    fetch_one.assert_called_once_with("id")
+    fetch_many.assert_not_called()
+
+
+def test_lone_lookup_fetches_individually():
+    """
+    Test that a lookup made whilst no others are in flight is fetched
+    by itself, without waiting out the window
+    """
+    fetch_one, fetch_many = Mock(), Mock()
+    batcher = ServerBatcher(fetch_one, fetch_many, window_seconds=30, max_batch=10)
+
+    start = time.monotonic()
+    assert batcher.find("id") == fetch_one.return_value
+    assert time.monotonic() - start < 5
+    fetch_many.assert_not_called()
+
+
+def test_lookup_waits_whilst_others_in_flight():
+    """
+    Test that a lookup made whilst another is being fetched waits out
+    the window for others to join it
+    """
+    fetch_one, fetch_many = Mock(), Mock()
+    batcher = ServerBatcher(fetch_one, fetch_many, window_seconds=0.1, max_batch=10)
+
+    start = time.monotonic()
+    assert _find_concurrently(batcher, ["id"]) == {"id": fetch_one.return_value}
+    assert time.monotonic() - start >= 0.1
+
+
+def test_concurrent_lookups_are_batched():
+    """
+    Test that lookups made together share one request, and a full
+    batch is fetched without waiting out the window
+    """
+    servers = {i: NonCallableMock() for i in ("a", "b", "c")}
+    fetch_one, fetch_many = Mock(), Mock(return_value=servers)
+    batcher = ServerBatcher(fetch_one, fetch_many, window_seconds=30, max_batch=3)
+
+    assert _find_concurrently(batcher, servers) == servers
+    fetch_many.assert_called_once_with({"a", "b", "c"})
+    fetch_one.assert_not_called()
+
+
+def test_full_batch_starts_another():
+    """
+    Test that lookups after a batch fills are gathered into a new one
+    """
+    fetch_many = Mock(side_effect=lambda ids: {i: i.upper() for i in ids})
+    batcher = ServerBatcher(Mock(), fetch_many, window_seconds=30, max_batch=2)
+
+    results = _find_concurrently(batcher, ["a", "b", "c", "d"])
+
+    assert results == {"a": "A", "b": "B", "c": "C", "d": "D"}
+    assert [len(c.args[0]) for c in fetch_many.call_args_list] == [2, 2]
+
+
+def test_missing_servers_fetched_individually():
+    """
+    Test that servers the batched request missed are looked up by themselves
+    """
+    found = NonCallableMock()
+    fetch_one = Mock(return_value=None)
+    fetch_many = Mock(return_value={"a": found})
+    batcher = ServerBatcher(fetch_one, fetch_many, window_seconds=30, max_batch=2)
+
+    assert _find_concurrently(batcher, ["a", "b"]) == {"a": found, "b": None}
+    fetch_one.assert_called_once_with("b")
+
+
+def test_batch_error_raised_for_every_lookup():
+    """
+    Test that a failed request fails every lookup waiting on it
+    """
+    error = ValueError("Failed")
+    batcher = ServerBatcher(
+        Mock(), Mock(side_effect=error), window_seconds=30, max_batch=2
+    )
+
+    assert _find_concurrently(batcher, ["a", "b"]) == {"a": error, "b": error}
@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests that VM messages are spread over shard queues by instance ID,
+and the shards are divided between replicas
+"""
+from unittest.mock import Mock, NonCallableMock, call, patch
+
+import pytest
+
+from rabbit_consumer.message_consumer import IMAGE_EVENT_TYPES, dispatch_message
+from rabbit_consumer.sharding import (
+    BROADCAST_ROUTING_KEY,
+    SHARD_EXCHANGE,
+    ShardRouter,
+    consume_concurrently,
+    declare_shards,
+    get_replica_index,
+    owned_shards,
+    shard_for,
+    shard_queue,
+)
+from rabbit_consumer.ttl_cache import TtlLruCache
+
+CREATE = "compute.instance.create.end"
+DELETE = "compute.instance.delete.start"
+
+
+@pytest.fixture(name="router")
+def fixture_router():
+    """
+    Returns a router over 8 shards, forwarding creates and deletes
+    """
+    return ShardRouter(NonCallableMock(), 8, event_types=[CREATE, DELETE])
+
+
+def _config(replicas: int, replica_index: int = -1) -> NonCallableMock:
+    """
+    Returns a mocked config for the given replica settings
+    """
+    return NonCallableMock(
+        consumer_replicas=replicas, consumer_replica_index=replica_index
+    )
+
+
+def test_shard_for_is_stable():
+    """
+    Test that an instance always maps to the same shard, within range
+    """
+    shards = [shard_for(f"instance-{i}", 8) for i in range(100)]
+    assert shards == [shard_for(f"instance-{i}", 8) for i in range(100)]
+    assert set(shards) == set(range(8))
+
+
+@pytest.mark.parametrize("replicas", [1, 3, 8])
+def test_owned_shards_cover_every_shard_once(replicas):
+    """
+    Test that each shard is owned by exactly one replica
+    """
+    owned = [owned_shards(8, replicas, index) for index in range(replicas)]
+    assert sorted(shard for shards in owned for shard in shards) == list(range(8))
+    assert owned_shards(8, 3, 1) == [1, 4, 7]
+
+
+def test_replica_index_from_config():
+    """
+    Test that an explicit replica index is used over the hostname
+    """
+    assert get_replica_index(_config(4, 2), hostname="rabbit-consumer-0") == 2
+    assert get_replica_index(_config(1), hostname="no-ordinal") == 0
+
+
+def test_replica_index_from_hostname():
+    """
+    Test that the index is taken from the StatefulSet pod ordinal
+    """
+    assert get_replica_index(_config(4), hostname="rabbit-consumer-3") == 3
+
+
+@pytest.mark.parametrize("hostname", ["rabbit-consumer", "rabbit-consumer-4"])
+def test_replica_index_invalid_hostname(hostname):
+    """
+    Test that a hostname without a valid ordinal is rejected
+    """
+    with pytest.raises(ValueError):
+        get_replica_index(_config(4), hostname=hostname)
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_declare_shards(rabbitpy):
+    """
+    Test that each shard queue is declared for a single active consumer,
+    and bound to the exchange by its shard number and the broadcast key
+    """
+    channel = NonCallableMock()
+    declare_shards(channel, 2)
+
+    rabbitpy.DirectExchange.assert_called_once_with(
+        channel, SHARD_EXCHANGE, durable=True
+    )
+    exchange = rabbitpy.DirectExchange.return_value
+    exchange.declare.assert_called_once()
+    assert [c.kwargs["name"] for c in rabbitpy.Queue.call_args_list] == [
+        "ral.info.shard.0",
+        "ral.info.shard.1",
+    ]
+    assert rabbitpy.Queue.call_args.kwargs["arguments"] == {
+        "x-single-active-consumer": True
+    }
+    assert rabbitpy.Queue.return_value.bind.call_args_list[-2:] == [
+        call(exchange, routing_key="1"),
+        call(exchange, routing_key=BROADCAST_ROUTING_KEY),
+    ]
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_forwards_vm_messages(rabbitpy, router, oslo_body_factory):
+    """
+    Test that creates and deletes are published onto the shard for their VM
+    """
+    message = NonCallableMock(properties={"message_id": "id"})
+    message.body = oslo_body_factory(DELETE)
+
+    shard = router.forward(message)
+
+    assert shard == shard_for("instance_id", 8)
+    assert shard_queue(shard) == f"ral.info.shard.{shard}"
+    _, body = rabbitpy.Message.call_args.args
+    assert body == message.body
+    assert rabbitpy.Message.call_args.kwargs["properties"] == {
+        "message_id": "id",
+        "delivery_mode": 2,
+    }
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        SHARD_EXCHANGE, routing_key=str(shard)
+    )
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'{"oslo.message": "{\\"event_type\\": \\"compute.instance.exists\\"}"}',
+        b"not json",
+        b'{"oslo.message": "{\\"payload\\": {\\"instance_id\\": \\"id\\"}}"}',
+    ],
+)
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_leaves_other_messages(rabbitpy, router, body):
+    """
+    Test that ignored, undecodable and untyped messages are not forwarded
+    """
+    assert router.forward(NonCallableMock(body=body, properties={})) is None
+    rabbitpy.Message.assert_not_called()
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_unconfirmed_raises(rabbitpy, router, oslo_body_factory):
+    """
+    Test that a message RabbitMQ did not confirm raises, so the
+    original is left to be redelivered
+    """
+    rabbitpy.Message.return_value.publish.return_value = False
+    message = NonCallableMock(body=oslo_body_factory(CREATE), properties={})
+    with pytest.raises(RuntimeError):
+        router.forward(message)
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_router_broadcasts_only_broadcast_types(rabbitpy, router, oslo_body_factory):
+    """
+    Test that only the broadcast types are copied onto every shard
+    """
+    message = NonCallableMock(body=oslo_body_factory(CREATE), properties={})
+    assert not router.broadcast(message)
+    rabbitpy.Message.assert_not_called()
+
+
+@patch("rabbit_consumer.sharding.rabbitpy")
+def test_image_update_reaches_every_replica(rabbitpy, oslo_body_factory):
+    """
+    Test that an image update read from ral.info by the first replica is
+    copied onto every shard, and invalidates the cached image of a replica
+    consuming its copy from another shard
+    """
+    router = ShardRouter(
+        NonCallableMock(), 4, event_types=[CREATE], broadcast_types=IMAGE_EVENT_TYPES
+    )
+    body = oslo_body_factory("image.update", {"id": "image-id"})
+    assert router.broadcast(NonCallableMock(body=body, properties={}))
+    rabbitpy.Message.return_value.publish.assert_called_once_with(
+        SHARD_EXCHANGE, routing_key=BROADCAST_ROUTING_KEY
+    )
+
+    cache = TtlLruCache(10, 900)
+    cache.put("image-id", NonCallableMock())
+    pool = Mock()
+    with patch("rabbit_consumer.openstack_api.get_image_cache", return_value=cache):
+        # As replica 1 handles the copy delivered on its own shard queue
+        dispatch_message(pool, NonCallableMock(body=rabbitpy.Message.call_args.args[1]))
+
+    assert not cache.get("image-id")[0]
+    pool.ignore.assert_called_once()
+
+
+def test_router_rejects_invalid_shard_count():
+    """
+    Test that at least one shard is required
+    """
+    with pytest.raises(ValueError):
+        ShardRouter(NonCallableMock(), 0, event_types=[CREATE])
+
+
+def test_consume_concurrently_returns_when_a_loop_stops():
+    """
+    Test that the loops run until the first one stops
+    """
+    calls = []
+    consume_concurrently({"first": lambda: calls.append(1)})
+    assert calls == [1]
+
+
+def test_consume_concurrently_raises_errors():
+    """
+    Test that a failed loop raises its error on the calling thread
+    """
+
+    def fail():
+        raise ConnectionError("Closed")
+
+    with pytest.raises(ConnectionError, match="Closed"):
+        consume_concurrently({"failing": fail})
@@ -0,0 +1,96 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the TTL and LRU cache
+"""
+from unittest.mock import Mock
+
+import pytest
+
+from rabbit_consumer.ttl_cache import TtlLruCache
+
+
+@pytest.fixture(name="clock")
+def fixture_clock():
+    """
+    Provides a clock which only moves when told to
+    """
+    return Mock(return_value=100.0)
+
+
+def test_get_returns_stored_value(clock):
+    """
+    Tests a stored value is returned until it expires
+    """
+    cache = TtlLruCache(4, ttl=10, clock=clock)
+    cache.put("key", "value")
+    assert cache.get("key") == (True, "value")
+
+    clock.return_value = 110.0
+    assert cache.get("key") == (False, None)
+    assert len(cache) == 0
+
+
+def test_put_with_ttl(clock):
+    """
+    Tests an entry's TTL overrides the cache's, and a TTL of 0 is not stored
+    """
+    cache = TtlLruCache(4, ttl=10, clock=clock)
+    cache.put("short", 1, ttl=1)
+    cache.put("disabled", 2, ttl=0)
+
+    clock.return_value = 101.0
+    assert cache.get("short") == (False, None)
+    assert cache.get("disabled") == (False, None)
+
+
+def test_least_recently_used_evicted(clock):
+    """
+    Tests the least recently used entry is evicted once full
+    """
+    cache = TtlLruCache(2, ttl=10, clock=clock)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+
+
+def test_invalidate_and_clear(clock):
+    """
+    Tests entries can be removed individually or all at once
+    """
+    cache = TtlLruCache(4, ttl=10, clock=clock)
+    cache.put("a", 1)
+    cache.put("b", 2)
+
+    cache.invalidate("a")
+    assert cache.get("a") == (False, None)
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_stats(clock):
+    """
+    Tests hits and misses are counted
+    """
+    cache = TtlLruCache(4, ttl=10, clock=clock)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("a")
+    cache.get("b")
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.size) == (2, 1, 1)
+    assert stats.hit_rate == pytest.approx(2 / 3)
+
+
+def test_invalid_size():
+    """
+    Tests the cache must hold at least one entry
+    """
+    with pytest.raises(ValueError):
+        TtlLruCache(0, ttl=10)
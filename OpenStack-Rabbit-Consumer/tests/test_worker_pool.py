@@ -0,0 +1,287 @@
+# SPDX-License-Identifier: Apache-2.0
+# Copyright (c) 2023 United Kingdom Research and Innovation
+"""
+Tests the worker pool dispatches messages concurrently
+whilst keeping per-VM ordering
+"""
+import threading
+from unittest.mock import Mock, NonCallableMock, patch
+
+import pytest
+
+from rabbit_consumer.backend_limiter import CircuitOpenError
+from rabbit_consumer.coalescer import CreateDeleteCoalescer
+from rabbit_consumer.worker_pool import MessageWorkerPool
+
+
+def _decoded(instance_id: str) -> NonCallableMock:
+    """
+    Returns a mocked decoded message for the given instance
+    """
+    decoded = NonCallableMock()
+    decoded.payload.instance_id = instance_id
+    return decoded
+
+
+@pytest.mark.parametrize("worker_count", [0, -1])
+def test_pool_rejects_invalid_worker_count(worker_count):
+    """
+    Test that the pool requires at least one worker
+    """
+    with pytest.raises(ValueError):
+        MessageWorkerPool(worker_count, Mock())
+
+
+def test_partition_is_stable():
+    """
+    Test that the same instance is always routed to the same worker
+    """
+    pool = MessageWorkerPool(4, Mock())
+    first = pool.partition("instance_id")
+    assert all(pool.partition("instance_id") == first for _ in range(10))
+    assert 0 <= first < 4
+
+
+def test_submit_handles_and_acks():
+    """
+    Test that submitted messages are handled then acked
+    """
+    handler = Mock()
+    message, decoded = Mock(), _decoded("instance_id")
+
+    with MessageWorkerPool(2, handler) as pool:
+        pool.submit(message, decoded)
+
+    handler.assert_called_once_with(decoded)
+    message.ack.assert_called_once()
+
+
+def test_same_instance_handled_in_order():
+    """
+    Test that messages for a single instance are handled in the order received
+    """
+    handled = []
+    decoded = [_decoded("instance_id") for _ in range(20)]
+
+    with MessageWorkerPool(4, handled.append) as pool:
+        for i in decoded:
+            pool.submit(Mock(), i)
+
+    assert handled == decoded
+
+
+def test_different_instances_handled_concurrently():
+    """
+    Test that a slow message does not block messages for other instances
+    """
+    pool = MessageWorkerPool(2, Mock())
+    slow_id = "slow"
+    fast_id = next(
+        f"fast-{i}"
+        for i in range(100)
+        if pool.partition(f"fast-{i}") != pool.partition(slow_id)
+    )
+
+    release = threading.Event()
+    fast_done = threading.Event()
+
+    def handler(decoded):
+        if decoded.payload.instance_id == slow_id:
+            assert release.wait(timeout=5)
+        else:
+            fast_done.set()
+
+    pool = MessageWorkerPool(2, handler)
+    with pool:
+        pool.submit(Mock(), _decoded(slow_id))
+        pool.submit(Mock(), _decoded(fast_id))
+        assert fast_done.wait(timeout=5)
+        release.set()
+
+
+def test_failed_handler_does_not_ack():
+    """
+    Test that a failed message is not acked, and the error is
+    raised on the next submission
+    """
+    handler = Mock(side_effect=ConnectionError("AQ down"))
+    message = Mock()
+
+    with MessageWorkerPool(1, handler) as pool:
+        pool.submit(message, _decoded("instance_id"))
+
+    message.ack.assert_not_called()
+    with pytest.raises(ConnectionError):
+        pool.submit(Mock(), _decoded("instance_id"))
+
+
+def test_failed_handler_routed_for_retry():
+    """
+    Test that a failed message is moved onto the retry router and acked,
+    without stopping the pool
+    """
+    error = ConnectionError("AQ down")
+    handler = Mock(side_effect=[error, None])
+    router = Mock()
+    failed, handled = Mock(), Mock()
+    decoded = _decoded("instance_id")
+
+    with MessageWorkerPool(1, handler, retry_router=router) as pool:
+        pool.submit(failed, decoded)
+        pool.submit(handled, decoded)
+
+    router.route.assert_called_once_with(failed, error, decoded.event_type, retry=True)
+    failed.ack.assert_called_once()
+    handled.ack.assert_called_once()
+
+
+@patch("rabbit_consumer.backend_limiter.wait_for_backends")
+def test_circuit_open_holds_message(wait_for_backends):
+    """
+    Test that a message interrupted by a backend's circuit opening is
+    run again once the backend recovers, rather than retried
+    """
+    handler = Mock(side_effect=[CircuitOpenError("AQ down"), None])
+    router, message = Mock(), Mock()
+
+    with MessageWorkerPool(1, handler, retry_router=router) as pool:
+        pool.submit(message, _decoded("instance_id"))
+
+    assert handler.call_count == 2
+    assert wait_for_backends.call_count == 2
+    router.route.assert_not_called()
+    message.ack.assert_called_once()
+
+
+def test_failed_routing_does_not_ack():
+    """
+    Test that a message which could not be moved onto a retry queue is
+    left un-acked, and the handler error stops the pool
+    """
+    handler = Mock(side_effect=ConnectionError("AQ down"))
+    router = Mock()
+    router.route.side_effect = OSError("Channel closed")
+    message = Mock()
+
+    with MessageWorkerPool(1, handler, retry_router=router) as pool:
+        pool.submit(message, _decoded("instance_id"))
+
+    message.ack.assert_not_called()
+    with pytest.raises(ConnectionError):
+        pool.submit(Mock(), _decoded("instance_id"))
+
+
+def test_reject_without_router_raises():
+    """
+    Test that rejecting a message raises its error when there is no router
+    """
+    message = Mock()
+    with pytest.raises(ValueError):
+        MessageWorkerPool(1, Mock()).reject(message, ValueError(), "unknown")
+    message.ack.assert_not_called()
+
+
+def test_delete_cancels_queued_create():
+    """
+    Test that a create still queued when its delete arrives is acked
+    without being handled
+    """
+    started, release = threading.Event(), threading.Event()
+    handled = []
+
+    def _handler(decoded):
+        if decoded.payload.instance_id == "blocker":
+            started.set()
+            release.wait(timeout=5)
+        handled.append(decoded)
+
+    coalescer = CreateDeleteCoalescer(0, "create", "delete")
+    blocker, create, delete = _decoded("blocker"), _decoded("vm"), _decoded("vm")
+    blocker.event_type, create.event_type = "create", "create"
+    delete.event_type = "delete"
+    create_message = Mock()
+
+    with MessageWorkerPool(1, _handler, coalescer) as pool:
+        pool.submit(Mock(), blocker)
+        started.wait(timeout=5)
+        pool.submit(create_message, create)
+        pool.submit(Mock(), delete)
+        release.set()
+
+    assert handled == [blocker, delete]
+    create_message.ack.assert_called_once()
+
+
+def test_ignored_messages_acked_in_batches():
+    """
+    Test that ignored messages are acked together once a batch is full,
+    and any still held are acked when the pool exits
+    """
+    channel = NonCallableMock()
+    messages = [NonCallableMock(delivery_tag=i, channel=channel) for i in range(5)]
+
+    with MessageWorkerPool(1, Mock(), ack_batch_size=2) as pool:
+        for message in messages:
+            pool.ignore(message)
+
+    messages[0].ack.assert_not_called()
+    messages[1].ack.assert_called_once_with(all_previous=True)
+    messages[3].ack.assert_called_once_with(all_previous=True)
+    messages[4].ack.assert_called_once_with(all_previous=True)
+
+
+def test_ignored_batch_skips_handled_message():
+    """
+    Test that a batch never acks a message still being handled
+    """
+    channel = NonCallableMock()
+    release = threading.Event()
+    handled = NonCallableMock(delivery_tag=0, channel=channel)
+    ignored = [NonCallableMock(delivery_tag=i, channel=channel) for i in (1, 2)]
+
+    with MessageWorkerPool(
+        1, lambda _: release.wait(timeout=5), ack_batch_size=2
+    ) as pool:
+        pool.submit(handled, _decoded("instance_id"))
+        for message in ignored:
+            pool.ignore(message)
+        for message in ignored:
+            message.ack.assert_called_once_with(all_previous=False)
+        release.set()
+
+    handled.ack.assert_called_once_with(all_previous=False)
+
+
+def test_pool_rejects_invalid_ack_batch_size():
+    """
+    Test that acks cannot be batched by less than one message
+    """
+    with pytest.raises(ValueError):
+        MessageWorkerPool(1, Mock(), ack_batch_size=0)
+
+
+def test_full_worker_queue_blocks_submit():
+    """
+    Test that submit waits once a worker's queue is full, and the pool
+    asks for no more messages than its workers can hold
+    """
+    started, release = threading.Event(), threading.Event()
+
+    def _handler(_):
+        started.set()
+        release.wait(timeout=5)
+
+    with MessageWorkerPool(1, _handler, queue_size=1) as pool:
+        assert pool.prefetch_count == 2
+        pool.submit(Mock(), _decoded("vm"))
+        started.wait(timeout=5)
+        pool.submit(Mock(), _decoded("vm"))
+
+        blocked = threading.Thread(target=pool.submit, args=(Mock(), _decoded("vm")))
+        blocked.start()
+        blocked.join(timeout=0.1)
+        assert blocked.is_alive()
+
+        release.set()
+        blocked.join(timeout=5)
+        assert not blocked.is_alive()